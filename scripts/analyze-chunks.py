@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import chunks
+import disks
+import os
+import paths
+import prefetch
+import sys
+import typing
+
+DEFAULT_CHUNK_SIZES = "64K,128K,256K,512K,1M"
+# Built by import-disks.py (only their manifests and chunks are kept).
+INFINITE_HD_NAMES = [
+    "Infinite HD.dsk",
+    "Infinite HD6.dsk",
+    "Infinite HDX.dsk",
+    "Infinite HD (MFS).dsk",
+    "Infinite HD (NeXT).dsk",
+]
+
+
+class Strategy(typing.NamedTuple):
+    name: str
+    content_defined: bool
+    chunk_size: int = chunks.CHUNK_SIZE
+    min_size: int = chunks.CDC_MIN_SIZE
+    avg_size: int = chunks.CDC_AVG_SIZE
+    max_size: int = chunks.CDC_MAX_SIZE
+
+    def iter_chunks(self, image_file: typing.BinaryIO) -> typing.Iterator[bytearray]:
+        if self.content_defined:
+            return chunks.iter_cdc_chunks(
+                image_file, self.min_size, self.avg_size, self.max_size
+            )
+        return chunks.iter_chunks(image_file, self.chunk_size)
+
+
+class Image(typing.NamedTuple):
+    name: str
+    open: typing.Callable[[], typing.BinaryIO]
+    # Byte ranges read while booting, derived from the prefetchChunks list.
+    boot_ranges: typing.List[typing.Tuple[int, int]]
+
+
+class ImageStats(typing.NamedTuple):
+    name: str
+    total_size: int
+    # Number of non-zero chunks, i.e. requests needed to read the entire image.
+    request_count: int
+    # Number of non-zero chunks that overlap the bytes read while booting.
+    boot_request_count: int
+    # Bytes in non-zero chunks, i.e. bytes transferred to read the entire image.
+    fetched_bytes: int
+    # Bytes in chunks that were not already produced by an earlier image.
+    new_bytes: int
+    # Size of every distinct non-zero chunk in the image, by signature.
+    signature_sizes: typing.Dict[str, int]
+
+
+def parse_size(size: str) -> int:
+    size = size.strip().upper()
+    for suffix, multiplier in (("K", 1024), ("M", 1024 * 1024)):
+        if size.endswith(suffix):
+            return int(size[: -len(suffix)]) * multiplier
+    return int(size)
+
+
+def format_size(size: int) -> str:
+    if size >= 1024 * 1024 and size % (1024 * 1024) == 0:
+        return "%dM" % (size // 1024 // 1024)
+    return "%dK" % (size // 1024)
+
+
+def count_boot_requests(
+    chunk_starts: typing.List[int],
+    non_zero: typing.List[bool],
+    boot_ranges: typing.List[typing.Tuple[int, int]],
+) -> int:
+    boot_chunks = set()
+    for start, end in boot_ranges:
+        first = max(bisect.bisect_right(chunk_starts, start) - 1, 0)
+        last = bisect.bisect_left(chunk_starts, end)
+        boot_chunks.update(i for i in range(first, last) if non_zero[i])
+    return len(boot_chunks)
+
+
+def analyze(
+    strategy: Strategy, image_list: typing.List[Image]
+) -> typing.Tuple[typing.List[ImageStats], int]:
+    chunk_sizes: typing.Dict[str, int] = {}
+    all_stats = []
+    for image in image_list:
+        sys.stderr.write("Analyzing %s (%s)\n" % (image.name, strategy.name))
+        total_size = 0
+        fetched_bytes = 0
+        new_bytes = 0
+        chunk_starts = []
+        non_zero = []
+        signature_sizes = {}
+        with image.open() as image_file:
+            for chunk in strategy.iter_chunks(image_file):
+                chunk_starts.append(total_size)
+                total_size += len(chunk)
+                # Compare against a zero chunk of the same length, regardless of
+                # the strategy's chunk size.
+                is_zero = chunks.is_zero_chunk(chunk, content_defined=True)
+                non_zero.append(not is_zero)
+                if is_zero:
+                    continue
+                fetched_bytes += len(chunk)
+                signature = chunks.chunk_signature(chunk)
+                signature_sizes[signature] = len(chunk)
+                if signature not in chunk_sizes:
+                    chunk_sizes[signature] = len(chunk)
+                    new_bytes += len(chunk)
+        all_stats.append(
+            ImageStats(
+                image.name,
+                total_size,
+                sum(non_zero),
+                count_boot_requests(chunk_starts, non_zero, image.boot_ranges),
+                fetched_bytes,
+                new_bytes,
+                signature_sizes,
+            )
+        )
+    return all_stats, sum(chunk_sizes.values())
+
+
+def format_mb(size: int) -> str:
+    return "%.1f MB" % (size / 1024 / 1024)
+
+
+def print_sharing_matrix(strategy: Strategy, all_stats: typing.List[ImageStats]):
+    # Row i, column j is the percentage of image i's (non-zero) bytes that are
+    # in chunks that image j also has.
+    print()
+    print(
+        "Sharing matrix (%s), %% of row image bytes shared with column image:"
+        % strategy.name
+    )
+    print("%-4s %-36s" % ("", "") + "".join("%5d" % j for j in range(len(all_stats))))
+    for i, row in enumerate(all_stats):
+        cells = []
+        row_size = sum(row.signature_sizes.values())
+        for j, column in enumerate(all_stats):
+            if i == j or not row_size:
+                cells.append("%5s" % "-")
+                continue
+            shared_size = sum(
+                size
+                for signature, size in row.signature_sizes.items()
+                if signature in column.signature_sizes
+            )
+            cells.append("%5d" % round(shared_size / row_size * 100))
+        print("%-4d %-36s" % (i, row.name[:36]) + "".join(cells))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compare chunk sizes and content-defined chunking of system disk "
+            "images (and the Infinite HD variants), in terms of unique chunk "
+            "storage, sharing between images and request counts."
+        )
+    )
+    parser.add_argument(
+        "--disk-filter",
+        "-f",
+        action="append",
+        dest="disk_filters",
+        help="substrings of disk names to analyze (defaults to all disks)",
+    )
+    parser.add_argument(
+        "--chunk-sizes",
+        default=DEFAULT_CHUNK_SIZES,
+        help="comma-separated fixed chunk sizes to compare (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-cdc",
+        action="store_true",
+        help="only compare fixed chunk sizes",
+    )
+    parser.add_argument(
+        "--cdc-min", type=int, default=chunks.CDC_MIN_SIZE, help="minimum CDC size"
+    )
+    parser.add_argument(
+        "--cdc-avg", type=int, default=chunks.CDC_AVG_SIZE, help="average CDC size"
+    )
+    parser.add_argument(
+        "--cdc-max", type=int, default=chunks.CDC_MAX_SIZE, help="maximum CDC size"
+    )
+    parser.add_argument(
+        "--per-image",
+        action="store_true",
+        help="also report per-image request counts and new bytes",
+    )
+    parser.add_argument(
+        "--matrix",
+        action="store_true",
+        help="also print the cross-image sharing matrix for each strategy",
+    )
+    args = parser.parse_args()
+
+    def matches_filter(name: str) -> bool:
+        return not args.disk_filters or any(f in name for f in args.disk_filters)
+
+    all_prefetch_chunks = prefetch.read_prefetch_chunks()
+
+    def boot_ranges(name: str) -> typing.List[typing.Tuple[int, int]]:
+        # prefetchChunks are indexes of the current (fixed size) chunks.
+        return [
+            (i * chunks.CHUNK_SIZE, (i + 1) * chunks.CHUNK_SIZE)
+            for i in all_prefetch_chunks.get(os.path.splitext(name)[0], [])
+        ]
+
+    image_list = []
+    for disk in disks.ALL_DISKS:
+        if not matches_filter(disk.name):
+            continue
+        if os.path.exists(disk.path()):
+            image_list.append(Image(disk.name, disk.open, boot_ranges(disk.name)))
+        else:
+            sys.stderr.write("Skipping %s, image not available\n" % disk.name)
+    for name in INFINITE_HD_NAMES:
+        if not matches_filter(name):
+            continue
+        if os.path.exists(os.path.join(paths.DATA_DIR, f"{name}.json")):
+            image_list.append(
+                Image(
+                    name,
+                    lambda name=name: chunks.open_chunked_image(name),
+                    boot_ranges(name),
+                )
+            )
+        else:
+            sys.stderr.write("Skipping %s, not built by import-disks\n" % name)
+    if not image_list:
+        sys.stderr.write("No disks found.\n")
+        return 1
+
+    strategies = [
+        Strategy("fixed %s" % format_size(size), content_defined=False, chunk_size=size)
+        for size in (parse_size(s) for s in args.chunk_sizes.split(","))
+    ]
+    if not args.no_cdc:
+        strategies.append(
+            Strategy(
+                "cdc %dK/%dK/%dK"
+                % (args.cdc_min // 1024, args.cdc_avg // 1024, args.cdc_max // 1024),
+                content_defined=True,
+                min_size=args.cdc_min,
+                avg_size=args.cdc_avg,
+                max_size=args.cdc_max,
+            )
+        )
+    results = [(s, *analyze(s, image_list)) for s in strategies]
+
+    print(
+        "%-24s %12s %14s %10s %12s %14s"
+        % (
+            "Strategy",
+            "Total",
+            "Unique stored",
+            "Requests",
+            "Avg request",
+            "Boot requests",
+        )
+    )
+    for strategy, all_stats, unique_size in results:
+        total_size = sum(s.total_size for s in all_stats)
+        request_count = sum(s.request_count for s in all_stats)
+        fetched_size = sum(s.fetched_bytes for s in all_stats)
+        print(
+            "%-24s %12s %14s %10d %12s %14d"
+            % (
+                strategy.name,
+                format_mb(total_size),
+                format_mb(unique_size),
+                request_count,
+                format_mb(fetched_size / request_count if request_count else 0),
+                sum(s.boot_request_count for s in all_stats),
+            )
+        )
+
+    if args.per_image:
+        print()
+        print("%-40s" % "Image" + "".join(" %24s" % s.name for s, _, _ in results))
+        for i, image in enumerate(image_list):
+            row = "%-40s" % image.name[:40]
+            for _, all_stats, _ in results:
+                stats = all_stats[i]
+                row += " %24s" % (
+                    "%d req, %s new" % (stats.request_count, format_mb(stats.new_bytes))
+                )
+            print(row)
+
+    if args.matrix:
+        for strategy, all_stats, _ in results:
+            print_sharing_matrix(strategy, all_stats)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
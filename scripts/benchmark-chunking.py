@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+import argparse
+import chunks
+import contextlib
+import filecmp
+import glob
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import paths
+import random
+import resource
+import sys
+import tempfile
+import time
+import typing
+
+
+# The original implementation of write_chunked_image, which reads the whole
+# image into memory and slices it. Kept here so that the streaming version can
+# be compared against it (both for speed and for byte-identical output).
+def legacy_write_chunked_image(
+    image_path: str, name: str, chunk_dir: str, manifest_dir: str
+) -> None:
+    total_size = 0
+    chunk_list = []
+    chunk_signatures = set()
+    with open(image_path, "rb") as image_file:
+        image_bytes = image_file.read()
+    disk_size = len(image_bytes)
+    for i in range(0, disk_size, chunks.CHUNK_SIZE):
+        chunk = image_bytes[i : i + chunks.CHUNK_SIZE]
+        total_size += len(chunk)
+        if chunk == chunks.ZERO_CHUNK:
+            chunk_list.append("")
+            continue
+        chunk_signature = hashlib.blake2b(
+            chunk, digest_size=16, salt=chunks.SIGNATURE_SALT
+        ).hexdigest()
+        chunk_list.append(chunk_signature)
+        if chunk_signature in chunk_signatures:
+            continue
+        chunk_signatures.add(chunk_signature)
+        chunk_path = os.path.join(chunk_dir, f"{chunk_signature}.chunk")
+        if os.path.exists(chunk_path):
+            continue
+        with open(chunk_path, "wb+") as chunk_file:
+            chunk_file.write(chunk)
+
+    manifest_path = os.path.join(manifest_dir, f"{name}.json")
+    with open(manifest_path, "w+") as manifest_file:
+        json.dump(
+            {
+                "name": os.path.splitext(name)[0],
+                "totalSize": total_size,
+                "chunks": chunk_list,
+                "chunkSize": chunks.CHUNK_SIZE,
+            },
+            manifest_file,
+            indent=4,
+        )
+
+
+def streaming_write_chunked_image(
+    image_path: str, name: str, chunk_dir: str, manifest_dir: str
+) -> None:
+    chunks.write_chunked_image(image_path, name, chunk_dir, manifest_dir)
+
+
+IMPLEMENTATIONS = {
+    "legacy": legacy_write_chunked_image,
+    "streaming": streaming_write_chunked_image,
+}
+
+
+def peak_rss_bytes() -> int:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, but in kilobytes on Linux.
+    if sys.platform == "darwin":
+        return max_rss
+    return max_rss * 1024
+
+
+def run_implementation(
+    implementation: str,
+    image_path: str,
+    output_dir: str,
+    result_queue: multiprocessing.Queue,
+) -> None:
+    # Runs in a fresh process, so that the peak RSS is only that of the
+    # implementation under test.
+    start_rss = peak_rss_bytes()
+    start_time = time.monotonic()
+    # Only the chunker's logging is silenced, errors still show up.
+    with contextlib.redirect_stderr(io.StringIO()):
+        IMPLEMENTATIONS[implementation](
+            image_path, os.path.basename(image_path), output_dir, output_dir
+        )
+    result_queue.put(
+        (time.monotonic() - start_time, peak_rss_bytes() - start_rss)
+    )
+
+
+def benchmark(
+    implementation: str, image_path: str, output_dir: str
+) -> typing.Tuple[float, int]:
+    context = multiprocessing.get_context("spawn")
+    result_queue = context.Queue()
+    process = context.Process(
+        target=run_implementation,
+        args=(implementation, image_path, output_dir, result_queue),
+    )
+    process.start()
+    # The result is small enough to not block the process from exiting.
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(
+            "%s chunking of %s failed (exit code %s)"
+            % (implementation, image_path, process.exitcode)
+        )
+    return result_queue.get()
+
+
+def outputs_match(legacy_dir: str, streaming_dir: str) -> bool:
+    legacy_files = sorted(os.listdir(legacy_dir))
+    if legacy_files != sorted(os.listdir(streaming_dir)):
+        return False
+    _, mismatch, errors = filecmp.cmpfiles(
+        legacy_dir, streaming_dir, legacy_files, shallow=False
+    )
+    return not mismatch and not errors
+
+
+def make_patches(image_size: int, seed: int) -> chunks.Patches:
+    # Stand-ins for the customizations of system images (Stickies contents,
+    # placeholder files), a few KB spread over the image.
+    rng = random.Random(seed)
+    patch_count = 8
+    return [
+        (i * image_size // patch_count, rng.randbytes(4096))
+        for i in range(patch_count)
+        if i * image_size // patch_count + 4096 <= image_size
+    ]
+
+
+def benchmark_patched(
+    image_path: str, temp_dir: str
+) -> typing.Tuple[float, float, int, bool]:
+    # Chunks the image with one set of patches (so that the hash registry
+    # knows it), and then times chunking it with different patches (as after
+    # a CHANGELOG edit) in full and by re-hashing only the patched chunks.
+    # Returns both times, the number of re-hashed chunks and whether both
+    # produced the same manifest.
+    name = os.path.basename(image_path)
+    chunk_dir = os.path.join(temp_dir, "chunks")
+    full_dir = os.path.join(temp_dir, "full")
+    delta_dir = os.path.join(temp_dir, "delta")
+    for d in [chunk_dir, full_dir, delta_dir]:
+        os.mkdir(d)
+    image_size = os.path.getsize(image_path)
+    chunks.write_chunked_image(
+        image_path,
+        name,
+        chunk_dir,
+        delta_dir,
+        show_progress=False,
+        stored_chunks=set(),
+        use_registry=True,
+        patches=make_patches(image_size, 1),
+    )
+    new_patches = make_patches(image_size, 2)
+
+    start_time = time.monotonic()
+    chunks.write_chunked_image(
+        image_path, name, chunk_dir, full_dir, show_progress=False, patches=new_patches
+    )
+    full_time = time.monotonic() - start_time
+
+    start_time = time.monotonic()
+    stats = chunks.write_chunked_image(
+        image_path,
+        name,
+        chunk_dir,
+        delta_dir,
+        show_progress=False,
+        stored_chunks=chunks.list_stored_chunks(chunk_dir),
+        use_registry=True,
+        patches=new_patches,
+    )
+    delta_time = time.monotonic() - start_time
+
+    match = filecmp.cmp(
+        os.path.join(full_dir, f"{name}.json"),
+        os.path.join(delta_dir, f"{name}.json"),
+        shallow=False,
+    )
+    rehashed_count = len(chunks.patched_chunk_indexes(new_patches, stats.chunk_count))
+    return full_time, delta_time, rehashed_count, match
+
+
+def main_patched(image_paths: typing.List[str]) -> int:
+    all_match = True
+    print(
+        "%-40s %10s %10s %10s %10s %s"
+        % ("Image", "Size (MB)", "Full (s)", "Delta (s)", "Rehashed", "Output")
+    )
+    with tempfile.TemporaryDirectory() as registry_dir:
+        paths.HASH_REGISTRY_PATH = os.path.join(registry_dir, "hashes.sqlite")
+        for image_path in image_paths:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                # Only the chunker's logging is silenced, errors still show up.
+                with contextlib.redirect_stderr(io.StringIO()):
+                    full_time, delta_time, rehashed_count, match = benchmark_patched(
+                        image_path, temp_dir
+                    )
+            all_match = all_match and match
+            print(
+                "%-40s %10.1f %10.2f %10.2f %10d %s"
+                % (
+                    os.path.basename(image_path)[:40],
+                    os.path.getsize(image_path) / 1024 / 1024,
+                    full_time,
+                    delta_time,
+                    rehashed_count,
+                    "identical" if match else "DIFFERENT",
+                )
+            )
+    return 0 if all_match else 1
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compare wall-clock time and peak memory use of the legacy "
+            "(whole image in memory) and streaming disk image chunkers."
+        )
+    )
+    parser.add_argument(
+        "images",
+        nargs="*",
+        help="disk images to chunk (defaults to the uncompressed Images/*.dsk)",
+    )
+    parser.add_argument(
+        "--patched",
+        action="store_true",
+        help=(
+            "instead, compare chunking customized images in full with "
+            "re-hashing only their patched chunks, after their patches change "
+            "(fixed-size chunks only, content-defined chunking and "
+            "--zero-free-space always chunk in full)"
+        ),
+    )
+    args = parser.parse_args()
+
+    image_paths = args.images or sorted(
+        glob.glob(os.path.join(paths.IMAGES_DIR, "*.dsk"))
+    )
+    if not image_paths:
+        sys.stderr.write("No disk images found.\n")
+        return 1
+    if args.patched:
+        return main_patched(image_paths)
+
+    all_match = True
+    print(
+        "%-40s %10s %10s %10s %10s %10s %s"
+        % ("Image", "Size (MB)", "Old (s)", "New (s)", "Old (MB)", "New (MB)", "Output")
+    )
+    for image_path in image_paths:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = {}
+            for implementation in IMPLEMENTATIONS:
+                output_dir = os.path.join(temp_dir, implementation)
+                os.mkdir(output_dir)
+                results[implementation] = benchmark(
+                    implementation, image_path, output_dir
+                )
+            match = outputs_match(
+                os.path.join(temp_dir, "legacy"), os.path.join(temp_dir, "streaming")
+            )
+        all_match = all_match and match
+        (legacy_time, legacy_rss) = results["legacy"]
+        (streaming_time, streaming_rss) = results["streaming"]
+        print(
+            "%-40s %10.1f %10.2f %10.2f %10.1f %10.1f %s"
+            % (
+                os.path.basename(image_path)[:40],
+                os.path.getsize(image_path) / 1024 / 1024,
+                legacy_time,
+                streaming_time,
+                legacy_rss / 1024 / 1024,
+                streaming_rss / 1024 / 1024,
+                "identical" if match else "DIFFERENT",
+            )
+        )
+
+    return 0 if all_match else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
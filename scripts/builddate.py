@@ -0,0 +1,41 @@
+# The time that built disk images are stamped with (Stickies dates, and the
+# upper bound for imported file dates). By default it's the current time, but
+# if SOURCE_DATE_EPOCH is set (see https://reproducible-builds.org/specs/
+# source-date-epoch/), it's used instead, so that rebuilding from the same
+# inputs produces identical images (and thus identical chunks).
+
+import datetime
+import os
+import paths
+import subprocess
+import time
+import typing
+
+
+def source_date_epoch() -> typing.Optional[int]:
+    value = os.getenv("SOURCE_DATE_EPOCH")
+    return int(value) if value else None
+
+
+def timestamp() -> int:
+    epoch = source_date_epoch()
+    return epoch if epoch is not None else int(time.time())
+
+
+def now() -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(timestamp())
+
+
+def enable_reproducible() -> int:
+    # Uses the time of the last commit, unless SOURCE_DATE_EPOCH was already
+    # set. It's set in the environment, so that worker processes and other
+    # scripts that are run from the build also pick it up.
+    epoch = source_date_epoch()
+    if epoch is None:
+        epoch = int(
+            subprocess.check_output(
+                ["git", "log", "-1", "--format=%ct"], cwd=paths.ROOT_DIR
+            ).strip()
+        )
+        os.environ["SOURCE_DATE_EPOCH"] = str(epoch)
+    return epoch
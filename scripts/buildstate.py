@@ -0,0 +1,67 @@
+# Tracks the input fingerprint of every image that import-disks.py has built,
+# so that incremental runs can skip images whose inputs have not changed (and
+# keep their existing manifest and chunks).
+
+import chunks
+import hashlib
+import json
+import os
+import paths
+import registry
+import typing
+
+
+def hash_file(path: str) -> str:
+    return registry.hash_file(path)
+
+
+def hash_files(file_paths: typing.Iterable[str], root_dir: str) -> str:
+    digest = hashlib.sha256()
+    for path in sorted(file_paths):
+        digest.update(os.path.relpath(path, root_dir).encode())
+        digest.update(b"\0")
+        digest.update(hash_file(path).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def hash_values(*values: typing.Any) -> str:
+    return hashlib.sha256(
+        json.dumps(values, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class BuildState:
+    def __init__(self, fingerprints: typing.Dict[str, str]):
+        self.fingerprints = fingerprints
+        self.stored_chunks = chunks.list_stored_chunks()
+
+    @staticmethod
+    def load(path: str = paths.BUILD_STATE_PATH) -> "BuildState":
+        try:
+            with open(path, "r") as f:
+                return BuildState(json.load(f)["fingerprints"])
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return BuildState({})
+
+    def is_up_to_date(self, name: str, fingerprint: str) -> bool:
+        if self.fingerprints.get(name) != fingerprint:
+            return False
+        # The manifest and all of its chunks also need to still be around
+        # (they may have been removed by a full build or by hand).
+        manifest_path = os.path.join(paths.DATA_DIR, f"{name}.json")
+        try:
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        return all(c in self.stored_chunks for c in manifest["chunks"] if c)
+
+    def update(self, fingerprints: typing.Dict[str, str]) -> None:
+        self.fingerprints.update(fingerprints)
+
+    def save(self, path: str = paths.BUILD_STATE_PATH) -> None:
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"fingerprints": self.fingerprints}, f, indent=4, sort_keys=True)
+        os.replace(temp_path, path)
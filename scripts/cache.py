@@ -0,0 +1,310 @@
+# Bookkeeping for the download cache (paths.CACHE_DIR), which holds downloaded
+# archives and disk images (stored by content in paths.BLOBS_DIR, with hard
+# links per URL), concatenated multi-part images, header-only entries and
+# decompressed images. Accesses are recorded (when, and whether
+# they were hits or misses), so that the cache can be kept under a size limit
+# by evicting the least recently used entries that are not inputs of the
+# current build, and so that its effectiveness can be reported.
+
+import os
+import paths
+import shutil
+import sqlite3
+import threading
+import time
+import typing
+
+ACCESS_DB_NAME = "access.sqlite"
+# Set to a size in GB to evict least recently used entries after builds.
+MAX_SIZE_ENV = "INFINITE_MAC_CACHE_MAX_SIZE"
+# Files next to a cached download that record its validators (see urls.py),
+# they're part of its entry.
+VALIDATORS_SUFFIX = ".validators"
+# Incomplete downloads are only evicted once they are old enough that they
+# can't belong to a download that is still running.
+INCOMPLETE_MAX_AGE = 60 * 60
+
+_connection: typing.Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+
+
+class Entry(typing.NamedTuple):
+    # Relative to the cache directory (e.g. "<sha256>" or "decompressed/...").
+    name: str
+    path: str
+    size: int
+    # Seconds since the epoch, from the recorded accesses or, for entries that
+    # were cached before they were recorded, the modification time.
+    last_access: float
+    hits: int
+    misses: int
+    # For blobs, the names of the entries that are links to it (they're
+    # evicted together, since the space is only reclaimed once all are gone).
+    aliases: typing.Tuple[str, ...] = ()
+
+    @property
+    def kind(self) -> str:
+        return entry_kind(self.name)
+
+
+class EvictionResult(typing.NamedTuple):
+    evicted: typing.List[Entry]
+    evicted_size: int
+    remaining_size: int
+
+
+def _get_connection() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        os.makedirs(paths.CACHE_DIR, exist_ok=True)
+        # Accesses are recorded from multiple threads and processes (like the
+        # hash registry), which wait for each other's writes.
+        _connection = sqlite3.connect(
+            os.path.join(paths.CACHE_DIR, ACCESS_DB_NAME),
+            check_same_thread=False,
+            timeout=60,
+        )
+        _connection.execute(
+            "CREATE TABLE IF NOT EXISTS accesses ("
+            "  name TEXT PRIMARY KEY,"
+            "  last_access REAL NOT NULL,"
+            "  hits INTEGER NOT NULL,"
+            "  misses INTEGER NOT NULL"
+            ")"
+        )
+    return _connection
+
+
+def is_database(name: str) -> bool:
+    # The hash registry and the access database (and their journals) are not
+    # entries, and are never evicted.
+    for db_name in [os.path.basename(paths.HASH_REGISTRY_PATH), ACCESS_DB_NAME]:
+        if name == db_name or name.startswith(db_name + "-"):
+            return True
+    return False
+
+
+def entry_name(path: str) -> typing.Optional[str]:
+    # Name of the entry that path belongs to, or None if it's not in the cache.
+    relative_path = os.path.relpath(path, paths.CACHE_DIR)
+    parts = relative_path.split(os.sep)
+    if parts[0] in [os.curdir, os.pardir] or is_database(parts[0]):
+        return None
+    if parts[0] in [
+        os.path.basename(paths.DECOMPRESSED_DIR),
+        os.path.basename(paths.BLOBS_DIR),
+    ]:
+        if len(parts) < 2:
+            return None
+        return "/".join(parts[:2])
+    return parts[0]
+
+
+def entry_kind(name: str) -> str:
+    if name.startswith(os.path.basename(paths.DECOMPRESSED_DIR) + "/"):
+        return "decompressed"
+    base_name = name.split("/")[-1]
+    # Interrupted downloads, and temporary files of interrupted writes.
+    if (
+        base_name.endswith(".partial")
+        or base_name.endswith(".tmp")
+        or base_name.startswith("tmp")
+    ):
+        return "incomplete"
+    if base_name.endswith("-headers"):
+        return "headers"
+    return "download"
+
+
+def record_access(path: str, hit: bool) -> None:
+    name = entry_name(path)
+    if name is None:
+        return
+    with _lock:
+        connection = _get_connection()
+        connection.execute(
+            "INSERT INTO accesses (name, last_access, hits, misses) "
+            "VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET "
+            "  last_access = excluded.last_access,"
+            "  hits = hits + excluded.hits,"
+            "  misses = misses + excluded.misses",
+            (name, time.time(), 1 if hit else 0, 0 if hit else 1),
+        )
+        connection.commit()
+
+
+def recorded_accesses() -> typing.Dict[str, typing.Tuple[float, int, int]]:
+    # Entry name to (last access, hits, misses), including entries that have
+    # since been evicted (their hit rates are still of interest).
+    with _lock:
+        rows = (
+            _get_connection()
+            .execute("SELECT name, last_access, hits, misses FROM accesses")
+            .fetchall()
+        )
+    return {
+        name: (last_access, hits, misses) for name, last_access, hits, misses in rows
+    }
+
+
+def path_size(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(dir_path, file_name))
+        for dir_path, _, file_names in os.walk(path)
+        for file_name in file_names
+    )
+
+
+def list_entries() -> typing.List[Entry]:
+    if not os.path.isdir(paths.CACHE_DIR):
+        return []
+    accesses = recorded_accesses()
+    entry_paths: typing.Dict[str, str] = {}
+    sidecar_sizes: typing.Dict[str, int] = {}
+    blob_names: typing.Dict[typing.Tuple[int, int], str] = {}
+    for name in os.listdir(paths.CACHE_DIR):
+        path = os.path.join(paths.CACHE_DIR, name)
+        if is_database(name):
+            continue
+        if path in [paths.DECOMPRESSED_DIR, paths.BLOBS_DIR] and os.path.isdir(path):
+            for member_name in os.listdir(path):
+                member_path = os.path.join(path, member_name)
+                entry_paths[name + "/" + member_name] = member_path
+                if path == paths.BLOBS_DIR:
+                    stat = os.stat(member_path)
+                    blob_names[(stat.st_dev, stat.st_ino)] = name + "/" + member_name
+        elif name.endswith(VALIDATORS_SUFFIX):
+            base_name = name[: -len(VALIDATORS_SUFFIX)]
+            sidecar_sizes[base_name] = os.path.getsize(path)
+        else:
+            entry_paths[name] = path
+
+    # Links to blobs are part of the blob's entry.
+    blob_aliases: typing.Dict[str, typing.List[str]] = {}
+    for name, path in list(entry_paths.items()):
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            blob_name = blob_names.get((stat.st_dev, stat.st_ino))
+            if blob_name and blob_name != name:
+                blob_aliases.setdefault(blob_name, []).append(name)
+                del entry_paths[name]
+
+    entries = []
+    for name, path in entry_paths.items():
+        aliases = blob_aliases.get(name, [])
+        size = path_size(path)
+        last_access, hits, misses = 0.0, 0, 0
+        for n in [name] + aliases:
+            n_last_access, n_hits, n_misses = accesses.get(n, (0, 0, 0))
+            last_access = max(last_access, n_last_access)
+            hits += n_hits
+            misses += n_misses
+            size += sidecar_sizes.pop(n, 0)
+        if entry_kind(name) == "incomplete" or not last_access:
+            last_access = os.path.getmtime(path)
+        entries.append(
+            Entry(name, path, size, last_access, hits, misses, tuple(aliases))
+        )
+    # Validators whose download is gone.
+    for name, size in sidecar_sizes.items():
+        path = os.path.join(paths.CACHE_DIR, name + VALIDATORS_SUFFIX)
+        entries.append(Entry(name, path, size, os.path.getmtime(path), 0, 0))
+    return entries
+
+
+def is_pinned(entry: Entry, names: typing.Set[str]) -> bool:
+    # Interrupted downloads of pinned entries are kept too, so that they can be
+    # resumed.
+    return (
+        entry.name in names
+        or entry.name.removesuffix(".partial") in names
+        or any(a in names for a in entry.aliases)
+    )
+
+
+def pinned_names(pinned_paths: typing.Iterable[str]) -> typing.Set[str]:
+    return {name for name in map(entry_name, pinned_paths) if name is not None}
+
+
+def remove_entry(entry: Entry) -> None:
+    if os.path.isdir(entry.path):
+        shutil.rmtree(entry.path, ignore_errors=True)
+    for name in [entry.name, *entry.aliases]:
+        for path in [
+            os.path.join(paths.CACHE_DIR, name),
+            os.path.join(paths.CACHE_DIR, name) + VALIDATORS_SUFFIX,
+        ]:
+            try:
+                os.remove(path)
+            except (FileNotFoundError, IsADirectoryError):
+                pass
+
+
+def eviction_candidates(
+    entries: typing.List[Entry], pinned_paths: typing.Iterable[str]
+) -> typing.List[Entry]:
+    # Entries that may be evicted, least recently used first.
+    names = pinned_names(pinned_paths)
+    now = time.time()
+    return sorted(
+        (
+            e
+            for e in entries
+            if not is_pinned(e, names)
+            and not (
+                e.kind == "incomplete" and now - e.last_access < INCOMPLETE_MAX_AGE
+            )
+        ),
+        key=lambda e: e.last_access,
+    )
+
+
+def evict(
+    max_size: int,
+    pinned_paths: typing.Iterable[str],
+    dry_run: bool = False,
+) -> EvictionResult:
+    # Evicts least recently used entries until the cache is at most max_size
+    # bytes (or only pinned and in-progress entries are left).
+    entries = list_entries()
+    size = sum(e.size for e in entries)
+    if size <= max_size:
+        return EvictionResult([], 0, size)
+    evicted = []
+    evicted_size = 0
+    for entry in eviction_candidates(entries, pinned_paths):
+        if size - evicted_size <= max_size:
+            break
+        if not dry_run:
+            remove_entry(entry)
+        evicted.append(entry)
+        evicted_size += entry.size
+    return EvictionResult(evicted, evicted_size, size - evicted_size)
+
+
+def max_size() -> typing.Optional[int]:
+    value = os.getenv(MAX_SIZE_ENV)
+    return int(float(value) * 1024 * 1024 * 1024) if value else None
+
+
+def enforce_max_size(
+    pinned_paths: typing.Iterable[str], log: typing.Callable[[str], typing.Any]
+) -> None:
+    # Evicts entries if MAX_SIZE_ENV is set and the cache is over it
+    # (pinned_paths is only iterated if that's the case).
+    limit = max_size()
+    if limit is None:
+        return
+    result = evict(limit, pinned_paths)
+    if result.evicted:
+        log(
+            "Evicted %d cache entries (%.1f MB), %.1f MB remain\n"
+            % (
+                len(result.evicted),
+                result.evicted_size / 1024 / 1024,
+                result.remaining_size / 1024 / 1024,
+            )
+        )
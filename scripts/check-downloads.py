@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import paths
+import sys
+import tempfile
+import threading
+import typing
+import urls
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    # Serves a single resource, optionally dropping connections partway
+    # through or ignoring Range headers, to stand in for the sites that images
+    # are downloaded from.
+    def __init__(self, body: bytes):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.body = body
+        self.support_ranges = True
+        # Responses are cut off after this many bytes (once).
+        self.drop_after: typing.Optional[int] = None
+        self.requests: typing.List[typing.Optional[str]] = []
+        # Client addresses, one per connection.
+        self.connections: typing.Set[typing.Tuple[str, int]] = set()
+        self.not_modified_count = 0
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%d/image.dsk" % self.server_address[1]
+
+    @property
+    def redirect_url(self) -> str:
+        return "http://127.0.0.1:%d/redirect" % self.server_address[1]
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    server: StandInServer
+    # Keep-alive, for connection pools.
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        pass
+
+    @staticmethod
+    def etag_for(body: bytes) -> str:
+        return '"%s"' % hashlib.sha256(body).hexdigest()
+
+    def etag(self) -> str:
+        return self.etag_for(self.server.body)
+
+    def do_HEAD(self) -> None:
+        self.send_response(200)
+        self.send_header("ETag", self.etag())
+        self.send_header("Content-Length", str(len(self.server.body)))
+        self.end_headers()
+
+    def do_GET(self) -> None:
+        self.server.connections.add(self.client_address)
+        if self.headers.get("If-None-Match") == self.etag():
+            self.server.not_modified_count += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/image.dsk")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = self.server.body
+        range_header = self.headers.get("Range")
+        self.server.requests.append(range_header)
+        start = 0
+        # A Range request for a resource that has changed since If-Range was
+        # sent gets all of it.
+        if_range = self.headers.get("If-Range")
+        if (
+            range_header
+            and self.server.support_ranges
+            and if_range in [None, self.etag()]
+        ):
+            start = int(range_header.removeprefix("bytes=").removesuffix("-"))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % len(body))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes %d-%d/%d" % (start, len(body) - 1, len(body))
+            )
+        else:
+            self.send_response(200)
+        self.send_header("ETag", self.etag())
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        data = body[start:]
+        if self.server.drop_after is not None:
+            data = data[: self.server.drop_after]
+            self.server.drop_after = None
+            self.close_connection = True
+        self.wfile.write(data)
+
+
+def check(
+    name: str,
+    server: StandInServer,
+    dest_path: str,
+    expected_requests: typing.List[typing.Optional[str]],
+    expect_failure: bool,
+    failures: typing.List[str],
+    pool: typing.Optional[urls.ConnectionPool] = None,
+    url: typing.Optional[str] = None,
+) -> None:
+    if pool:
+        name += " (pooled)"
+    failure_count = len(failures)
+    server.requests = []
+    try:
+        urls.download_to_path(url or server.url, dest_path, pool)
+        failed = False
+    except Exception:
+        failed = True
+    if failed != expect_failure:
+        failures.append("%s: download %s" % (name, "failed" if failed else "succeeded"))
+    if not failed:
+        with open(dest_path, "rb") as f:
+            if f.read() != server.body:
+                failures.append("%s: downloaded data differs" % name)
+        if os.path.exists(dest_path + urls.PARTIAL_SUFFIX + urls.VALIDATORS_SUFFIX):
+            failures.append("%s: partial download validators were left" % name)
+    elif os.path.exists(dest_path):
+        failures.append("%s: incomplete download was published" % name)
+    if server.requests != expected_requests:
+        failures.append(
+            "%s: made requests %s, expected %s"
+            % (name, server.requests, expected_requests)
+        )
+    print("%s: %s" % ("FAILED" if len(failures) > failure_count else "ok", name))
+
+
+def check_resumption(
+    server: StandInServer,
+    dest_path: str,
+    failures: typing.List[str],
+    pool: typing.Optional[urls.ConnectionPool] = None,
+) -> None:
+    size = len(server.body)
+    half = size // 2
+    check("complete download", server, dest_path, [None], False, failures, pool)
+    os.remove(dest_path)
+
+    server.drop_after = half
+    check("interrupted download", server, dest_path, [None], True, failures, pool)
+    if os.path.getsize(dest_path + urls.PARTIAL_SUFFIX) != half:
+        failures.append("interrupted download: partial file size")
+    check(
+        "resumed download",
+        server,
+        dest_path,
+        ["bytes=%d-" % half],
+        False,
+        failures,
+        pool,
+    )
+    os.remove(dest_path)
+
+    server.drop_after = half
+    check("interrupted download", server, dest_path, [None], True, failures, pool)
+    server.support_ranges = False
+    check(
+        "restarted download (no range support)",
+        server,
+        dest_path,
+        ["bytes=%d-" % half],
+        False,
+        failures,
+        pool,
+    )
+    os.remove(dest_path)
+    server.support_ranges = True
+
+    # Resuming after the resource has changed would splice the start of the
+    # old version onto the end of the new one, it's downloaded again instead.
+    server.drop_after = half
+    check("interrupted download", server, dest_path, [None], True, failures, pool)
+    old_body = server.body
+    server.body = os.urandom(size)
+    check(
+        "restarted download (changed resource)",
+        server,
+        dest_path,
+        ["bytes=%d-" % half],
+        False,
+        failures,
+        pool,
+    )
+    os.remove(dest_path)
+    server.body = old_body
+
+    # Partial downloads without validators can't be checked for changes.
+    with open(dest_path + urls.PARTIAL_SUFFIX, "wb") as f:
+        f.write(server.body[:half])
+    check(
+        "restarted download (no validators)",
+        server,
+        dest_path,
+        [None],
+        False,
+        failures,
+        pool,
+    )
+    os.remove(dest_path)
+
+    with open(dest_path + urls.PARTIAL_SUFFIX, "wb") as f:
+        f.write(server.body)
+    with open(dest_path + urls.PARTIAL_SUFFIX + urls.VALIDATORS_SUFFIX, "w") as f:
+        json.dump({"ETag": StandInHandler.etag_for(server.body)}, f)
+    check(
+        "already complete partial download",
+        server,
+        dest_path,
+        ["bytes=%d-" % size],
+        False,
+        failures,
+        pool,
+    )
+    os.remove(dest_path)
+
+
+def check_content_addressing(server: StandInServer, failures: typing.List[str]) -> None:
+    # Downloads are stored once per content, and not downloaded at all if
+    # their expected digest is already in the cache.
+    sha256 = hashlib.sha256(server.body).hexdigest()
+    blob = urls.blob_path(sha256)
+
+    def read(
+        name: str,
+        query: str,
+        expected_sha256: typing.Optional[str],
+        expected_requests: typing.List[typing.Optional[str]],
+        expect_failure: bool = False,
+    ) -> None:
+        server.requests = []
+        failure_count = len(failures)
+        url = server.url + "?" + query
+        try:
+            path = urls.read_url_to_path(url, sha256=expected_sha256)
+            failed = False
+        except Exception:
+            failed = True
+        if failed != expect_failure:
+            failures.append(
+                "%s: download %s" % (name, "failed" if failed else "succeeded")
+            )
+        if not failed and not os.path.samefile(path, blob):
+            failures.append("%s: not linked to the blob" % name)
+        if failed and os.path.exists(urls.url_cache_path(url)):
+            failures.append("%s: failed download was cached" % name)
+        if server.requests != expected_requests:
+            failures.append(
+                "%s: made requests %s, expected %s"
+                % (name, server.requests, expected_requests)
+            )
+        print("%s: %s" % ("FAILED" if len(failures) > failure_count else "ok", name))
+
+    read("first download", "first", None, [None])
+    read("other URL with a known digest", "known", sha256, [])
+    read("other URL with an unknown digest", "unknown", None, [None])
+    read("mismatched digest", "mismatched", "0" * 64, [None], True)
+    if os.path.exists(
+        urls.url_cache_path(server.url + "?mismatched") + urls.PARTIAL_SUFFIX
+    ):
+        failures.append("mismatched digest: partial download was kept")
+    half = len(server.body) // 2
+    server.drop_after = half
+    read("interrupted download", "resumed", None, [None], True)
+    # The digest covers the part from the first attempt too.
+    read("resumed download", "resumed", None, ["bytes=%d-" % half])
+
+
+def check_revalidation(server: StandInServer, failures: typing.List[str]) -> None:
+    # Cached downloads (in a temporary cache directory) are only downloaded
+    # again if they have changed.
+    def read(name: str, expected_body: bytes, expected_not_modified: int) -> None:
+        server.not_modified_count = 0
+        path = urls.read_url_to_path(server.url + "?" + name.replace(" ", "-"))
+        failure_count = len(failures)
+        with open(path, "rb") as f:
+            if f.read() != expected_body:
+                failures.append("%s: cached data differs" % name)
+        if server.not_modified_count != expected_not_modified:
+            failures.append(
+                "%s: %d not modified responses, expected %d"
+                % (name, server.not_modified_count, expected_not_modified)
+            )
+        print("%s: %s" % ("FAILED" if len(failures) > failure_count else "ok", name))
+
+    original_body = server.body
+    for name in ["unchanged", "changed", "cached without validators"]:
+        urls.read_url_to_path(server.url + "?" + name.replace(" ", "-"))
+    os.remove(
+        urls.url_cache_path(server.url + "?cached-without-validators")
+        + urls.VALIDATORS_SUFFIX
+    )
+    urls.enable_revalidation()
+    read("unchanged", original_body, 1)
+    read("cached without validators", original_body, 0)
+    with open(
+        urls.url_cache_path(server.url + "?cached-without-validators")
+        + urls.VALIDATORS_SUFFIX
+    ) as f:
+        if "ETag" not in json.load(f):
+            failures.append("cached without validators: validators were not adopted")
+    server.body = os.urandom(len(original_body))
+    read("changed", server.body, 0)
+    server.body = original_body
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Check that downloads (with and without a connection pool) are "
+            "streamed to the cache atomically, resumed after interruptions "
+            "and revalidated, against a local stand-in server."
+        )
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=32 * 1024 * 1024,
+        help="size of the served resource (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    server = StandInServer(os.urandom(args.size))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    failures: typing.List[str] = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dest_path = os.path.join(temp_dir, "image.dsk")
+        check_resumption(server, dest_path, failures)
+        pool = urls.ConnectionPool()
+        check_resumption(server, dest_path, failures, pool)
+
+        # Complete responses leave the connection in the pool for the next
+        # request, including after redirects.
+        pool = urls.ConnectionPool()
+        server.connections = set()
+        for url in [server.url, server.redirect_url]:
+            check(
+                "reused connection",
+                server,
+                dest_path,
+                [None],
+                False,
+                failures,
+                pool,
+                url,
+            )
+            os.remove(dest_path)
+        if len(server.connections) != 1:
+            failures.append(
+                "reused connection: %d connections were made" % len(server.connections)
+            )
+        pool.close()
+
+        paths.CACHE_DIR = os.path.join(temp_dir, "cache")
+        paths.BLOBS_DIR = os.path.join(paths.CACHE_DIR, "blobs")
+        paths.HASH_REGISTRY_PATH = os.path.join(paths.CACHE_DIR, "hashes.sqlite")
+        check_content_addressing(server, failures)
+        check_revalidation(server, failures)
+    server.shutdown()
+
+    for failure in failures:
+        print("FAILED: %s" % failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
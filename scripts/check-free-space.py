@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import argparse
+import chunks
+import freespace
+import machfs
+import os
+import placeholders
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import typing
+
+FILE_SIZES = [300 * 1024, 2 * 1024 * 1024 + 17, 5000, 1024 * 1024]
+VOLUME_SIZE = 24 * 1024 * 1024
+
+
+def build_volume(image_path: str, seed: int) -> None:
+    # An HFS volume with a few files, and junk (like that left behind by
+    # deleted files) in its free space, including runs that are larger than
+    # the reads of both chunkers.
+    rng = random.Random(seed)
+    volume = machfs.Volume()
+    volume.name = "Free Space"
+    folder = machfs.Folder()
+    volume["Folder"] = folder
+    for i, size in enumerate(FILE_SIZES):
+        f = machfs.File()
+        f.data = rng.randbytes(size)
+        f.rsrc = rng.randbytes(size // 7)
+        (folder if i % 2 else volume)["File %d" % i] = f
+    with open(image_path, "wb") as image_file:
+        image_file.write(volume.write(VOLUME_SIZE))
+    with open(image_path, "r+b") as image_file:
+        for start, end in freespace.find_free_ranges(image_path):
+            image_file.seek(start)
+            image_file.write(rng.randbytes(end - start))
+
+
+def read_files(data: bytes) -> typing.Dict[typing.Tuple[str, ...], typing.Any]:
+    volume = machfs.Volume()
+    volume.read(data)
+    return {
+        tuple(path): (f.data, f.rsrc)
+        for path, f in volume.iter_paths()
+        if isinstance(f, machfs.File)
+    }
+
+
+def check(
+    image_path: str,
+    temp_dir: str,
+    content_defined: bool,
+    zero_free_space: bool,
+    failures: typing.List[str],
+) -> None:
+    label = "%s chunking%s" % (
+        "content-defined" if content_defined else "fixed",
+        ", zeroed free space" if zero_free_space else "",
+    )
+    name = "%s-%s.dsk" % (
+        "cdc" if content_defined else "fixed",
+        "zeroed" if zero_free_space else "raw",
+    )
+    chunk_dir = os.path.join(temp_dir, "chunks")
+    manifest_dir = os.path.join(temp_dir, "manifests")
+    os.makedirs(chunk_dir, exist_ok=True)
+    os.makedirs(manifest_dir, exist_ok=True)
+
+    with open(image_path, "rb") as image_file:
+        expected = bytearray(image_file.read())
+    free_ranges = freespace.find_free_ranges(image_path)
+    if zero_free_space:
+        for start, end in free_ranges:
+            expected[start:end] = bytes(end - start)
+
+    try:
+        stats = chunks.write_chunked_image(
+            image_path,
+            name,
+            chunk_dir=chunk_dir,
+            manifest_dir=manifest_dir,
+            show_progress=False,
+            content_defined=content_defined,
+            zero_free_space=zero_free_space,
+        )
+    except Exception as e:
+        failures.append("%s: chunking raised %r" % (label, e))
+        return
+    with chunks.open_chunked_image(name, chunk_dir, manifest_dir) as chunked_file:
+        chunked = chunked_file.read()
+
+    if chunked != expected:
+        failures.append("%s: reassembled image differs" % label)
+    elif read_files(chunked) != read_files(bytes(expected)):
+        failures.append("%s: file contents differ" % label)
+    expected_zeroed = sum(end - start for start, end in free_ranges)
+    if zero_free_space and stats.zeroed_size != expected_zeroed:
+        failures.append(
+            "%s: zeroed %d bytes, expected %d"
+            % (label, stats.zeroed_size, expected_zeroed)
+        )
+    sys.stderr.write(
+        "%s: %d chunks (%d zero), %d bytes zeroed\n"
+        % (label, stats.chunk_count, stats.zero_chunk_count, stats.zeroed_size)
+    )
+
+
+def check_catalog(image_path: str, temp_dir: str, failures: typing.List[str]) -> None:
+    # The catalog walk that --verify-free-space relies on finds every fork,
+    # none of them overlap free space, and it notices if the allocation bitmap
+    # (which free space comes from) claims that a file's block is free.
+    with open(image_path, "rb") as image_file:
+        image_data = image_file.read()
+    extents = placeholders.allocated_extents(image_data) or []
+    file_extents = [e for e in extents if e[0].startswith("file ")]
+    forks = {d.removesuffix(" (overflow)") for d, _, _ in file_extents}
+    # Every file has a data and a resource fork (machfs may add more files,
+    # e.g. the desktop database).
+    if len(forks) < 2 * len(FILE_SIZES):
+        failures.append(
+            "catalog: found %d forks, expected %d" % (len(forks), 2 * len(FILE_SIZES))
+        )
+    overlapping = placeholders.allocated_in(
+        image_data, freespace.find_free_ranges(image_path)
+    )
+    if overlapping:
+        failures.append("catalog: %s overlap free space" % ", ".join(overlapping))
+
+    # Clear the bitmap bit of the first block of the first file.
+    corrupted_path = os.path.join(temp_dir, "Corrupted.dsk")
+    shutil.copyfile(image_path, corrupted_path)
+    mdb = image_data[freespace.MDB_OFFSET : freespace.MDB_OFFSET + 512]
+    bitmap_start = struct.unpack_from(">H", mdb, 14)[0] * freespace.SECTOR_SIZE
+    block_size = struct.unpack_from(">I", mdb, 20)[0]
+    blocks_offset = struct.unpack_from(">H", mdb, 28)[0] * freespace.SECTOR_SIZE
+    block = (file_extents[0][1] - blocks_offset) // block_size
+    with open(corrupted_path, "r+b") as corrupted_file:
+        corrupted_file.seek(bitmap_start + block // 8)
+        byte = corrupted_file.read(1)[0]
+        corrupted_file.seek(bitmap_start + block // 8)
+        corrupted_file.write(bytes([byte & ~(0x80 >> (block % 8))]))
+    with open(corrupted_path, "rb") as corrupted_file:
+        overlapping = placeholders.allocated_in(
+            corrupted_file.read(), freespace.find_free_ranges(corrupted_path)
+        )
+    if overlapping != [file_extents[0][0]]:
+        failures.append(
+            "catalog: a corrupted bitmap was reported as overlapping %s" % overlapping
+        )
+    sys.stderr.write(
+        "catalog: %d allocated extents, corrupted bitmap overlaps %s\n"
+        % (len(extents), overlapping)
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Build an HFS volume with junk in its free space and check that "
+            "chunking it (fixed and content-defined, with and without zeroing "
+            "free space) reassembles to the expected image, and that its "
+            "catalog's extents don't overlap free space."
+        )
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed for the file contents and junk (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    failures: typing.List[str] = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        image_path = os.path.join(temp_dir, "Free Space.dsk")
+        build_volume(image_path, args.seed)
+        free_ranges = freespace.find_free_ranges(image_path)
+        sys.stderr.write(
+            "%d free ranges, the largest %d bytes\n"
+            % (len(free_ranges), max(end - start for start, end in free_ranges))
+        )
+        check_catalog(image_path, temp_dir, failures)
+        for content_defined in [False, True]:
+            for zero_free_space in [False, True]:
+                check(image_path, temp_dir, content_defined, zero_free_space, failures)
+
+    for failure in failures:
+        sys.stderr.write("FAILED: %s\n" % failure)
+    if not failures:
+        sys.stderr.write("ok\n")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import argparse
+import codecs
+import io
+import nextstep
+import os
+import paths
+import sys
+import time
+import typing
+
+nextstep.register_nextstep_codec()
+
+
+def reference_encode(input: str) -> bytes:
+    # The original encoder (a character at a time, strict errors only), to
+    # check compatibility against and to compare speed with.
+    result = bytearray()
+    for char in input:
+        u = ord(char)
+        if u < 0x80:
+            result.append(u)
+        elif u in nextstep.NEXTSTEP_ENCODING_MAP:
+            result.append(nextstep.NEXTSTEP_ENCODING_MAP[u])
+        else:
+            raise UnicodeEncodeError(
+                "nextstep", char, 0, 1, "character not in encoding"
+            )
+    return bytes(result)
+
+
+def encodable(text: str) -> str:
+    return "".join(
+        c for c in text if ord(c) < 0x80 or ord(c) in nextstep.NEXTSTEP_ENCODING_MAP
+    )
+
+
+def check_round_trips(failures: typing.List[str]) -> None:
+    defined_bytes = bytes(
+        b for b in range(256) if nextstep.DECODING_TABLE[b] != "\ufffe"
+    )
+    if defined_bytes.decode("nextstep").encode("nextstep") != defined_bytes:
+        failures.append("decoding and re-encoding all defined bytes")
+    for u, b in nextstep.NEXTSTEP_ENCODING_MAP.items():
+        if chr(u).encode("nextstep") != bytes([b]):
+            failures.append("encoding U+%04X" % u)
+    for u in range(0x80):
+        if chr(u).encode("nextstep").decode("nextstep") != chr(u):
+            failures.append("round-tripping U+%04X" % u)
+
+
+def check_compatibility(text: str, failures: typing.List[str]) -> None:
+    if text.encode("nextstep") != reference_encode(text):
+        failures.append("encoding matches the original encoder")
+    try:
+        reference_encode("\u4e00")
+        failures.append("original encoder raises on unencodable characters")
+    except UnicodeEncodeError:
+        pass
+
+
+def check_errors(failures: typing.List[str]) -> None:
+    try:
+        "ab\u4e00c".encode("nextstep")
+        failures.append("strict encoding raises")
+    except UnicodeEncodeError as e:
+        if (e.start, e.end) != (2, 3):
+            failures.append("strict encoding error position (%d, %d)" % e.args[2:4])
+    for errors, expected in [
+        ("replace", b"ab?c"),
+        ("ignore", b"abc"),
+        ("backslashreplace", b"ab\\u4e00c"),
+        ("xmlcharrefreplace", b"ab&#19968;c"),
+    ]:
+        if "ab\u4e00c".encode("nextstep", errors) != expected:
+            failures.append("encoding with errors=%s" % errors)
+    try:
+        b"ab\xfec".decode("nextstep")
+        failures.append("strict decoding of an undefined byte raises")
+    except UnicodeDecodeError as e:
+        if (e.start, e.end) != (2, 3):
+            failures.append("strict decoding error position (%d, %d)" % e.args[2:4])
+    if b"ab\xfec".decode("nextstep", "replace") != "ab\ufffdc":
+        failures.append("decoding with errors=replace")
+
+
+def check_incremental(text: str, failures: typing.List[str]) -> None:
+    encoded = text.encode("nextstep")
+    encoder = codecs.getincrementalencoder("nextstep")()
+    pieces = [encoder.encode(text[i : i + 1000]) for i in range(0, len(text), 1000)]
+    if b"".join(pieces) + encoder.encode("", final=True) != encoded:
+        failures.append("incremental encoding")
+    decoder = codecs.getincrementaldecoder("nextstep")()
+    pieces = [
+        decoder.decode(encoded[i : i + 1000]) for i in range(0, len(encoded), 1000)
+    ]
+    if "".join(pieces) + decoder.decode(b"", final=True) != text:
+        failures.append("incremental decoding")
+    stream = io.BytesIO()
+    writer = codecs.getwriter("nextstep")(stream)
+    writer.write(text)
+    if stream.getvalue() != encoded:
+        failures.append("stream writing")
+    stream.seek(0)
+    if codecs.getreader("nextstep")(stream).read() != text:
+        failures.append("stream reading")
+
+
+def benchmark(text: str, repeat: int) -> None:
+    for name, encode in [
+        ("original", reference_encode),
+        ("charmap", lambda t: t.encode("nextstep")),
+    ]:
+        start_time = time.monotonic()
+        for _ in range(repeat):
+            encode(text)
+        elapsed = (time.monotonic() - start_time) / repeat
+        print(
+            "%-10s encode: %8.2f ms (%.1f MB/s)"
+            % (name, elapsed * 1000, len(text) / 1024 / 1024 / elapsed)
+        )
+    encoded = text.encode("nextstep")
+    start_time = time.monotonic()
+    for _ in range(repeat):
+        encoded.decode("nextstep")
+    elapsed = (time.monotonic() - start_time) / repeat
+    print(
+        "%-10s decode: %8.2f ms (%.1f MB/s)"
+        % ("charmap", elapsed * 1000, len(encoded) / 1024 / 1024 / elapsed)
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Check that the NEXTSTEP codec round-trips, handles errors and "
+            "matches the original encoder, and compare their speed on the "
+            "CHANGELOG."
+        )
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=1024 * 1024,
+        help=(
+            "characters to benchmark with (the CHANGELOG is repeated to reach "
+            "it, default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=10,
+        help="benchmark iterations (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    with open(os.path.join(paths.ROOT_DIR, "CHANGELOG.md"), "r") as f:
+        text = encodable(f.read())
+    failures: typing.List[str] = []
+    check_round_trips(failures)
+    check_compatibility(text, failures)
+    check_errors(failures)
+    check_incremental(text, failures)
+    for failure in failures:
+        print("FAILED: %s" % failure)
+    if failures:
+        return 1
+    benchmark_text = text * max(args.size // len(text), 1)
+    print("All checks passed, benchmarking on %d characters" % len(benchmark_text))
+    benchmark(benchmark_text, args.repeat)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import argparse
+import builddate
+import manifests
+import os
+import paths
+import subprocess
+import sys
+import typing
+
+
+def read_manifest_files(manifest_dir: str) -> typing.Dict[str, bytes]:
+    manifest_files = {}
+    for name in sorted(os.listdir(manifest_dir)):
+        if name.endswith(".dsk.json") or name.endswith(".dsk.manifest"):
+            with open(os.path.join(manifest_dir, name), "rb") as f:
+                manifest_files[name] = f.read()
+    return manifest_files
+
+
+def build(import_disks_args: typing.List[str]) -> typing.Dict[str, bytes]:
+    subprocess.run(
+        [
+            sys.executable,
+            os.path.join(paths.ROOT_DIR, "scripts", "import-disks.py"),
+            "--reproducible",
+            *import_disks_args,
+        ],
+        check=True,
+    )
+    return read_manifest_files(paths.DATA_DIR)
+
+
+def first_difference(
+    first: typing.Dict[str, typing.Any], second: typing.Dict[str, typing.Any]
+) -> str:
+    if first["totalSize"] != second["totalSize"]:
+        return "size %d vs %d" % (first["totalSize"], second["totalSize"])
+    first_chunks = first["chunks"]
+    second_chunks = second["chunks"]
+    differing = [
+        i
+        for i in range(min(len(first_chunks), len(second_chunks)))
+        if first_chunks[i] != second_chunks[i]
+    ]
+    if not differing:
+        if len(first_chunks) != len(second_chunks):
+            return "%d vs %d chunks" % (len(first_chunks), len(second_chunks))
+        return "same chunks, other fields differ"
+    i = differing[0]
+    chunk_starts = first.get("chunkStarts")
+    offset = chunk_starts[i] if chunk_starts else i * first["chunkSize"]
+    return "%d chunks differ, the first at offset %d (chunk %d)" % (
+        len(differing),
+        offset,
+        i,
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Run import-disks twice with a fixed SOURCE_DATE_EPOCH (the time "
+            "of the last commit, unless it's already set) and check that both "
+            "builds produce byte-identical manifests. Remaining arguments are "
+            "passed to import-disks."
+        )
+    )
+    _, import_disks_args = parser.parse_known_args()
+    # --incremental would skip everything the second time around.
+    import_disks_args = [a for a in import_disks_args if a != "--incremental"]
+    epoch = builddate.enable_reproducible()
+    sys.stderr.write("Building twice with SOURCE_DATE_EPOCH=%d\n" % epoch)
+
+    first_build = build(import_disks_args)
+    first_manifests = {
+        name: manifests.read_manifest(os.path.join(paths.DATA_DIR, name))
+        for name in first_build
+    }
+    second_build = build(import_disks_args)
+
+    differences = []
+    for name in sorted(first_build.keys() | second_build.keys()):
+        if name not in second_build:
+            differences.append("%s: only in the first build" % name)
+        elif name not in first_build:
+            differences.append("%s: only in the second build" % name)
+        elif first_build[name] != second_build[name]:
+            second_manifest = manifests.read_manifest(
+                os.path.join(paths.DATA_DIR, name)
+            )
+            differences.append(
+                "%s: %s"
+                % (name, first_difference(first_manifests[name], second_manifest))
+            )
+    for difference in differences:
+        print(difference)
+    sys.stderr.write(
+        "%d of %d manifests differ between builds\n"
+        % (len(differences), len(first_build))
+    )
+    return 1 if differences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
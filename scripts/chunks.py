@@ -0,0 +1,733 @@
+import bisect
+import concurrent.futures
+import freespace
+import hashlib
+import io
+import json
+import os
+import paths
+import registry
+import sys
+import tempfile
+import time
+import typing
+import zlib
+
+CHUNK_SIZE = 256 * 1024
+ZERO_CHUNK = b"\0" * CHUNK_SIZE
+SIGNATURE_SALT = b"raw"
+
+# Content-defined chunking parameters. Boundaries are only placed on sector
+# boundaries, since that's the granularity at which data moves around in a disk
+# image when files are added or removed.
+CDC_MIN_SIZE = 64 * 1024
+CDC_AVG_SIZE = 256 * 1024
+CDC_MAX_SIZE = 1024 * 1024
+CDC_SECTOR_SIZE = 512
+_ZERO_VIEW = memoryview(bytes(max(CHUNK_SIZE, CDC_MAX_SIZE)))
+
+# Temporary files are created owner-only, files that are renamed into place
+# get the mode that open() would have given them instead.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+# (offset, data) edits to apply on top of an image file.
+Patches = typing.Sequence[typing.Tuple[int, bytes]]
+
+
+class ImageToChunk(typing.NamedTuple):
+    path: str
+    name: str
+    content_defined: bool = False
+    zero_free_space: bool = False
+    patches: Patches = ()
+
+
+class ChunkedImageStats(typing.NamedTuple):
+    name: str
+    total_size: int
+    chunk_count: int
+    unique_chunk_count: int
+    zero_chunk_count: int
+    elapsed: float
+    # Non-zero bytes in free space that were treated as zero, and the chunks
+    # that became entirely zero as a result.
+    zeroed_size: int = 0
+    zeroed_chunk_count: int = 0
+
+
+class ZeroedRangesReader(io.RawIOBase):
+    # Reads a file as if the given (sorted, non-overlapping) byte ranges were
+    # zero, and keeps track of the ranges in which that actually changed
+    # something.
+    def __init__(self, image_file: typing.BinaryIO, ranges: freespace.Ranges):
+        self._file = image_file
+        self._ranges = ranges
+        self._range_starts = [start for start, _ in ranges]
+        self._position = 0
+        self.zeroed_ranges: freespace.Ranges = []
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: typing.Any) -> int:
+        size = self._file.readinto(buffer)
+        if not size:
+            return size
+        read_start = self._position
+        read_end = read_start + size
+        self._position = read_end
+        view = memoryview(buffer)
+        i = max(bisect.bisect_right(self._range_starts, read_start) - 1, 0)
+        while i < len(self._ranges) and self._ranges[i][0] < read_end:
+            start = max(self._ranges[i][0], read_start)
+            end = min(self._ranges[i][1], read_end)
+            i += 1
+            if start >= end:
+                continue
+            data = view[start - read_start : end - read_start]
+            if is_zero_view(data):
+                continue
+            fill_zero_view(data)
+            if self.zeroed_ranges and self.zeroed_ranges[-1][1] == start:
+                self.zeroed_ranges[-1] = (self.zeroed_ranges[-1][0], end)
+            else:
+                self.zeroed_ranges.append((start, end))
+        return size
+
+
+def zero_view_pieces(
+    data: memoryview,
+) -> typing.Iterator[typing.Tuple[memoryview, memoryview]]:
+    # Reads may be longer than _ZERO_VIEW (e.g. the multi-chunk reads of
+    # content-defined chunking), so they're handled a piece at a time.
+    for offset in range(0, len(data), len(_ZERO_VIEW)):
+        piece = data[offset : offset + len(_ZERO_VIEW)]
+        yield piece, _ZERO_VIEW[: len(piece)]
+
+
+def is_zero_view(data: memoryview) -> bool:
+    return all(piece == zero for piece, zero in zero_view_pieces(data))
+
+
+def fill_zero_view(data: memoryview) -> None:
+    for piece, zero in zero_view_pieces(data):
+        piece[:] = zero
+
+
+class PatchedReader(io.RawIOBase):
+    # Reads a file with the given (sorted, non-overlapping) patches applied,
+    # so that customized images don't need a patched copy of the original.
+    def __init__(self, image_file: typing.BinaryIO, patches: Patches):
+        self._file = image_file
+        self._patches = patches
+        self._patch_ends = [offset + len(data) for offset, data in patches]
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return self._file.seekable()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._position = self._file.seek(offset, whence)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def readinto(self, buffer: typing.Any) -> int:
+        size = self._file.readinto(buffer)
+        if not size:
+            return size
+        read_start = self._position
+        read_end = read_start + size
+        self._position = read_end
+        view = memoryview(buffer)
+        i = bisect.bisect_right(self._patch_ends, read_start)
+        while i < len(self._patches) and self._patches[i][0] < read_end:
+            offset, data = self._patches[i]
+            start = max(offset, read_start)
+            end = min(offset + len(data), read_end)
+            view[start - read_start : end - read_start] = data[
+                start - offset : end - offset
+            ]
+            i += 1
+        return size
+
+    def close(self) -> None:
+        self._file.close()
+        super().close()
+
+
+def open_image(image_path: str, patches: Patches = ()) -> typing.BinaryIO:
+    if not patches:
+        return open(image_path, "rb")
+    return io.BufferedReader(
+        PatchedReader(open(image_path, "rb"), patches), buffer_size=CHUNK_SIZE
+    )
+
+
+def patches_digest(patches: Patches) -> str:
+    digest = hashlib.sha256()
+    for offset, data in patches:
+        digest.update(offset.to_bytes(8, "little"))
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def patched_chunk_indexes(patches: Patches, chunk_count: int) -> typing.List[int]:
+    # Indexes of the (fixed-size) chunks that patches overlap.
+    indexes = set()
+    for offset, data in patches:
+        if data:
+            indexes.update(
+                range(offset // CHUNK_SIZE, (offset + len(data) - 1) // CHUNK_SIZE + 1)
+            )
+    return sorted(i for i in indexes if i < chunk_count)
+
+
+def read_chunk_at(image_file: typing.BinaryIO, index: int) -> bytes:
+    image_file.seek(index * CHUNK_SIZE)
+    return image_file.read(CHUNK_SIZE)
+
+
+def rechunk_patched_image(
+    image_path: str,
+    base_chunks: typing.List[str],
+    patches: Patches,
+    chunk_dir: str,
+    stored_chunks: typing.Set[str],
+) -> typing.Optional[typing.List[str]]:
+    # Chunk signatures of an image with patches applied, given the signatures
+    # of the unpatched image: only the chunks that the patches overlap are
+    # read, hashed and written. Returns None if any other chunk of the base
+    # image is no longer stored (so the image needs to be chunked in full).
+    patched_indexes = patched_chunk_indexes(patches, len(base_chunks))
+    patched_index_set = set(patched_indexes)
+    if not all(
+        c in stored_chunks
+        for i, c in enumerate(base_chunks)
+        if c and i not in patched_index_set
+    ):
+        return None
+    chunks = list(base_chunks)
+    with open_image(image_path, patches) as image_file:
+        for i in patched_indexes:
+            chunk = read_chunk_at(image_file, i)
+            if is_zero_chunk(chunk):
+                chunks[i] = ""
+                continue
+            chunks[i] = chunk_signature(chunk)
+            write_chunk(chunks[i], chunk, chunk_dir, stored_chunks)
+    return chunks
+
+
+def base_chunk_signatures(
+    image_path: str, chunks: typing.List[str], patches: Patches
+) -> typing.List[str]:
+    # The inverse of rechunk_patched_image: signatures of the unpatched image,
+    # given those of the patched one (only the chunks that the patches overlap
+    # need to be hashed again).
+    base_chunks = list(chunks)
+    with open(image_path, "rb") as image_file:
+        for i in patched_chunk_indexes(patches, len(chunks)):
+            chunk = read_chunk_at(image_file, i)
+            base_chunks[i] = "" if is_zero_chunk(chunk) else chunk_signature(chunk)
+    return base_chunks
+
+
+def iter_chunks(
+    image_file: typing.BinaryIO, chunk_size: int = CHUNK_SIZE
+) -> typing.Iterator[bytearray]:
+    # Reads the image into a single reusable buffer, so that peak memory use is
+    # bounded by the chunk size instead of the image size. The yielded buffer
+    # is overwritten by the next iteration, callers must not hold on to it.
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    while True:
+        read_size = 0
+        while read_size < chunk_size:
+            n = image_file.readinto(view[read_size:])
+            if not n:
+                break
+            read_size += n
+        if read_size == chunk_size:
+            yield buffer
+            continue
+        if read_size > 0:
+            # Only the last chunk can be short, it's fine to copy it.
+            yield buffer[:read_size]
+        return
+
+
+def cdc_masks(avg_size: int) -> typing.Tuple[int, int]:
+    # Normalized chunking (as in FastCDC): a harder to match mask before the
+    # average size and an easier one after it, so that chunk sizes cluster
+    # around the average.
+    bits = max((avg_size // CDC_SECTOR_SIZE).bit_length() - 1, 1)
+    return (1 << (bits + 1)) - 1, (1 << (bits - 1)) - 1
+
+
+def find_cdc_boundary(
+    data: typing.Union[bytes, bytearray],
+    min_size: int = CDC_MIN_SIZE,
+    avg_size: int = CDC_AVG_SIZE,
+    max_size: int = CDC_MAX_SIZE,
+) -> int:
+    data_size = len(data)
+    if data_size <= min_size:
+        return data_size
+    end = min(data_size, max_size)
+    small_mask, large_mask = cdc_masks(avg_size)
+    view = memoryview(data)
+    # Fingerprinting whole sectors with CRC-32 (instead of a per-byte rolling
+    # hash) keeps the Python loop to one iteration per sector.
+    for offset in range(min_size, end, CDC_SECTOR_SIZE):
+        sector_hash = zlib.crc32(view[offset - CDC_SECTOR_SIZE : offset])
+        mask = small_mask if offset < avg_size else large_mask
+        if sector_hash & mask == 0:
+            return offset
+    return end
+
+
+def iter_cdc_chunks(
+    image_file: typing.BinaryIO,
+    min_size: int = CDC_MIN_SIZE,
+    avg_size: int = CDC_AVG_SIZE,
+    max_size: int = CDC_MAX_SIZE,
+) -> typing.Iterator[bytearray]:
+    # Like iter_chunks, memory use is bounded by a small multiple of the
+    # maximum chunk size. Chunks are yielded as new bytearrays.
+    buffer = bytearray()
+    eof = False
+    while buffer or not eof:
+        while not eof and len(buffer) < max_size:
+            data = image_file.read(max_size * 4)
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            return
+        boundary = find_cdc_boundary(buffer, min_size, avg_size, max_size)
+        yield buffer[:boundary]
+        # Deleting from the front of a bytearray does not copy the remainder.
+        del buffer[:boundary]
+
+
+def is_zero_chunk(
+    chunk: typing.Union[bytes, bytearray], content_defined: bool = False
+) -> bool:
+    # bytearray/bytes comparison is a memcmp, unlike memoryview comparison,
+    # which goes item by item. A short (trailing) fixed-size chunk is never
+    # treated as zero, since the client expects it to be present.
+    if content_defined:
+        # Chunks of other sizes (e.g. those of analyze-chunks.py) may be larger
+        # than _ZERO_VIEW.
+        if len(chunk) > len(_ZERO_VIEW):
+            return chunk == bytes(len(chunk))
+        return chunk == _ZERO_VIEW[: len(chunk)]
+    return chunk == ZERO_CHUNK
+
+
+def chunk_signature(chunk: typing.Union[bytes, bytearray, memoryview]) -> str:
+    return hashlib.blake2b(
+        chunk, digest_size=16, salt=SIGNATURE_SALT
+    ).hexdigest()
+
+
+def chunk_path(signature: str, chunk_dir: str = paths.DISK_DIR) -> str:
+    return os.path.join(chunk_dir, f"{signature}.chunk")
+
+
+def write_chunk(
+    signature: str,
+    chunk: typing.Union[bytes, bytearray, memoryview],
+    chunk_dir: str = paths.DISK_DIR,
+    stored_chunks: typing.Optional[typing.Set[str]] = None,
+) -> bool:
+    path = chunk_path(signature, chunk_dir)
+    # An earlier run of this script (e.g. for a different base image) may have
+    # already created this file. If we have a listing of the chunk directory,
+    # check against it instead of doing a filesystem lookup per chunk.
+    if stored_chunks is not None:
+        if signature in stored_chunks:
+            return False
+    elif os.path.exists(path):
+        return False
+    # Write to a temporary file and rename it into place, so that concurrent
+    # writers of the same chunk (or an interrupted run) never leave a partial
+    # chunk behind that would be mistaken for a complete one.
+    with tempfile.NamedTemporaryFile(
+        dir=chunk_dir, prefix=f".{signature}.", suffix=".tmp", delete=False
+    ) as chunk_file:
+        chunk_file.write(chunk)
+    replace_temp_file(chunk_file.name, path)
+    if stored_chunks is not None:
+        stored_chunks.add(signature)
+    return True
+
+
+def replace_temp_file(temp_path: str, path: str) -> None:
+    os.chmod(temp_path, FILE_MODE)
+    os.replace(temp_path, path)
+
+
+def list_stored_chunks(chunk_dir: str = paths.DISK_DIR) -> typing.Set[str]:
+    stored_chunks = set()
+    if not os.path.isdir(chunk_dir):
+        return stored_chunks
+    with os.scandir(chunk_dir) as entries:
+        for entry in entries:
+            signature, ext = os.path.splitext(entry.name)
+            if ext == ".chunk":
+                stored_chunks.add(signature)
+    return stored_chunks
+
+
+def write_chunked_image(
+    image_path: str,
+    name: str,
+    chunk_dir: str = paths.DISK_DIR,
+    manifest_dir: str = paths.DATA_DIR,
+    show_progress: bool = True,
+    stored_chunks: typing.Optional[typing.Set[str]] = None,
+    use_registry: bool = False,
+    content_defined: bool = False,
+    zero_free_space: bool = False,
+    patches: Patches = (),
+) -> ChunkedImageStats:
+    start_time = time.monotonic()
+    # Content-defined chunk lists also need their offsets, and chunks with
+    # zeroed free space don't match the file contents, neither are tracked by
+    # the registry. Such images are thus always read and hashed in full, even
+    # if only their patches changed (rechunk_patched_image relies on the
+    # registry's signatures of the unpatched image).
+    use_registry = use_registry and not content_defined and not zero_free_space
+    if use_registry:
+        # Fingerprint before reading, so that a concurrent modification results
+        # in a mismatch on the next run rather than a stale entry.
+        image_fingerprint = registry.fingerprint(image_path)
+        # The same file with different patches has different chunks.
+        variant = patches_digest(patches) if patches else ""
+        chunks = registry.get_chunk_signatures(image_fingerprint, CHUNK_SIZE, variant)
+        # Chunks may have been removed from the store since the image was last
+        # chunked (e.g. by a full rebuild), in which case we need the data.
+        if chunks is not None and stored_chunks is not None:
+            if all(c in stored_chunks for c in chunks if c):
+                return write_registered_chunked_image(
+                    name, image_fingerprint.size, chunks, manifest_dir, start_time
+                )
+        elif chunks is None and variant and stored_chunks is not None:
+            # Only the patches changed since the image was last chunked (e.g. a
+            # new CHANGELOG in the Stickies), so most chunks are those of the
+            # base image.
+            base_chunks = registry.get_chunk_signatures(image_fingerprint, CHUNK_SIZE)
+            if base_chunks is not None:
+                chunks = rechunk_patched_image(
+                    image_path, base_chunks, patches, chunk_dir, stored_chunks
+                )
+                if chunks is not None:
+                    registry.put_chunk_signatures(
+                        image_fingerprint, CHUNK_SIZE, chunks, variant
+                    )
+                    return write_registered_chunked_image(
+                        name,
+                        image_fingerprint.size,
+                        chunks,
+                        manifest_dir,
+                        start_time,
+                        rehashed_count=len(patched_chunk_indexes(patches, len(chunks))),
+                    )
+    total_size = 0
+    chunks = []
+    chunk_starts = [] if content_defined else None
+    chunk_signatures = set()
+    zero_chunk_count = 0
+    zero_chunk_ranges = []
+    zeroed_ranges: freespace.Ranges = []
+    with open_image(image_path, patches) as image_file:
+        disk_size = os.path.getsize(image_path)
+        if zero_free_space:
+            image_file = ZeroedRangesReader(
+                image_file, freespace.find_free_ranges(image_path)
+            )
+            zeroed_ranges = image_file.zeroed_ranges
+        chunk_iterator = (
+            iter_cdc_chunks(image_file) if content_defined else iter_chunks(image_file)
+        )
+        for chunk in chunk_iterator:
+            if show_progress:
+                sys.stderr.write(
+                    "Chunking %s: %.1f%%\r"
+                    % (name, ((total_size + len(chunk)) / disk_size) * 100)
+                )
+            if chunk_starts is not None:
+                chunk_starts.append(total_size)
+            total_size += len(chunk)
+            # Don't bother storing zero-ed out chunks (common for the saved HD),
+            # the signature takes up space, and we don't need to load them
+            if is_zero_chunk(chunk, content_defined):
+                chunks.append("")
+                zero_chunk_count += 1
+                if zero_free_space:
+                    zero_chunk_ranges.append((total_size - len(chunk), total_size))
+                continue
+            signature = chunk_signature(chunk)
+            chunks.append(signature)
+            if signature in chunk_signatures:
+                continue
+            chunk_signatures.add(signature)
+            write_chunk(signature, chunk, chunk_dir, stored_chunks)
+
+    if use_registry:
+        registry.put_chunk_signatures(image_fingerprint, CHUNK_SIZE, chunks, variant)
+        if (
+            variant
+            and registry.get_chunk_signatures(image_fingerprint, CHUNK_SIZE) is None
+        ):
+            registry.put_chunk_signatures(
+                image_fingerprint,
+                CHUNK_SIZE,
+                base_chunk_signatures(image_path, chunks, patches),
+            )
+    write_manifest(name, total_size, chunks, manifest_dir, chunk_starts)
+
+    stats = ChunkedImageStats(
+        name=name,
+        total_size=total_size,
+        chunk_count=len(chunks),
+        unique_chunk_count=len(chunk_signatures),
+        zero_chunk_count=zero_chunk_count,
+        elapsed=time.monotonic() - start_time,
+        zeroed_size=sum(end - start for start, end in zeroed_ranges),
+        zeroed_chunk_count=count_overlapping(zero_chunk_ranges, zeroed_ranges),
+    )
+    log_chunked_image(stats)
+    return stats
+
+
+def count_overlapping(ranges: freespace.Ranges, other_ranges: freespace.Ranges) -> int:
+    # Number of ranges that overlap any of the other ranges (both are sorted).
+    other_ends = [end for _, end in other_ranges]
+    count = 0
+    for start, end in ranges:
+        i = bisect.bisect_right(other_ends, start)
+        if i < len(other_ranges) and other_ranges[i][0] < end:
+            count += 1
+    return count
+
+
+def write_registered_chunked_image(
+    name: str,
+    total_size: int,
+    chunks: typing.List[str],
+    manifest_dir: str,
+    start_time: float,
+    rehashed_count: typing.Optional[int] = None,
+) -> ChunkedImageStats:
+    write_manifest(name, total_size, chunks, manifest_dir)
+    stats = ChunkedImageStats(
+        name=name,
+        total_size=total_size,
+        chunk_count=len(chunks),
+        unique_chunk_count=len(set(c for c in chunks if c)),
+        zero_chunk_count=chunks.count(""),
+        elapsed=time.monotonic() - start_time,
+    )
+    log_chunked_image(stats, from_registry=True, rehashed_count=rehashed_count)
+    return stats
+
+
+def log_chunked_image(
+    stats: ChunkedImageStats,
+    from_registry: bool = False,
+    rehashed_count: typing.Optional[int] = None,
+) -> None:
+    name = stats.name
+    if rehashed_count is not None:
+        registry_note = ", rehashed %d patched chunks" % rehashed_count
+    elif from_registry:
+        registry_note = ", unchanged"
+    else:
+        registry_note = ""
+    if stats.chunk_count > 0:
+        sys.stderr.write(
+            "Chunked %s: %d%% unique chunks, %d%% zero chunks (%s%s)\n"
+            % (
+                name,
+                round(stats.unique_chunk_count / stats.chunk_count * 100),
+                round(stats.zero_chunk_count / stats.chunk_count * 100),
+                format_throughput(stats.total_size, stats.elapsed),
+                registry_note,
+            )
+        )
+        if stats.zeroed_size:
+            sys.stderr.write(
+                "Zeroed %.1f MB of free space in %s, saving %d chunks\n"
+                % (stats.zeroed_size / 1024 / 1024, name, stats.zeroed_chunk_count)
+            )
+    else:
+        sys.stderr.write("Chunked %s: 0 chunks\n" % name)
+
+
+def write_chunked_images(
+    images: typing.List[ImageToChunk],
+    jobs: int = 1,
+    chunk_dir: str = paths.DISK_DIR,
+    manifest_dir: str = paths.DATA_DIR,
+    use_registry: bool = True,
+) -> typing.List[ChunkedImageStats]:
+    # hashlib and file I/O release the GIL for large buffers, so threads are
+    # enough to keep multiple cores busy. Each image still produces its own
+    # manifest, and stats are returned in input order regardless of which image
+    # finishes first.
+    start_time = time.monotonic()
+    # A single listing of the chunk directory, shared by all jobs, replaces
+    # per-chunk existence checks.
+    stored_chunks = list_stored_chunks(chunk_dir)
+    if use_registry:
+        registry.prune()
+    if jobs <= 1:
+        all_stats = [
+            write_chunked_image(
+                image.path,
+                image.name,
+                chunk_dir,
+                manifest_dir,
+                stored_chunks=stored_chunks,
+                use_registry=use_registry,
+                content_defined=image.content_defined,
+                zero_free_space=image.zero_free_space,
+                patches=image.patches,
+            )
+            for image in images
+        ]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            all_stats = list(
+                executor.map(
+                    lambda image: write_chunked_image(
+                        image.path,
+                        image.name,
+                        chunk_dir,
+                        manifest_dir,
+                        # Progress lines from multiple threads would be
+                        # interleaved and unreadable.
+                        show_progress=False,
+                        stored_chunks=stored_chunks,
+                        use_registry=use_registry,
+                        content_defined=image.content_defined,
+                        zero_free_space=image.zero_free_space,
+                        patches=image.patches,
+                    ),
+                    images,
+                )
+            )
+    total_size = sum(stats.total_size for stats in all_stats)
+    sys.stderr.write(
+        "Chunked %d images with %d job(s): %s\n"
+        % (
+            len(all_stats),
+            max(jobs, 1),
+            format_throughput(total_size, time.monotonic() - start_time),
+        )
+    )
+    zeroed_size = sum(stats.zeroed_size for stats in all_stats)
+    if zeroed_size:
+        sys.stderr.write(
+            "Zeroed %.1f MB of free space, saving %d chunks\n"
+            % (
+                zeroed_size / 1024 / 1024,
+                sum(stats.zeroed_chunk_count for stats in all_stats),
+            )
+        )
+    return all_stats
+
+
+def format_throughput(size: int, elapsed: float) -> str:
+    size_mb = size / 1024 / 1024
+    if elapsed <= 0:
+        return "%.1f MB" % size_mb
+    return "%.1f MB in %.1fs, %.1f MB/s" % (size_mb, elapsed, size_mb / elapsed)
+
+
+def write_manifest(
+    name: str,
+    total_size: int,
+    chunks: typing.List[str],
+    manifest_dir: str = paths.DATA_DIR,
+    chunk_starts: typing.Optional[typing.List[int]] = None,
+) -> None:
+    manifest = {
+        "name": os.path.splitext(name)[0],
+        "totalSize": total_size,
+        "chunks": chunks,
+        "chunkSize": CHUNK_SIZE,
+    }
+    if chunk_starts is not None:
+        # Variable-length chunks, chunkSize is the upper bound on their length
+        # (and the size of chunks synthesized past the end of the image).
+        manifest["chunkSize"] = CDC_MAX_SIZE
+        manifest["chunkStarts"] = chunk_starts
+    manifest_path = os.path.join(manifest_dir, f"{name}.json")
+    with open(manifest_path, "w+") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+
+
+class _ChunkedImageReader(io.RawIOBase):
+    def __init__(self, manifest: typing.Dict[str, typing.Any], chunk_dir: str):
+        self._chunks = manifest["chunks"]
+        self._chunk_size = manifest["chunkSize"]
+        self._chunk_starts = manifest.get("chunkStarts")
+        self._total_size = manifest["totalSize"]
+        self._chunk_dir = chunk_dir
+        self._chunk_index = 0
+        self._chunk = b""
+        self._chunk_offset = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def _chunk_start(self, chunk_index: int) -> int:
+        if chunk_index >= len(self._chunks):
+            return self._total_size
+        if self._chunk_starts is not None:
+            return self._chunk_starts[chunk_index]
+        return chunk_index * self._chunk_size
+
+    def readinto(self, buffer: typing.Any) -> int:
+        if self._chunk_offset == len(self._chunk):
+            if self._chunk_index >= len(self._chunks):
+                return 0
+            signature = self._chunks[self._chunk_index]
+            if signature:
+                with open(chunk_path(signature, self._chunk_dir), "rb") as f:
+                    self._chunk = f.read()
+            else:
+                self._chunk = bytes(
+                    self._chunk_start(self._chunk_index + 1)
+                    - self._chunk_start(self._chunk_index)
+                )
+            self._chunk_index += 1
+            self._chunk_offset = 0
+        size = min(len(buffer), len(self._chunk) - self._chunk_offset)
+        buffer[:size] = self._chunk[self._chunk_offset : self._chunk_offset + size]
+        self._chunk_offset += size
+        return size
+
+
+def open_chunked_image(
+    name: str, chunk_dir: str = paths.DISK_DIR, manifest_dir: str = paths.DATA_DIR
+) -> typing.BinaryIO:
+    # Reassembles an image that was written by write_chunked_image from its
+    # manifest and chunks (e.g. for images that are only built in a temporary
+    # directory by import-disks.py).
+    with open(os.path.join(manifest_dir, f"{name}.json"), "r") as manifest_file:
+        manifest = json.load(manifest_file)
+    return io.BufferedReader(
+        _ChunkedImageReader(manifest, chunk_dir), buffer_size=CHUNK_SIZE
+    )
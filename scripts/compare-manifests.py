@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import gzip
+import json
+import manifests
+import os
+import paths
+import sys
+import time
+import typing
+
+
+def time_parse(parse: typing.Callable[[bytes], typing.Any], data: bytes) -> float:
+    # Best of several runs, manifests are small enough that a single parse is
+    # dominated by noise.
+    best = float("inf")
+    for _ in range(20):
+        start_time = time.perf_counter()
+        parse(data)
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compare the size and parse time of the JSON and binary encodings "
+            "of chunked disk manifests, and check that they round-trip."
+        )
+    )
+    parser.add_argument(
+        "manifests",
+        nargs="*",
+        help="manifests to compare (defaults to the generated src/Data/*.dsk.json)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        help="also write the binary manifests (as <name>.manifest) to this directory",
+    )
+    args = parser.parse_args()
+
+    manifest_paths = args.manifests or sorted(
+        glob.glob(os.path.join(paths.DATA_DIR, "*.dsk.json"))
+    )
+    if not manifest_paths:
+        sys.stderr.write("No manifests found.\n")
+        return 1
+
+    all_match = True
+    totals = [0, 0, 0, 0, 0.0, 0.0]
+    print(
+        "%-40s %8s %10s %10s %10s %10s %10s %10s"
+        % (
+            "Manifest",
+            "Chunks",
+            "JSON",
+            "Binary",
+            "JSON gz",
+            "Binary gz",
+            "JSON ms",
+            "Binary ms",
+        )
+    )
+    for manifest_path in manifest_paths:
+        with open(manifest_path, "rb") as manifest_file:
+            json_data = manifest_file.read()
+        manifest = json.loads(json_data)
+        binary_data = manifests.encode(manifest)
+        match = manifests.decode(binary_data) == manifest
+        all_match = all_match and match
+        if args.output_dir:
+            name = os.path.basename(manifest_path).removesuffix(".json")
+            manifests.write_binary_manifest(
+                os.path.join(args.output_dir, f"{name}.manifest"), manifest
+            )
+
+        sizes = [
+            len(json_data),
+            len(binary_data),
+            len(gzip.compress(json_data)),
+            len(gzip.compress(binary_data)),
+        ]
+        times = [
+            time_parse(json.loads, json_data),
+            time_parse(manifests.decode, binary_data),
+        ]
+        for i, value in enumerate(sizes + times):
+            totals[i] += value
+        print(
+            "%-40s %8d %10d %10d %10d %10d %10.3f %10.3f%s"
+            % (
+                os.path.basename(manifest_path)[:40],
+                len(manifest["chunks"]),
+                *sizes,
+                *(t * 1000 for t in times),
+                "" if match else " MISMATCH",
+            )
+        )
+    print(
+        "%-40s %8s %10d %10d %10d %10d %10.3f %10.3f"
+        % ("Total", "", *totals[:4], *(t * 1000 for t in totals[4:]))
+    )
+    return 0 if all_match else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,14 @@
+import cache
+import contextlib
 import dataclasses
 import hashlib
 import logging
+import mmap
 import os.path
 import paths
+import shutil
 import stickies
+import tempfile
 import typing
 import urls
 import zipfile
@@ -22,6 +27,10 @@ class Disk:
     sticky_placeholder_overwrite_byte: bytes = b"\x00"
     compressed: bool = False
     urls: typing.List[str] = dataclasses.field(default_factory=list)
+    # Expected SHA-256 digest of the download (of the concatenated parts, for
+    # images that are split into multiple URLs). Downloads are checked
+    # against it, and skipped if the cache already has a blob with it.
+    sha256: typing.Optional[str] = None
 
     def path(self) -> str:
         if self.urls:
@@ -29,24 +38,81 @@ class Disk:
                 return urls.read_url_to_path(
                     self.urls[0],
                     on_cache_miss=lambda: print(f"Downloading {self.urls[0]}"),
+                    sha256=self.sha256,
                 )
-            cache_key = hashlib.sha256("".join(self.urls).encode()).hexdigest()
-            cache_path = os.path.join(paths.CACHE_DIR, cache_key)
-            if not os.path.exists(cache_path):
-                data = b""
-                for url in self.urls:
-                    data += urls.read_url(
-                        url, on_cache_miss=lambda: print(f"Downloading {url}")
+            cache_path = joined_cache_path(self.urls)
+            if self.sha256:
+                urls.link_expected_blob(cache_path, self.sha256)
+            stale = False
+            if (
+                os.path.exists(cache_path)
+                and urls.revalidation_enabled()
+                and not self.sha256
+            ):
+                # Parts that have changed are downloaded again, and then need
+                # to be concatenated again.
+                cache_mtime = os.path.getmtime(cache_path)
+                stale = any(
+                    os.path.getmtime(urls.read_url_to_path(url)) > cache_mtime
+                    for url in self.urls
+                )
+            cache.record_access(
+                cache_path, hit=not stale and os.path.exists(cache_path)
+            )
+            if stale or not os.path.exists(cache_path):
+                # Concatenated (and hashed) a part at a time, and renamed into
+                # place once complete (like single downloads).
+                os.makedirs(paths.CACHE_DIR, exist_ok=True)
+                digest = hashlib.sha256()
+                with tempfile.NamedTemporaryFile(
+                    dir=paths.CACHE_DIR, delete=False
+                ) as dest_file:
+                    for url in self.urls:
+                        part_path = urls.read_url_to_path(
+                            url, on_cache_miss=lambda: print(f"Downloading {url}")
+                        )
+                        with open(part_path, "rb") as part_file:
+                            while data := part_file.read(urls.DOWNLOAD_BUFFER_SIZE):
+                                digest.update(data)
+                                dest_file.write(data)
+                if self.sha256 and digest.hexdigest() != self.sha256:
+                    os.remove(dest_file.name)
+                    raise IOError(
+                        "%s does not match the expected digest (%s instead of %s)"
+                        % (self.name, digest.hexdigest(), self.sha256)
                     )
-                with open(cache_path, "wb") as f:
-                    f.write(data)
+                os.replace(dest_file.name, cache_path)
+                urls.store_blob(cache_path, digest.hexdigest())
             return cache_path
         name = self.name
         if self.compressed:
             name += ".zip"
         return os.path.join(paths.IMAGES_DIR, name)
 
-    def read(self) -> bytes:
+    def cache_paths(self) -> typing.List[str]:
+        # Paths in the cache directory that the image is read from (whether or
+        # not they exist yet), without downloading it.
+        if not self.urls:
+            if not self.compressed:
+                return []
+            input_path = self.path()
+            result = []
+        else:
+            result = [urls.url_cache_path(url) for url in self.urls]
+            if len(self.urls) == 1:
+                input_path = result[0]
+            else:
+                input_path = joined_cache_path(self.urls)
+                result.append(input_path)
+        if self.sha256:
+            result.append(urls.blob_path(self.sha256))
+        if self.compressed and os.path.exists(input_path):
+            result.append(decompressed_cache_path(input_path, self.name))
+        return result
+
+    def image_path(self) -> typing.Optional[str]:
+        # Path of the uncompressed image (compressed images are decompressed
+        # into the cache directory once), or None if it's not available.
         input_path = self.path()
         if not os.path.exists(input_path):
             logging.warning(
@@ -54,13 +120,84 @@ class Disk:
                 self.name,
                 input_path,
             )
-            return bytes()
-        elif self.compressed:
-            with zipfile.ZipFile(input_path, "r") as zip:
-                return zip.read(self.name)
+            return None
+        if self.compressed:
+            return decompressed_path(input_path, self.name)
+        return input_path
+
+    def estimated_size(self) -> typing.Optional[int]:
+        # Size of the uncompressed image, without downloading it (None if it
+        # has not been downloaded yet).
+        if self.urls:
+            input_paths = [urls.url_cache_path(url) for url in self.urls]
         else:
-            with open(input_path, "rb") as image:
-                return image.read()
+            input_paths = [self.path()]
+        if not all(os.path.exists(p) for p in input_paths):
+            return None if self.urls else 0
+        if self.compressed and len(input_paths) == 1:
+            with zipfile.ZipFile(input_paths[0], "r") as zip:
+                return zip.getinfo(self.name).file_size
+        return sum(os.path.getsize(p) for p in input_paths)
+
+    def buffer(
+        self,
+    ) -> typing.ContextManager[typing.Union[mmap.mmap, bytes]]:
+        return image_buffer(self.image_path())
+
+    def open(self) -> typing.BinaryIO:
+        # Streaming alternative to buffer(), for reading the image in order.
+        input_path = self.path()
+        if self.compressed:
+            with zipfile.ZipFile(input_path, "r") as zip:
+                return zip.open(self.name)
+        return open(input_path, "rb")
+
+
+@contextlib.contextmanager
+def image_buffer(
+    image_path: typing.Optional[str],
+) -> typing.Iterator[typing.Union[mmap.mmap, bytes]]:
+    # Read-only view of an image that is paged in as needed, instead of
+    # reading all of it into memory.
+    if image_path is None or not os.path.getsize(image_path):
+        yield bytes()
+        return
+    with open(image_path, "rb") as image_file:
+        with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield buffer
+
+
+def joined_cache_path(disk_urls: typing.List[str]) -> str:
+    # Images that are split into multiple downloads are concatenated into the
+    # cache directory.
+    cache_key = hashlib.sha256("".join(disk_urls).encode()).hexdigest()
+    return os.path.join(paths.CACHE_DIR, cache_key)
+
+
+def decompressed_cache_path(zip_path: str, member: str) -> str:
+    # Keyed by the zip file's path, size and modification time.
+    stat = os.stat(zip_path)
+    cache_key = hashlib.sha256(
+        f"{os.path.realpath(zip_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+    ).hexdigest()[:16]
+    return os.path.join(paths.DECOMPRESSED_DIR, f"{cache_key}-{member}")
+
+
+def decompressed_path(zip_path: str, member: str) -> str:
+    # Decompresses a member of a zip file into the cache directory, so that it
+    # can be used in place like an uncompressed image.
+    cache_path = decompressed_cache_path(zip_path, member)
+    cache.record_access(cache_path, hit=os.path.exists(cache_path))
+    if os.path.exists(cache_path):
+        return cache_path
+    os.makedirs(paths.DECOMPRESSED_DIR, exist_ok=True)
+    with zipfile.ZipFile(zip_path, "r") as zip, zip.open(member) as src_file:
+        with tempfile.NamedTemporaryFile(
+            dir=paths.DECOMPRESSED_DIR, delete=False
+        ) as dest_file:
+            shutil.copyfileobj(src_file, dest_file, 1024 * 1024)
+    os.replace(dest_file.name, cache_path)
+    return cache_path
 
 
 SYSTEM_10_ORIGINAL = Disk(name="System 1.0 (Original).dsk")
@@ -33,7 +33,8 @@ def parse_args():
 
 def load_volume(disk: disks.Disk) -> machfs.Volume:
     volume = machfs.Volume()
-    volume.read(disk.read())
+    with disk.buffer() as image_data:
+        volume.read(image_data)
     return volume
 
 
@@ -0,0 +1,204 @@
+# Finds the unallocated allocation blocks of HFS, HFS+ and MFS volumes, so that
+# they can be treated as zero when chunking. Source images often have stale
+# data in free blocks, which the filesystem never reads, but which otherwise
+# ends up in unique chunks that need to be stored and fetched.
+#
+# Images may be a bare volume or have an Apple partition map (in which case
+# every HFS partition is handled). Anything that isn't recognized results in no
+# free ranges, i.e. the image is chunked as-is.
+
+import struct
+import typing
+
+SECTOR_SIZE = 512
+MDB_OFFSET = 1024
+
+HFS_SIGNATURE = b"BD"
+HFS_PLUS_SIGNATURES = (b"H+", b"HX")
+MFS_SIGNATURE = b"\xd2\xd7"
+
+# Byte ranges (start, end) of free space, relative to the start of the image.
+Ranges = typing.List[typing.Tuple[int, int]]
+
+
+def _read_at(image_file: typing.BinaryIO, offset: int, size: int) -> bytes:
+    image_file.seek(offset)
+    return image_file.read(size)
+
+
+def _bitmap_free_blocks(
+    bitmap: bytes, block_count: int
+) -> typing.Iterator[typing.Tuple[int, int]]:
+    # Yields runs of free (clear) bits as (first block, block count). Bits are
+    # most significant first, as in both the HFS volume bitmap and the HFS+
+    # allocation file. Whole bytes are skipped when possible.
+    block = 0
+    run_start = None
+    while block < block_count:
+        if block & 7 == 0 and block + 8 <= block_count:
+            byte = bitmap[block >> 3]
+            if byte == 0xFF:
+                if run_start is not None:
+                    yield run_start, block - run_start
+                    run_start = None
+                block += 8
+                continue
+            if byte == 0:
+                if run_start is None:
+                    run_start = block
+                block += 8
+                continue
+        allocated = bitmap[block >> 3] & (0x80 >> (block & 7))
+        if allocated:
+            if run_start is not None:
+                yield run_start, block - run_start
+                run_start = None
+        elif run_start is None:
+            run_start = block
+        block += 1
+    if run_start is not None:
+        yield run_start, block_count - run_start
+
+
+def _hfs_free_ranges(
+    image_file: typing.BinaryIO, volume_offset: int, mdb: bytes
+) -> Ranges:
+    bitmap_start, block_count, block_size, first_block_sector = (
+        struct.unpack_from(">H", mdb, 14)[0],
+        struct.unpack_from(">H", mdb, 18)[0],
+        struct.unpack_from(">I", mdb, 20)[0],
+        struct.unpack_from(">H", mdb, 28)[0],
+    )
+    bitmap = _read_at(
+        image_file,
+        volume_offset + bitmap_start * SECTOR_SIZE,
+        (block_count + 7) // 8,
+    )
+    if len(bitmap) < (block_count + 7) // 8 or not block_size:
+        return []
+    blocks_offset = volume_offset + first_block_sector * SECTOR_SIZE
+    return [
+        (
+            blocks_offset + start * block_size,
+            blocks_offset + (start + count) * block_size,
+        )
+        for start, count in _bitmap_free_blocks(bitmap, block_count)
+    ]
+
+
+def _hfs_plus_free_ranges(
+    image_file: typing.BinaryIO, volume_offset: int, header: bytes
+) -> Ranges:
+    block_size, block_count = struct.unpack_from(">II", header, 40)
+    # The allocation file fork data, only the extents in the volume header
+    # are used (an allocation file that needs the extents overflow file is
+    # not supported).
+    logical_size, _, fork_block_count = struct.unpack_from(">QII", header, 112)
+    extents = [struct.unpack_from(">II", header, 128 + i * 8) for i in range(8)]
+    if not block_size or sum(count for _, count in extents) < fork_block_count:
+        return []
+    bitmap = b"".join(
+        _read_at(image_file, volume_offset + start * block_size, count * block_size)
+        for start, count in extents
+        if count
+    )[:logical_size]
+    if len(bitmap) < (block_count + 7) // 8:
+        return []
+    return [
+        (
+            volume_offset + start * block_size,
+            volume_offset + (start + count) * block_size,
+        )
+        for start, count in _bitmap_free_blocks(bitmap, block_count)
+    ]
+
+
+def _mfs_free_ranges(
+    image_file: typing.BinaryIO, volume_offset: int, mdb: bytes
+) -> Ranges:
+    block_count = struct.unpack_from(">H", mdb, 18)[0]
+    block_size = struct.unpack_from(">I", mdb, 20)[0]
+    first_block_sector = struct.unpack_from(">H", mdb, 28)[0]
+    # The block map follows the 64-byte MDB, with a 12-bit entry (0 if free)
+    # for each allocation block, starting with block 2.
+    block_map = _read_at(
+        image_file, volume_offset + MDB_OFFSET + 64, (block_count * 12 + 7) // 8
+    )
+    if len(block_map) < (block_count * 12 + 7) // 8 or not block_size:
+        return []
+    blocks_offset = volume_offset + first_block_sector * SECTOR_SIZE
+    ranges: Ranges = []
+    for i in range(block_count):
+        bit_offset = i * 12
+        pair = (block_map[bit_offset // 8] << 8) | (
+            block_map[bit_offset // 8 + 1]
+            if bit_offset // 8 + 1 < len(block_map)
+            else 0
+        )
+        entry = (pair >> (4 - bit_offset % 8)) & 0xFFF
+        if entry:
+            continue
+        start = blocks_offset + i * block_size
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], start + block_size)
+        else:
+            ranges.append((start, start + block_size))
+    return ranges
+
+
+def _volume_free_ranges(image_file: typing.BinaryIO, volume_offset: int) -> Ranges:
+    header = _read_at(image_file, volume_offset + MDB_OFFSET, SECTOR_SIZE)
+    signature = header[:2]
+    if signature == HFS_SIGNATURE:
+        ranges = _hfs_free_ranges(image_file, volume_offset, header)
+        if header[0x7C:0x7E] in HFS_PLUS_SIGNATURES:
+            # HFS wrapper around an HFS+ volume (the embedded volume is
+            # allocated as far as the wrapper is concerned).
+            block_size = struct.unpack_from(">I", header, 20)[0]
+            first_block_sector = struct.unpack_from(">H", header, 28)[0]
+            embedded_start = struct.unpack_from(">H", header, 0x7E)[0]
+            ranges += _volume_free_ranges(
+                image_file,
+                volume_offset
+                + first_block_sector * SECTOR_SIZE
+                + embedded_start * block_size,
+            )
+        return ranges
+    if signature in HFS_PLUS_SIGNATURES:
+        return _hfs_plus_free_ranges(image_file, volume_offset, header)
+    if signature == MFS_SIGNATURE:
+        return _mfs_free_ranges(image_file, volume_offset, header)
+    return []
+
+
+def _partition_offsets(image_file: typing.BinaryIO) -> typing.List[int]:
+    # Offsets of the HFS partitions in an Apple partition map, or just the
+    # start of the image if there is no partition map.
+    if _read_at(image_file, 0, 2) != b"ER":
+        return [0]
+    offsets = []
+    entry = _read_at(image_file, SECTOR_SIZE, SECTOR_SIZE)
+    if entry[:2] != b"PM":
+        return [0]
+    entry_count = struct.unpack_from(">I", entry, 4)[0]
+    for i in range(entry_count):
+        entry = _read_at(image_file, (i + 1) * SECTOR_SIZE, SECTOR_SIZE)
+        if entry[:2] != b"PM":
+            break
+        start = struct.unpack_from(">I", entry, 8)[0]
+        partition_type = entry[48:80].split(b"\0", 1)[0]
+        if partition_type == b"Apple_HFS":
+            offsets.append(start * SECTOR_SIZE)
+    return offsets
+
+
+def find_free_ranges(image_path: str) -> Ranges:
+    with open(image_path, "rb") as image_file:
+        ranges: Ranges = []
+        for volume_offset in _partition_offsets(image_file):
+            try:
+                ranges += _volume_free_ranges(image_file, volume_offset)
+            except (struct.error, IndexError):
+                # Truncated or corrupted volume, leave it as-is.
+                continue
+    return sorted(ranges)
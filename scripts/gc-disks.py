@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import argparse
+import paths
+import sweep
+import sys
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Remove chunks (and packs, pre-compressed variants and "
+            "dictionaries) from Images/build that are not referenced by any "
+            "manifest, and list the ones to delete from the remote store."
+        )
+    )
+    parser.add_argument(
+        "--previous-releases",
+        type=int,
+        default=1,
+        metavar="N",
+        help=(
+            "also keep everything referenced by the manifests of the last N "
+            "releases before the current one, so that clients with cached "
+            "manifests can still load them (default: %(default)s). A release "
+            "is a commit that changed src/Data/*.dsk.json, the current one is "
+            "the manifests in src/Data (the latest such commit is skipped if "
+            "they are the same)"
+        ),
+    )
+    parser.add_argument(
+        "--manifest-dir",
+        action="append",
+        default=[],
+        help="additional directory of manifests to keep (e.g. an archived release)",
+    )
+    parser.add_argument(
+        "--remote-listing",
+        help=(
+            "file with the names of all objects in the remote store (e.g. the "
+            "output of rclone lsf), used for the delete list instead of the "
+            "local sweep"
+        ),
+    )
+    parser.add_argument(
+        "--delete-list",
+        help=(
+            "write the names of unreferenced objects to this file (for rclone "
+            "delete --files-from) instead of to stdout"
+        ),
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report what would be removed",
+    )
+    args = parser.parse_args()
+
+    marked = sweep.mark(
+        [paths.DATA_DIR] + args.manifest_dir,
+        previous_releases=args.previous_releases,
+        log=sys.stderr.write,
+    )
+    result = sweep.sweep(marked, dry_run=args.dry_run)
+    sys.stderr.write(
+        "%s %d unreferenced files (%.1f MB), kept %d (%.1f MB)\n"
+        % (
+            "Would remove" if args.dry_run else "Removed",
+            len(result.unreferenced),
+            result.unreferenced_size / 1024 / 1024,
+            result.kept_count,
+            result.kept_size / 1024 / 1024,
+        )
+    )
+
+    if args.remote_listing:
+        with open(args.remote_listing, "r") as f:
+            delete_list = sweep.unreferenced_remote(
+                (line.strip() for line in f if line.strip()), marked
+            )
+    else:
+        delete_list = result.unreferenced
+    if args.delete_list:
+        with open(args.delete_list, "w") as f:
+            f.writelines(f"{name}\n" for name in delete_list)
+        sys.stderr.write(
+            "Wrote %d remote deletions to %s\n" % (len(delete_list), args.delete_list)
+        )
+    else:
+        sys.stdout.writelines(f"{name}\n" for name in delete_list)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
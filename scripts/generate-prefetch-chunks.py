@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# Generates the prefetchChunks lists in src/defs/disks.ts from chunk access
+# traces, instead of copying them by hand from the warnings that
+# EmulatorWorkerChunkedDisk.validate() logs.
+#
+# Traces are JSONL files, with one event per line, as recorded from the
+# EmulatorWorkerChunkedDiskDelegate callbacks:
+#
+#   {"trace": "<id>", "event": "will_load_chunk", "disk": "<spec name>",
+#    "chunk": <index>, "time": <ms>}
+#   {"trace": "<id>", "event": "did_load_chunk", "disk": "<spec name>",
+#    "chunk": <index>, "time": <ms>}
+#   {"trace": "<id>", "event": "quiescent", "time": <ms>}
+#
+# "trace" identifies a single boot (multiple traces can be in the same file),
+# "disk" is the name from the disk's manifest (e.g. "System 7.0 HD"), and
+# "time" is milliseconds since the start of the trace (e.g. performance.now()).
+# "quiescent" is the first idle point (the emulator_quiescent message). Chunks
+# that are loaded before it in any trace are included in the generated list,
+# ordered by how early they are loaded. did_load_chunk events are optional, and
+# are used to estimate the latency of a blocking chunk load. "chunk" is an index
+# into the manifest's chunks; prefetchChunks are always indexes of fixed-size
+# (256K) chunks, so traces of content-defined manifests are mapped to those.
+
+import argparse
+import collections
+import json
+import os
+import paths
+import prefetch
+import statistics
+import sys
+import typing
+
+DEFAULT_ROUND_TRIP_MS = 150
+
+
+def read_manifest(disk_name: str) -> typing.Optional[dict]:
+    manifest_path = os.path.join(paths.DATA_DIR, f"{disk_name}.dsk.json")
+    try:
+        with open(manifest_path, "r") as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+
+def generate_prefetch_chunks(
+    traces: typing.List[prefetch.Trace],
+    manifest: typing.Optional[dict],
+) -> typing.List[int]:
+    # The union of all chunks loaded during boot is needed to avoid any
+    # blocking loads. Order by the average position at which a chunk is first
+    # loaded, so that the most urgent chunks are requested first.
+    positions: typing.Dict[int, typing.List[float]] = collections.defaultdict(list)
+    for trace in traces:
+        for position, chunk in enumerate(trace.boot_chunks):
+            positions[chunk].append(position / max(len(trace.boot_chunks), 1))
+    chunk_list = sorted(positions, key=lambda c: (statistics.mean(positions[c]), c))
+    if manifest is not None:
+        # Chunks that are zero (or past the end) in the current manifest are
+        # synthesized by the client and never fetched.
+        chunk_list = [
+            c
+            for c in chunk_list
+            if any(
+                manifest["chunks"][i]
+                for i in prefetch.manifest_chunk_indexes(manifest, [c])
+            )
+        ]
+    return chunk_list
+
+
+def count_blocking_loads(
+    traces: typing.List[prefetch.Trace], prefetch_chunks: typing.List[int]
+) -> typing.Tuple[float, float]:
+    # Average number of boot-time loads that go to the network (and block the
+    # emulator), and of prefetched chunks that were not needed, per trace.
+    prefetch_set = set(prefetch_chunks)
+    blocking = [len(set(t.boot_chunks) - prefetch_set) for t in traces]
+    unused = [len(prefetch_set - set(t.boot_chunks)) for t in traces]
+    return statistics.mean(blocking), statistics.mean(unused)
+
+
+def estimate_round_trip_ms(
+    traces: typing.List[prefetch.Trace],
+    prefetch_chunks: typing.List[int],
+    default: float,
+) -> float:
+    # Loads of chunks that were not prefetched went to the network.
+    prefetch_set = set(prefetch_chunks)
+    network_times = [
+        load_time
+        for trace in traces
+        for chunk, load_time in trace.load_times.items()
+        if chunk not in prefetch_set
+    ]
+    if not network_times:
+        return default
+    return statistics.median(network_times)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Generate prefetchChunks lists for src/defs/disks.ts from recorded "
+            "chunk access traces."
+        )
+    )
+    parser.add_argument("traces", nargs="+", help="JSONL trace files")
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="rewrite the prefetchChunks lists in src/defs/disks.ts in place",
+    )
+    parser.add_argument(
+        "--round-trip-ms",
+        type=float,
+        default=DEFAULT_ROUND_TRIP_MS,
+        help=(
+            "latency of a blocking chunk load, if the traces have no "
+            "did_load_chunk events (default: %(default)s)"
+        ),
+    )
+    args = parser.parse_args()
+
+    traces_by_disk = prefetch.read_traces(args.traces)
+    if not traces_by_disk:
+        sys.stderr.write("No chunk loads found in traces.\n")
+        return 1
+    disks_ts = prefetch.read_disks_ts()
+    current = prefetch.read_prefetch_chunks(disks_ts)
+
+    generated = {}
+    report = []
+    for disk_name in sorted(traces_by_disk):
+        traces = traces_by_disk[disk_name]
+        manifest = read_manifest(disk_name)
+        if manifest is None:
+            sys.stderr.write(
+                "No manifest for %s, not checking for zero chunks\n" % disk_name
+            )
+        else:
+            # Traces are of the manifest's chunks, which are not the fixed-size
+            # chunks of prefetchChunks if they are content-defined.
+            traces = [prefetch.prefetch_trace(manifest, t) for t in traces]
+        chunk_list = generate_prefetch_chunks(traces, manifest)
+        generated[disk_name] = chunk_list
+        current_chunks = current.get(disk_name, [])
+        round_trip_ms = estimate_round_trip_ms(
+            traces, current_chunks, args.round_trip_ms
+        )
+        current_blocking, current_unused = count_blocking_loads(traces, current_chunks)
+        generated_blocking, generated_unused = count_blocking_loads(traces, chunk_list)
+        report.append(
+            (
+                disk_name,
+                len(traces),
+                current_blocking,
+                current_unused,
+                generated_blocking,
+                generated_unused,
+                (current_blocking - generated_blocking) * round_trip_ms,
+            )
+        )
+
+        if disk_name not in current:
+            sys.stderr.write("%s has no prefetchChunks in disks.ts\n" % disk_name)
+        if not args.update:
+            print("// %s" % disk_name)
+            print(prefetch.format_prefetch_chunks(chunk_list), end="")
+
+    if args.update:
+        with open(prefetch.DISKS_TS_PATH, "w") as disks_ts_file:
+            disks_ts_file.write(prefetch.update_disks_ts(disks_ts, generated))
+
+    sys.stderr.write(
+        "\n%-40s %6s %18s %18s %10s\n"
+        % ("Disk", "Traces", "Current blocking", "New blocking", "Saved")
+    )
+    for (
+        disk_name,
+        trace_count,
+        current_blocking,
+        current_unused,
+        generated_blocking,
+        generated_unused,
+        saved_ms,
+    ) in report:
+        sys.stderr.write(
+            "%-40s %6d %18s %18s %8.0fms\n"
+            % (
+                disk_name[:40],
+                trace_count,
+                "%.1f (%.1f unused)" % (current_blocking, current_unused),
+                "%.1f (%.1f unused)" % (generated_blocking, generated_unused),
+                saved_ms,
+            )
+        )
+    sys.stderr.write(
+        "Blocking round-trips saved per boot: %.1f\n" % sum(r[2] - r[4] for r in report)
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 
 import argparse
+import cache
 import glob
 import hashlib
+import inputs
 import io
 import json
 import os
 import paths
+import registry
 import shutil
 import subprocess
 import sys
@@ -59,6 +62,20 @@ class OutputManifest(typing.TypedDict):
     isFloppy: typing.NotRequired[bool]
 
 
+class Media(typing.NamedTuple):
+    path: str
+    # Member within the .zip file at path, if the media is compressed.
+    member: typing.Optional[str]
+    size: int
+
+    def open(self) -> typing.BinaryIO:
+        if self.member is None:
+            return open(self.path, "rb")
+        # The member remains readable after the archive itself is closed.
+        with zipfile.ZipFile(self.path, "r") as zip_file:
+            return zip_file.open(self.member)
+
+
 def load_manifest(manifest_path: str) -> typing.Tuple[str, InputManifest]:
     folder_path, _ = os.path.splitext(
         os.path.relpath(manifest_path, paths.CD_ROMS_DIR))
@@ -143,11 +160,12 @@ def get_source_info(
 
     src_url = input_manifest["src_url"]
     if input_manifest.get("is_floppy"):
-        media = urls.read_url(
+        media_path = urls.read_url_to_path(
             src_url,
             on_cache_miss=lambda: sys.stderr.write(
                 "  Downloading media for self-hosting: %s\n" % src_url),
         )
+        media = Media(media_path, None, os.path.getsize(media_path))
         return get_self_hosted_source_info(
             media, write_media, sync_media, media_rclone_remote)
 
@@ -161,32 +179,47 @@ def get_source_info(
 
 
 def get_self_hosted_source_info(
-    media: bytes,
+    media: Media,
     write_media: bool,
     sync_media: bool,
     media_rclone_remote: str,
 ) -> typing.Tuple[str, int]:
-    media_hash = hashlib.sha256(media).hexdigest()
+    media_hash = get_media_hash(media)
     media_key = f"{MEDIA_R2_PREFIX}/{media_hash}.media"
     if write_media:
         write_local_media(media_key, media)
     if sync_media:
         sync_media_to_r2(media_key, media, media_rclone_remote)
-    return f"r2://{media_key}", len(media)
+    return f"r2://{media_key}", media.size
 
 
-def write_local_media(media_key: str, media: bytes) -> None:
+def get_media_hash(media: Media) -> str:
+    # Media files can be hundreds of megabytes, so avoid re-reading them if
+    # the hash registry already knows the hash of an unchanged file.
+    media_fingerprint = registry.fingerprint(media.path)
+    hash_kind = "sha256"
+    if media.member is not None:
+        hash_kind += ":" + media.member
+    media_hash = registry.get_file_hash(media_fingerprint, hash_kind)
+    if media_hash is None:
+        with media.open() as f:
+            media_hash = hashlib.file_digest(f, "sha256").hexdigest()
+        registry.put_file_hash(media_fingerprint, media_hash, hash_kind)
+    return media_hash
+
+
+def write_local_media(media_key: str, media: Media) -> None:
     media_path = os.path.join(paths.CD_ROMS_BUILD_DIR, media_key)
     os.makedirs(os.path.dirname(media_path), exist_ok=True)
-    if os.path.isfile(media_path) and os.path.getsize(media_path) == len(media):
+    if os.path.isfile(media_path) and os.path.getsize(media_path) == media.size:
         return
     temp_path = media_path + ".tmp"
-    with open(temp_path, "wb") as f:
-        f.write(media)
+    with media.open() as src, open(temp_path, "wb") as f:
+        shutil.copyfileobj(src, f)
     os.replace(temp_path, media_path)
 
 
-def load_media_file(input_manifest: InputManifest) -> bytes:
+def load_media_file(input_manifest: InputManifest) -> Media:
     manifest_path = input_manifest.get("_manifest_path")
     if not manifest_path:
         raise Exception("Cannot resolve src_file without manifest path")
@@ -197,16 +230,16 @@ def load_media_file(input_manifest: InputManifest) -> bytes:
         raise Exception("src_file does not exist: %s" % src_file)
     if zipfile.is_zipfile(src_path):
         return load_media_from_zip(src_path, input_manifest)
-    with open(src_path, "rb") as f:
-        return f.read()
+    return Media(src_path, None, os.path.getsize(src_path))
 
 
-def load_media_from_zip(src_path: str, input_manifest: InputManifest) -> bytes:
+def load_media_from_zip(src_path: str, input_manifest: InputManifest) -> Media:
     with zipfile.ZipFile(src_path, "r") as zip_file:
         src_file_member = input_manifest.get("src_file_member")
         if src_file_member:
             try:
-                return zip_file.read(src_file_member)
+                return Media(src_path, src_file_member,
+                             zip_file.getinfo(src_file_member).file_size)
             except KeyError:
                 raise Exception(
                     "src_file_member not found in %s: %s" %
@@ -221,30 +254,35 @@ def load_media_from_zip(src_path: str, input_manifest: InputManifest) -> bytes:
             raise Exception(
                 "%s has %d media candidates (%s), specify src_file_member" %
                 (input_manifest["src_file"], len(candidates), ", ".join(candidates)))
-        return zip_file.read(candidates[0])
+        return Media(src_path, candidates[0],
+                     zip_file.getinfo(candidates[0]).file_size)
 
 
 def is_media_file(filename: str) -> bool:
     return filename.lower().endswith(MEDIA_FILE_EXTENSIONS)
 
 
-def sync_media_to_r2(key: str, media: bytes, media_rclone_remote: str) -> None:
+def sync_media_to_r2(key: str, media: Media, media_rclone_remote: str) -> None:
     existing_size = get_r2_object_size(key, media_rclone_remote)
-    if existing_size == len(media):
+    if existing_size == media.size:
         sys.stderr.write("  R2 media already exists: %s\n" % key)
         return
     if existing_size is not None:
         sys.stderr.write(
             "  R2 media size mismatch for %s (%d != %d), uploading\n" %
-            (key, existing_size, len(media)))
+            (key, existing_size, media.size))
     else:
         sys.stderr.write("  Uploading R2 media: %s\n" % key)
 
     temp_path = None
     try:
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(media)
-            temp_path = temp_file.name
+        if media.member is None:
+            upload_path = media.path
+        else:
+            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+                with media.open() as src:
+                    shutil.copyfileobj(src, temp_file)
+                temp_path = upload_path = temp_file.name
         subprocess.run(
             [
                 "rclone",
@@ -252,7 +290,7 @@ def sync_media_to_r2(key: str, media: bytes, media_rclone_remote: str) -> None:
                 "copyto",
                 "--s3-no-check-bucket",
                 "--no-update-modtime",
-                temp_path,
+                upload_path,
                 "%s/%s" % (media_rclone_remote, key),
             ],
             check=True,
@@ -401,6 +439,8 @@ def main():
     with open(os.path.join(paths.DATA_DIR, "CD-ROMs.json"), "w") as f:
         json.dump(output_manifests, f, indent=4)
 
+    cache.enforce_max_size(inputs.pinned_cache_paths(), sys.stderr.write)
+
 
 if __name__ == "__main__":
     sys.exit(main())
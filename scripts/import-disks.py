@@ -1,25 +1,42 @@
 #!/usr/bin/env python3
 
+import argparse
+import bisect
 import copy
 import basilisk
+import builddate
+import buildstate
+import cache
+import chunks
+import dataclasses
 import disks
 import enum
-import hashlib
-import json
+import freespace
+import functools
+import glob
+import inputs
 import library
 import logging
+import merkle
 import minivmac
+import mmap
+import nextstep
 import os
+import packs
 import paths
+import placeholders
+import precompress
+import prefetch
+import scheduler
 import shutil
 import sys
 import tempfile
 import typing
+import urls
 import zipfile
 import subprocess
 import stickies
-
-CHUNK_SIZE = 256 * 1024
+import struct
 
 
 class InfiniteHD(enum.Enum):
@@ -33,6 +50,9 @@ class InfiniteHD(enum.Enum):
 class ImageDef(typing.NamedTuple):
     name: str
     path: str
+    # Customizations, applied on top of the file at path when it's chunked
+    # (so that it never needs to be copied).
+    patches: chunks.Patches = ()
 
 
 def write_image_def(image: bytes, name: str, dest_dir: str) -> ImageDef:
@@ -42,67 +62,117 @@ def write_image_def(image: bytes, name: str, dest_dir: str) -> ImageDef:
     return ImageDef(name, image_path)
 
 
-ZERO_CHUNK = b"\0" * CHUNK_SIZE
+def write_chunked_image(image: ImageDef) -> None:
+    chunks.write_chunked_image(image.path, image.name, patches=image.patches)
+
+
+def write_chunked_images(
+    images: typing.List[ImageDef],
+    jobs: int,
+    content_defined_names: typing.Set[str] = frozenset(),
+    zero_free_space: bool = False,
+) -> None:
+    chunks.write_chunked_images(
+        [
+            chunks.ImageToChunk(
+                i.path,
+                i.name,
+                content_defined=i.name in content_defined_names,
+                zero_free_space=zero_free_space,
+                patches=i.patches,
+            )
+            for i in images
+        ],
+        jobs=jobs,
+    )
 
 
-def write_chunked_image(image: ImageDef) -> None:
-    total_size = 0
-    chunks = []
-    chunk_signatures = set()
-    zero_chunk_count = 0
-    salt = b"raw"
-    with open(image.path, "rb") as image_file:
-        image_bytes = image_file.read()
-    disk_size = len(image_bytes)
-    for i in range(0, disk_size, CHUNK_SIZE):
+def read_block(f: typing.BinaryIO, size: int) -> bytes:
+    # Chunked images are read a chunk at a time, which may be shorter.
+    block = bytearray()
+    while len(block) < size and (data := f.read(size - len(block))):
+        block += data
+    return bytes(block)
+
+
+def mismatched_blocks(
+    image: ImageDef, free_ranges: freespace.Ranges
+) -> typing.List[int]:
+    # Offsets of the blocks of the chunked image that differ from the source
+    # image other than by having the free ranges zeroed. Both are read a chunk
+    # at a time, so that large images don't need to be read into memory.
+    range_starts = [start for start, _ in free_ranges]
+    mismatched_offsets = []
+    offset = 0
+    image_file = chunks.open_image(image.path, image.patches)
+    chunked_file = chunks.open_chunked_image(image.name)
+    with image_file, chunked_file:
+        while True:
+            image_block = read_block(image_file, chunks.CHUNK_SIZE)
+            chunked_block = read_block(chunked_file, chunks.CHUNK_SIZE)
+            if not image_block and not chunked_block:
+                break
+            if image_block != chunked_block:
+                expected_block = bytearray(image_block)
+                block_end = offset + len(image_block)
+                i = max(bisect.bisect_right(range_starts, offset) - 1, 0)
+                for start, end in free_ranges[i:]:
+                    if start >= block_end:
+                        break
+                    start, end = max(start, offset), min(end, block_end)
+                    if start < end:
+                        expected_block[start - offset : end - offset] = bytes(
+                            end - start
+                        )
+                if expected_block != chunked_block:
+                    mismatched_offsets.append(offset)
+            offset += len(image_block)
+    return mismatched_offsets
+
+
+def verify_free_space(image: ImageDef) -> bool:
+    # Checks that zeroing free space did not affect any file, independently of
+    # the allocation bitmap that the free ranges come from: no extent that the
+    # catalog and extents overflow B-trees (or the volume header) allocate may
+    # overlap them. The image is memory mapped, only the B-trees are read.
+    # The chunked image is also compared with the source, to check that only
+    # the free ranges changed.
+    free_ranges = freespace.find_free_ranges(image.path)
+    overlapping: typing.Optional[typing.List[str]] = None
+    if os.path.getsize(image.path):
+        with open(image.path, "rb") as image_file:
+            with mmap.mmap(
+                image_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as image_data:
+                try:
+                    overlapping = placeholders.allocated_in(image_data, free_ranges)
+                except (struct.error, IndexError, ValueError) as e:
+                    sys.stderr.write(
+                        "Could not read the catalog of %s: %r\n" % (image.name, e)
+                    )
+                    return False
+    if overlapping is None:
         sys.stderr.write(
-            "Chunking %s: %.1f%%\r" % (image.name, ((i + CHUNK_SIZE) / disk_size) * 100)
+            "No HFS or HFS+ volumes in %s, only comparing it with its source\n"
+            % image.name
         )
-        chunk = image_bytes[i : i + CHUNK_SIZE]
-        total_size += len(chunk)
-        # Don't bother storing zero-ed out chunks (common for the saved HD),
-        # the signature takes up space, and we don't need to load them
-        if chunk == ZERO_CHUNK:
-            chunks.append("")
-            zero_chunk_count += 1
-            continue
-        chunk_signature = hashlib.blake2b(chunk, digest_size=16, salt=salt).hexdigest()
-        chunks.append(chunk_signature)
-        if chunk_signature in chunk_signatures:
-            continue
-        chunk_signatures.add(chunk_signature)
-        chunk_path = os.path.join(paths.DISK_DIR, f"{chunk_signature}.chunk")
-        if os.path.exists(chunk_path):
-            # An earlier run of this script (e.g. for a different base image)
-            # may have already created this file.
-            continue
-        with open(chunk_path, "wb+") as chunk_file:
-            chunk_file.write(chunk)
-
-    if len(chunks) > 0:
+        overlapping = []
+    for description in overlapping:
         sys.stderr.write(
-            "Chunked %s: %d%% unique chunks, %d%% zero chunks\n"
-            % (
-                image.name,
-                round(len(chunk_signatures) / len(chunks) * 100),
-                round(zero_chunk_count / len(chunks) * 100),
-            )
+            "Free space zeroing overwrote %s in %s\n" % (description, image.name)
         )
-    else:
-        sys.stderr.write("Chunked %s: 0 chunks\n" % image.name)
-
-    manifest_path = os.path.join(paths.DATA_DIR, f"{image.name}.json")
-    with open(manifest_path, "w+") as manifest_file:
-        json.dump(
-            {
-                "name": os.path.splitext(image.name)[0],
-                "totalSize": total_size,
-                "chunks": chunks,
-                "chunkSize": CHUNK_SIZE,
-            },
-            manifest_file,
-            indent=4,
+    mismatched_offsets = mismatched_blocks(image, free_ranges)
+    for block_offset in mismatched_offsets:
+        sys.stderr.write(
+            "Free space zeroing changed the %d bytes at %d in %s\n"
+            % (chunks.CHUNK_SIZE, block_offset, image.name)
         )
+    if overlapping or mismatched_offsets:
+        return False
+    sys.stderr.write(
+        "Verified %s after zeroing %d free ranges\n" % (image.name, len(free_ranges))
+    )
+    return True
 
 
 def build_system_image(
@@ -111,32 +181,42 @@ def build_system_image(
 ) -> ImageDef:
     sys.stderr.write("Building system image %s\n" % (disk.name,))
 
-    image_data = disk.read()
+    image_path = disk.image_path()
+    if image_path is None:
+        return write_image_def(bytes(), disk.name, dest_dir)
 
+    # The image is only read via a memory map, and customizations are
+    # expressed as patches, so the (potentially multi-GB) image is never
+    # copied.
     stickies_placeholder = stickies.generate_placeholder()
-    stickies_index = image_data.find(stickies_placeholder)
-    use_ttxt = False
-    if stickies_index == -1:
-        use_ttxt = True
-        stickies_placeholder = stickies.generate_ttxt_placeholder()
-        stickies_index = image_data.find(stickies_placeholder)
-    if stickies_index == -1:
-        use_ttxt = True
-        stickies_placeholder = stickies.generate_next_placeholder()
-        stickies_index = image_data.find(stickies_placeholder)
-
-    if stickies_index == -1:
+    with disks.image_buffer(image_path) as image_data:
+        placeholder = placeholders.find(
+            image_data,
+            [
+                stickies_placeholder,
+                stickies.generate_ttxt_placeholder(),
+                stickies.generate_next_placeholder(),
+            ],
+            paths=[disk.stickies_path, TTXT_PLACEHOLDER_PATH],
+        )
+
+    image_patches = []
+    if placeholder is None:
         logging.warning(
             "Placeholder file not found in disk image %s, skipping customization",
             disk.name,
         )
     else:
+        use_ttxt = placeholder.data != stickies_placeholder
         customized_stickies = copy.deepcopy(STICKIES)
         with open("CHANGELOG.md", "r") as changelog_file:
             changelog = changelog_file.read()
         if disk.welcome_sticky_override:
             customized_stickies[-1] = copy.deepcopy(disk.welcome_sticky_override)
         for sticky in customized_stickies:
+            # The build time (or SOURCE_DATE_EPOCH) when the image is built,
+            # rather than when STICKIES was defined.
+            sticky.creation_date = sticky.modification_date = builddate.now()
             sticky.text = sticky.text.replace("CHANGELOG", changelog)
             if disk.stickies_encoding == "shift_jis":
                 # Bullets are not directly representable in Shift-JIS, replace
@@ -149,27 +229,75 @@ def build_system_image(
         else:
             stickies_data = stickies_file.to_bytes(disk.stickies_encoding)
 
-        if len(stickies_data) > len(stickies_placeholder):
+        if len(stickies_data) > len(placeholder.data):
             logging.warning(
                 "Stickies file is too large (%d, placeholder is only %d), "
                 "skipping customization for %s",
                 len(stickies_data),
-                len(stickies_placeholder),
+                len(placeholder.data),
                 disk.name,
             )
         else:
             # Replace the leftover placeholder data, so that TextText does not
             # render it (not needed for Stickies since they have a length
             # field, but it doesn't hurt either).
-            image_data = (
-                image_data[:stickies_index]
-                + stickies_data
-                + disk.sticky_placeholder_overwrite_byte
-                * (len(stickies_placeholder) - len(stickies_data))
-                + image_data[stickies_index + len(stickies_placeholder) :]
+            image_patches = placeholders.patches(
+                placeholder, stickies_data, disk.sticky_placeholder_overwrite_byte
             )
 
-    return write_image_def(image_data, disk.name, dest_dir)
+    return ImageDef(disk.name, image_path, image_patches)
+
+
+# Estimate for images that have not been downloaded yet (the ones with URLs are
+# mostly large hard disk images).
+UNDOWNLOADED_IMAGE_COST = 1024 * 1024 * 1024
+# Memory that a worker uses regardless of the image: the interpreter and its
+# modules, read buffers (up to 4 MB for content-defined chunking), and chunks
+# that are being hashed and written.
+WORKER_WORKING_SET = 64 * 1024 * 1024
+
+
+def system_image_cost(disk: disks.Disk) -> int:
+    # Downloads and decompression are streamed to the cache, and the image is
+    # memory-mapped and chunked a piece at a time, so it's never all held in
+    # the worker's own memory. Its pages do end up in the page cache (a
+    # placeholder scan touches all of them, and chunking right after
+    # customization relies on them still being there), which is what the
+    # budget is for. Going over it means reading images from disk again,
+    # rather than swapping.
+    size = disk.estimated_size()
+    if size is None:
+        size = UNDOWNLOADED_IMAGE_COST
+    return size + WORKER_WORKING_SET
+
+
+@functools.cache
+def worker_stored_chunks() -> typing.Set[str]:
+    # Listed once per worker process, and kept up to date by write_chunk.
+    return chunks.list_stored_chunks()
+
+
+def build_chunked_system_image(
+    disk: disks.Disk,
+    dest_dir: str,
+    content_defined: bool,
+    zero_free_space: bool,
+    show_progress: bool,
+) -> ImageDef:
+    # Runs in a scheduler worker process. Chunking right after customization
+    # means that the image is read while it's still in the page cache.
+    image = build_system_image(disk, dest_dir)
+    chunks.write_chunked_image(
+        image.path,
+        image.name,
+        show_progress=show_progress,
+        stored_chunks=worker_stored_chunks(),
+        use_registry=True,
+        content_defined=content_defined,
+        zero_free_space=zero_free_space,
+        patches=image.patches,
+    )
+    return image
 
 
 def build_library_images(dest_dir: str) -> typing.Tuple[ImageDef, ImageDef, ImageDef]:
@@ -182,59 +310,53 @@ def build_library_images(dest_dir: str) -> typing.Tuple[ImageDef, ImageDef, Imag
     return image6_def, image_def, imageX_def
 
 
-def build_passthrough_image(
-    base_name: str, dest_dir: str, compressed: bool = False
-) -> ImageDef:
+def build_passthrough_image(base_name: str, compressed: bool = False) -> ImageDef:
     input_path = os.path.join(paths.IMAGES_DIR, base_name)
+    # Chunk the image in place (compressed images are decompressed into the
+    # cache once), it's not modified, and its stable path allows the hash
+    # registry to skip re-reading it on later runs.
     if compressed:
-        with zipfile.ZipFile(input_path + ".zip", "r") as zip:
-            image_data = zip.read(base_name)
-    else:
-        with open(input_path, "rb") as image:
-            image_data = image.read()
-    return write_image_def(image_data, base_name, dest_dir)
+        input_path = disks.decompressed_path(input_path + ".zip", base_name)
+    return ImageDef(base_name, input_path)
 
 
-def build_additional_hd_image(
-    base_name: str, readme_file: str, dest_dir: str
-) -> ImageDef:
+def build_additional_hd_image(base_name: str, readme_file: str) -> ImageDef:
     # The disk image is compressed since it's mostly empty space and we don't
     # want to pay for a lot of Git LFS storage.
-    with zipfile.ZipFile(
-        os.path.join(paths.IMAGES_DIR, base_name + ".zip"), "r"
-    ) as zip:
-        image_data = zip.read(base_name)
+    image_path = disks.decompressed_path(
+        os.path.join(paths.IMAGES_DIR, base_name + ".zip"), base_name
+    )
 
     # Also use the Stickies placeholder file to inject the Read Me
-    readme_placeholder = stickies.generate_ttxt_placeholder()
-    readme_index = image_data.find(readme_placeholder)
+    with disks.image_buffer(image_path) as image_data:
+        readme_placeholder = placeholders.find(
+            image_data,
+            [stickies.generate_ttxt_placeholder()],
+            paths=[TTXT_PLACEHOLDER_PATH],
+        )
 
-    if readme_index != -1:
+    image_patches = []
+    if readme_placeholder is not None:
         readme_data = read_strings(readme_file).replace("\n", "\r").encode("macroman")
 
-        if len(readme_data) > len(readme_placeholder):
+        if len(readme_data) > len(readme_placeholder.data):
             logging.warning(
                 "Read Me file is too large (%d, placeholder is only %d), "
                 "skipping customization for %s",
                 len(readme_data),
-                len(readme_placeholder),
+                len(readme_placeholder.data),
                 base_name,
             )
         else:
             # Replace the leftover placeholder data, so that TextText does not
             # render.
-            image_data = (
-                image_data[:readme_index]
-                + readme_data
-                + b"\x00" * (len(readme_placeholder) - len(readme_data))
-                + image_data[readme_index + len(readme_placeholder) :]
-            )
+            image_patches = placeholders.patches(readme_placeholder, readme_data)
     else:
         logging.warning(
             "Placeholder file not found in disk image %s, skipping Read Me", base_name
         )
 
-    return write_image_def(image_data, base_name, dest_dir)
+    return ImageDef(base_name, image_path, image_patches)
 
 
 def build_desktop_db6(images: typing.List[ImageDef]) -> None:
@@ -287,6 +409,145 @@ def read_strings(name: str) -> str:
         return f.read()
 
 
+class IncrementalBuild:
+    def __init__(self, enabled: bool, options: typing.List[str]):
+        self.state = buildstate.BuildState.load() if enabled else None
+        # Build options that affect the output of every image.
+        self.options = options
+        self.fingerprints: typing.Dict[str, str] = {}
+        self.skipped: typing.List[str] = []
+
+    def should_build(
+        self, names: typing.List[str], fingerprint: typing.Callable[[], str]
+    ) -> bool:
+        if not self.state:
+            return True
+        image_fingerprint = buildstate.hash_values(fingerprint(), self.options)
+        # Images that are built together (e.g. the Infinite HD variants) are
+        # rebuilt together if any of them is out of date.
+        if all(self.state.is_up_to_date(n, image_fingerprint) for n in names):
+            self.skipped.extend(names)
+            return False
+        for name in names:
+            self.fingerprints[name] = image_fingerprint
+        return True
+
+    def finish(self) -> None:
+        if not self.state:
+            return
+        self.state.update(self.fingerprints)
+        self.state.save()
+        sys.stderr.write(
+            "Incremental build: rebuilt %d images, %d were up to date\n"
+            % (len(self.fingerprints), len(self.skipped))
+        )
+
+
+def sticky_fingerprint(sticky: stickies.Sticky) -> typing.Dict[str, typing.Any]:
+    fields = dataclasses.asdict(sticky)
+    # Dates are the build time (see builddate.py), a fixed SOURCE_DATE_EPOCH is
+    # one of the build options, and the current time should not cause a
+    # rebuild on its own.
+    del fields["creation_date"]
+    del fields["modification_date"]
+    fields["style"] = sorted(s.value for s in sticky.style)
+    return fields
+
+
+@functools.cache
+def stickies_fingerprint() -> str:
+    return buildstate.hash_values(
+        buildstate.hash_files(
+            [
+                os.path.join(paths.ROOT_DIR, "CHANGELOG.md"),
+                stickies.__file__,
+                placeholders.__file__,
+                nextstep.__file__,
+                *glob.glob(os.path.join(paths.STRINGS_DIR, "*.txt")),
+            ],
+            paths.ROOT_DIR,
+        ),
+        [sticky_fingerprint(s) for s in STICKIES],
+    )
+
+
+def system_image_fingerprint(disk: disks.Disk) -> str:
+    input_path = disk.path()
+    return buildstate.hash_values(
+        "system",
+        buildstate.hash_file(input_path) if os.path.exists(input_path) else None,
+        disk.name,
+        disk.stickies_path,
+        disk.stickies_encoding,
+        (
+            sticky_fingerprint(disk.welcome_sticky_override)
+            if disk.welcome_sticky_override
+            else None
+        ),
+        disk.sticky_placeholder_overwrite_byte,
+        disk.compressed,
+        stickies_fingerprint(),
+        chunks.CHUNK_SIZE,
+    )
+
+
+def build_code_fingerprint() -> str:
+    # The code that every image goes through (this script, the chunker and
+    # the manifest post-processing steps), changes to it rebuild everything.
+    return buildstate.hash_files(
+        [
+            __file__,
+            chunks.__file__,
+            freespace.__file__,
+            packs.__file__,
+            prefetch.__file__,
+            merkle.__file__,
+            precompress.__file__,
+        ],
+        paths.ROOT_DIR,
+    )
+
+
+def library_images_fingerprint() -> str:
+    library_paths = [
+        p
+        for p in glob.iglob(os.path.join(paths.LIBRARY_DIR, "**"), recursive=True)
+        if os.path.isfile(p)
+    ]
+    return buildstate.hash_values(
+        "library",
+        buildstate.hash_files(library_paths, paths.LIBRARY_DIR),
+        buildstate.hash_files(
+            [os.path.join(paths.IMAGES_DIR, InfiniteHD.DEFAULT.value), library.__file__],
+            paths.ROOT_DIR,
+        ),
+        os.getenv("DEBUG_LIBRARY_FILTER"),
+        chunks.CHUNK_SIZE,
+    )
+
+
+def passthrough_image_fingerprint(base_name: str, compressed: bool = False) -> str:
+    input_path = os.path.join(paths.IMAGES_DIR, base_name)
+    if compressed:
+        input_path += ".zip"
+    return buildstate.hash_values(
+        "passthrough", buildstate.hash_file(input_path), chunks.CHUNK_SIZE
+    )
+
+
+def additional_hd_image_fingerprint(base_name: str, readme_file: str) -> str:
+    return buildstate.hash_values(
+        "additional_hd",
+        buildstate.hash_file(os.path.join(paths.IMAGES_DIR, base_name + ".zip")),
+        buildstate.hash_file(os.path.join(paths.STRINGS_DIR, readme_file)),
+        chunks.CHUNK_SIZE,
+    )
+
+
+# Where load-placeholder-stickies-file.py's TextText placeholder ends up on
+# disks that don't have Stickies.
+TTXT_PLACEHOLDER_PATH = ["Welcome!"]
+
 STICKIES = [
     stickies.Sticky(
         top=238,
@@ -344,67 +605,281 @@ STICKIES = [
 ]
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "minimal",
+        nargs="?",
+        choices=["minimal"],
+        help="only build classic System images",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of images to chunk in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help=(
+            "number of worker processes that customize and chunk system images "
+            "(default: same as --jobs)"
+        ),
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=scheduler.default_memory_budget() / 1024 / 1024 / 1024,
+        help=(
+            "GB of (estimated) memory that system image workers may use at "
+            "once (default: %(default).1f, half of physical memory)"
+        ),
+    )
+    parser.add_argument(
+        "--chunking",
+        choices=["fixed", "cdc"],
+        default="fixed",
+        help=(
+            "chunk system images into fixed-size chunks, or use content-defined "
+            "chunking for better deduplication across versions"
+        ),
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "only rebuild images whose inputs have changed since the last "
+            "incremental build"
+        ),
+    )
+    parser.add_argument(
+        "--zero-free-space",
+        action="store_true",
+        help=(
+            "treat unallocated HFS, HFS+ and MFS allocation blocks as zero "
+            "when chunking"
+        ),
+    )
+    parser.add_argument(
+        "--verify-free-space",
+        action="store_true",
+        help=(
+            "with --zero-free-space, check that no file or B-tree extent in "
+            "the catalog overlaps the zeroed free space, and that only free "
+            "space changed in the chunked images"
+        ),
+    )
+    parser.add_argument(
+        "--reproducible",
+        action="store_true",
+        help=(
+            "stamp images with SOURCE_DATE_EPOCH (defaulting to the time of "
+            "the last commit) instead of the current time, so that rebuilding "
+            "the same inputs produces identical chunks"
+        ),
+    )
+    parser.add_argument(
+        "--revalidate",
+        action="store_true",
+        help=(
+            "check cached downloads against the server (with conditional "
+            "requests) and download the ones that have changed again"
+        ),
+    )
+    parser.add_argument(
+        "--packs",
+        action="store_true",
+        help=(
+            "also group chunks that are read together (during boot, or that "
+            "are adjacent) into packfiles"
+        ),
+    )
+    parser.add_argument(
+        "--merkle",
+        action="store_true",
+        help=(
+            "also add a Merkle tree over the chunk signatures to each manifest "
+            "(checked by verify-disks)"
+        ),
+    )
+    parser.add_argument(
+        "--precompress",
+        choices=precompress.available_codecs(),
+        help=(
+            "also write chunk variants compressed with a dictionary trained "
+            "over all chunks (the current manifests' dictionary is reused, if "
+            "it was for the same codec)"
+        ),
+    )
+    parser.add_argument(
+        "--retrain-dictionary",
+        action="store_true",
+        help=(
+            "train a new --precompress dictionary even if there is one already "
+            "(all variants are then written and uploaded again)"
+        ),
+    )
+    args = parser.parse_args()
+    workers = args.workers if args.workers is not None else args.jobs
+    memory_budget = int(args.memory_budget * 1024 * 1024 * 1024)
+    if args.reproducible:
+        sys.stderr.write(
+            "Reproducible build, SOURCE_DATE_EPOCH=%d\n"
+            % builddate.enable_reproducible()
+        )
+    if args.revalidate:
+        urls.enable_revalidation()
+
     system_filter = os.getenv("DEBUG_SYSTEM_FILTER")
     library_filter = os.getenv("DEBUG_LIBRARY_FILTER")
 
-    minimal_mode = len(sys.argv) >= 2 and sys.argv[1] == "minimal"
+    minimal_mode = args.minimal == "minimal"
     if minimal_mode:
         system_filter = "System"  # Just classic images
 
-    if not library_filter and not system_filter:
-        shutil.rmtree(paths.DISK_DIR, ignore_errors=True)
     if not os.path.exists(paths.DISK_DIR):
         os.mkdir(paths.DISK_DIR)
 
+    incremental_build = IncrementalBuild(
+        enabled=args.incremental,
+        options=[
+            args.chunking,
+            args.zero_free_space,
+            args.packs,
+            # Packs are grouped by the prefetch lists.
+            prefetch.read_prefetch_chunks() if args.packs else None,
+            args.merkle,
+            args.precompress,
+            builddate.source_date_epoch(),
+            build_code_fingerprint(),
+        ],
+    )
+
     with tempfile.TemporaryDirectory() as temp_dir:
         images = []
+        # System images are customized and chunked by worker processes, the
+        # rest are chunked together below.
+        system_images = []
         if not library_filter:
+            system_jobs = []
             for disk in disks.ALL_DISKS:
                 if system_filter and system_filter not in disk.name:
                     if minimal_mode:
                         images.append(write_image_def(bytes(), disk.name, temp_dir))
                     continue
-                images.append(build_system_image(disk, temp_dir))
-        if not system_filter:
-            infinite_hd6_image, infinite_hd_image, infinite_hdX_image = (
-                build_library_images(temp_dir)
-            )
-            images.append(infinite_hd6_image)
-            images.append(infinite_hd_image)
-            images.append(infinite_hdX_image)
-            if not library_filter:
-                build_desktop_db6([infinite_hd6_image])
-                build_desktop_db([infinite_hd_image, infinite_hdX_image])
-
-            images.append(
-                build_passthrough_image(InfiniteHD.MFS.value, dest_dir=temp_dir)
-            )
-            images.append(
-                build_passthrough_image(
-                    InfiniteHD.NEXT.value, dest_dir=temp_dir, compressed=True
+                if not incremental_build.should_build(
+                    [disk.name], lambda: system_image_fingerprint(disk)
+                ):
+                    continue
+                system_jobs.append(
+                    scheduler.Job(
+                        disk.name,
+                        system_image_cost(disk),
+                        build_chunked_system_image,
+                        (
+                            disk,
+                            temp_dir,
+                            args.chunking == "cdc",
+                            args.zero_free_space,
+                            workers <= 1,
+                        ),
+                    )
+                )
+            try:
+                system_results, system_stats = scheduler.run_jobs(
+                    system_jobs, workers, memory_budget
+                )
+            except scheduler.JobError as e:
+                sys.stderr.write("%s\n" % e)
+                sys.exit(1)
+            system_images = [r.value for r in system_results]
+            sys.stderr.write(
+                "Built %d system images with %d worker(s) in %.1fs "
+                "(estimated peak memory use %.1f GB of a %.1f GB budget)\n"
+                % (
+                    system_stats.job_count,
+                    system_stats.workers,
+                    system_stats.elapsed,
+                    system_stats.peak_cost / 1024 / 1024 / 1024,
+                    memory_budget / 1024 / 1024 / 1024,
                 )
             )
+        if not system_filter:
+            if incremental_build.should_build(
+                [
+                    InfiniteHD.SYSTEM_6.value,
+                    InfiniteHD.DEFAULT.value,
+                    InfiniteHD.MAC_OS_X.value,
+                ],
+                library_images_fingerprint,
+            ):
+                infinite_hd6_image, infinite_hd_image, infinite_hdX_image = (
+                    build_library_images(temp_dir)
+                )
+                images.append(infinite_hd6_image)
+                images.append(infinite_hd_image)
+                images.append(infinite_hdX_image)
+                if not library_filter:
+                    build_desktop_db6([infinite_hd6_image])
+                    build_desktop_db([infinite_hd_image, infinite_hdX_image])
+
+            if incremental_build.should_build(
+                [InfiniteHD.MFS.value],
+                lambda: passthrough_image_fingerprint(InfiniteHD.MFS.value),
+            ):
+                images.append(build_passthrough_image(InfiniteHD.MFS.value))
+            if incremental_build.should_build(
+                [InfiniteHD.NEXT.value],
+                lambda: passthrough_image_fingerprint(
+                    InfiniteHD.NEXT.value, compressed=True
+                ),
+            ):
+                images.append(
+                    build_passthrough_image(InfiniteHD.NEXT.value, compressed=True)
+                )
         elif minimal_mode:
             for i in InfiniteHD:
                 if i in [InfiniteHD.DEFAULT, InfiniteHD.MFS]:
-                    images.append(build_passthrough_image(i.value, dest_dir=temp_dir))
+                    images.append(build_passthrough_image(i.value))
                 else:
                     images.append(write_image_def(bytes(), i.value, temp_dir))
 
-        images.append(
-            build_additional_hd_image(
-                "Saved HD.dsk",
-                "saved-hd.txt",
-                dest_dir=temp_dir,
-            )
+        for base_name, readme_file in [
+            ("Saved HD.dsk", "saved-hd.txt"),
+            ("The Outside World.dsk", "the-outside-world.txt"),
+        ]:
+            if not incremental_build.should_build(
+                [base_name],
+                lambda: additional_hd_image_fingerprint(base_name, readme_file),
+            ):
+                continue
+            images.append(build_additional_hd_image(base_name, readme_file))
+
+        write_chunked_images(
+            images,
+            jobs=args.jobs,
+            # Persistent disks (e.g. Saved HD) rely on fixed-size chunks, only
+            # system images use content-defined chunking.
+            content_defined_names=(
+                {d.name for d in disks.ALL_DISKS} if args.chunking == "cdc" else set()
+            ),
+            zero_free_space=args.zero_free_space,
         )
-        images.append(
-            build_additional_hd_image(
-                "The Outside World.dsk",
-                "the-outside-world.txt",
-                dest_dir=temp_dir,
+        images = system_images + images
+        if args.zero_free_space and args.verify_free_space:
+            if not all([verify_free_space(i) for i in images]):
+                sys.exit(1)
+        if args.packs:
+            packs.write_packs([i.name for i in images])
+        if args.merkle:
+            merkle.write_trees([i.name for i in images])
+        if args.precompress:
+            precompress.write_compressed_chunks(
+                args.precompress,
+                jobs=args.jobs,
+                retrain_dictionary=args.retrain_dictionary,
             )
-        )
+        incremental_build.finish()
 
-        for image in images:
-            write_chunked_image(image)
+    cache.enforce_max_size(inputs.pinned_cache_paths(), sys.stderr.write)
@@ -0,0 +1,86 @@
+# Everything that the build scripts download: the src_urls of Library/ and
+# CD-ROMs/ manifests (and CD-ROM cover images), and system disk images. Used
+# to prefetch them all at once, and to pin them in the download cache.
+
+import disks
+import glob
+import json
+import os
+import paths
+import typing
+import urls
+
+
+class Input(typing.NamedTuple):
+    url: str
+    # Whether only the response headers are needed (CD-ROMs that are not
+    # self-hosted are served from their original URL).
+    headers: bool
+    # Manifest or disk that references the URL.
+    source: str
+    # Expected SHA-256 digest of the download, if declared.
+    sha256: typing.Optional[str] = None
+
+    def is_cached(self) -> bool:
+        return os.path.exists(urls.url_cache_path(self.url, self.headers)) or bool(
+            self.sha256 and os.path.exists(urls.blob_path(self.sha256))
+        )
+
+
+def read_manifests(
+    manifests_dir: str, exclude_dir: typing.Optional[str] = None
+) -> typing.Iterator[typing.Tuple[str, typing.Dict[str, typing.Any]]]:
+    for manifest_path in sorted(
+        glob.iglob(os.path.join(manifests_dir, "**", "*.json"), recursive=True)
+    ):
+        if exclude_dir and manifest_path.startswith(exclude_dir + os.sep):
+            continue
+        with open(manifest_path, "r") as manifest_file:
+            yield os.path.relpath(manifest_path, paths.ROOT_DIR), json.load(
+                manifest_file
+            )
+
+
+def library_inputs() -> typing.Iterator[Input]:
+    for source, manifest in read_manifests(paths.LIBRARY_DIR):
+        if "src_url" in manifest:
+            yield Input(manifest["src_url"], False, source, manifest.get("src_sha256"))
+
+
+def cd_rom_inputs() -> typing.Iterator[Input]:
+    # Mirrors what import-cd-roms.py reads.
+    for source, manifest in read_manifests(paths.CD_ROMS_DIR, paths.CD_ROMS_BUILD_DIR):
+        if "src_url" in manifest:
+            yield Input(manifest["src_url"], not manifest.get("is_floppy"), source)
+        if "cover_image" in manifest:
+            yield Input(manifest["cover_image"], False, source)
+
+
+def disk_inputs() -> typing.Iterator[Input]:
+    for disk in disks.ALL_DISKS:
+        for url in disk.urls:
+            # Multi-part images only have a digest for the whole image.
+            sha256 = disk.sha256 if len(disk.urls) == 1 else None
+            yield Input(url, False, disk.name, sha256)
+
+
+def all_inputs() -> typing.Iterator[Input]:
+    yield from library_inputs()
+    yield from cd_rom_inputs()
+    yield from disk_inputs()
+
+
+def pinned_cache_paths() -> typing.Iterator[str]:
+    # Paths in the cache directory that the current manifests and disks are
+    # read from, including concatenated and decompressed images.
+    for i in all_inputs():
+        yield urls.url_cache_path(i.url, i.headers)
+        if i.sha256:
+            yield urls.blob_path(i.sha256)
+    for disk in disks.ALL_DISKS:
+        yield from disk.cache_paths()
+    # Passthrough and additional images that are compressed in Images/.
+    for zip_path in glob.iglob(os.path.join(paths.IMAGES_DIR, "*.zip")):
+        yield disks.decompressed_cache_path(
+            zip_path, os.path.basename(zip_path).removesuffix(".zip")
+        )
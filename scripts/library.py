@@ -1,3 +1,4 @@
+import builddate
 import copy
 import datetime
 import glob
@@ -13,7 +14,6 @@ import struct
 import subprocess
 import sys
 import tempfile
-import time
 import typing
 import unicodedata
 import urls
@@ -135,7 +135,10 @@ def import_manifest(manifest_json: typing.Dict[str, typing.Any]) -> machfs.Folde
 
 def import_disk_image(manifest_json: typing.Dict[str, typing.Any]) -> machfs.Folder:
     return import_disk_image_data(
-        urls.read_url_to_path(manifest_json["src_url"]), manifest_json
+        urls.read_url_to_path(
+            manifest_json["src_url"], sha256=manifest_json.get("src_sha256")
+        ),
+        manifest_json,
     )
 
 
@@ -179,7 +182,9 @@ def import_archive(manifest_json: typing.Dict[str, typing.Any]) -> machfs.Folder
         return name
 
     src_url = manifest_json["src_url"]
-    archive_path = urls.read_url_to_path(src_url)
+    archive_path = urls.read_url_to_path(
+        src_url, sha256=manifest_json.get("src_sha256")
+    )
     root_folder = machfs.Folder()
     with tempfile.TemporaryDirectory() as tmp_dir_path:
         unar_code = subprocess.call(
@@ -387,7 +392,7 @@ def update_file_or_folder_from_lsar_entry(
         # the way they represent timezones.
         date_str = date_str.replace(" +0000", " +00:00")
         parsed = datetime.datetime.fromisoformat(date_str)
-        t = int(max(min(time.time(), parsed.timestamp()), 0))
+        t = int(max(min(builddate.timestamp(), parsed.timestamp()), 0))
         # 2082844800 is the number of seconds between the Mac epoch (January 1 1904)
         # and the Unix epoch (January 1 1970). See
         # http://justsolve.archiveteam.org/wiki/HFS/HFS%2B_timestamp
@@ -402,7 +407,9 @@ def update_file_or_folder_from_lsar_entry(
 
 def import_dmg(manifest_json: typing.Dict[str, typing.Any]) -> machfs.Folder:
     src_url = manifest_json["src_url"]
-    archive_path = urls.read_url_to_path(src_url)
+    archive_path = urls.read_url_to_path(
+        src_url, sha256=manifest_json.get("src_sha256")
+    )
     root_folder = machfs.Folder()
     import_dmg_folder(manifest_json, archive_path, root_folder)
     return root_folder
@@ -36,9 +36,9 @@ if __name__ == "__main__":
 
         print("Wrote Stickies to disk image %s" % output_path)
 
-        # Booth with Speed Disk so that disks can be de-fragmented after the
-        # placeholder file is copied onto them -- that ensures that it's written
-        # as a contiguous chunk.
+        # Boot with Speed Disk (the placeholder file no longer needs to be
+        # de-fragmented after it is copied, import-disks.py finds its extents
+        # via the HFS catalog, but it's a convenient bootable disk for a IIci).
         speed_disk_path = os.path.join(paths.IMAGES_DIR,
                                        "Speed Disk 3.1.3.dsk")
 
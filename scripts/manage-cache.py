@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import argparse
+import cache
+import inputs
+import paths
+import sys
+import time
+import typing
+
+KINDS = ["download", "headers", "decompressed", "incomplete"]
+
+
+def format_size(size: int) -> str:
+    if size >= 1024 * 1024 * 1024:
+        return "%.1f GB" % (size / 1024 / 1024 / 1024)
+    return "%.1f MB" % (size / 1024 / 1024)
+
+
+def format_age(last_access: float) -> str:
+    age = time.time() - last_access
+    if age < 60 * 60:
+        return "%dm ago" % (age // 60)
+    if age < 24 * 60 * 60:
+        return "%dh ago" % (age // (60 * 60))
+    return "%dd ago" % (age // (24 * 60 * 60))
+
+
+def format_hit_rate(hits: int, misses: int) -> str:
+    if not hits + misses:
+        return "-"
+    return "%.0f%% (%d/%d)" % (100 * hits / (hits + misses), hits, hits + misses)
+
+
+def stats(top: int, max_size: typing.Optional[int]) -> None:
+    entries = cache.list_entries()
+    pinned_paths = list(inputs.pinned_cache_paths())
+    pinned_names = cache.pinned_names(pinned_paths)
+    candidates = cache.eviction_candidates(entries, pinned_paths)
+    total_size = sum(e.size for e in entries)
+    print(
+        "%s: %d entries, %s" % (paths.CACHE_DIR, len(entries), format_size(total_size))
+    )
+    if max_size is not None:
+        print("Size limit: %s" % format_size(max_size))
+
+    # Hit rates are from all recorded accesses, including to entries that have
+    # since been evicted.
+    accesses = cache.recorded_accesses()
+    print()
+    print("%-13s %8s %10s  %s" % ("", "Entries", "Size", "Hit rate"))
+    for kind in KINDS:
+        kind_entries = [e for e in entries if e.kind == kind]
+        kind_accesses = [a for n, a in accesses.items() if cache.entry_kind(n) == kind]
+        print(
+            "%-13s %8d %10s  %s"
+            % (
+                kind,
+                len(kind_entries),
+                format_size(sum(e.size for e in kind_entries)),
+                format_hit_rate(
+                    sum(a[1] for a in kind_accesses), sum(a[2] for a in kind_accesses)
+                ),
+            )
+        )
+    print(
+        "%-13s %8s %10s  %s"
+        % (
+            "all",
+            "",
+            "",
+            format_hit_rate(
+                sum(a[1] for a in accesses.values()),
+                sum(a[2] for a in accesses.values()),
+            ),
+        )
+    )
+
+    print()
+    print("Largest entries:")
+    for entry in sorted(entries, key=lambda e: e.size, reverse=True)[:top]:
+        print(
+            "  %10s  %-9s %-13s %-10s %s"
+            % (
+                format_size(entry.size),
+                format_age(entry.last_access),
+                entry.kind,
+                "pinned" if cache.is_pinned(entry, pinned_names) else "",
+                entry.name,
+            )
+        )
+
+    print()
+    print(
+        "Reclaimable (not used by the current manifests and disks): %d entries, %s"
+        % (len(candidates), format_size(sum(e.size for e in candidates)))
+    )
+    if max_size is not None:
+        result = cache.evict(max_size, pinned_paths, dry_run=True)
+        print(
+            "Evicting down to the size limit would remove %d entries (%s)"
+            % (len(result.evicted), format_size(result.evicted_size))
+        )
+
+
+def evict(max_size: int, dry_run: bool) -> None:
+    result = cache.evict(max_size, inputs.pinned_cache_paths(), dry_run=dry_run)
+    for entry in result.evicted:
+        sys.stderr.write(
+            "%s %s (%s, last used %s)\n"
+            % (
+                "Would evict" if dry_run else "Evicted",
+                entry.name,
+                format_size(entry.size),
+                format_age(entry.last_access),
+            )
+        )
+    sys.stderr.write(
+        "%s %d entries (%s), %s remain\n"
+        % (
+            "Would evict" if dry_run else "Evicted",
+            len(result.evicted),
+            format_size(result.evicted_size),
+            format_size(result.remaining_size),
+        )
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Report on and trim the download cache (%s). Entries that the "
+            "current Library/ and CD-ROMs/ manifests and system disks use are "
+            "pinned and never evicted." % paths.CACHE_DIR
+        )
+    )
+    max_size_parser = argparse.ArgumentParser(add_help=False)
+    max_size_parser.add_argument(
+        "--max-size",
+        type=float,
+        metavar="GB",
+        help="size limit (default: $%s, if set)" % cache.MAX_SIZE_ENV,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    stats_parser = subparsers.add_parser(
+        "stats",
+        parents=[max_size_parser],
+        help="report hit rates, the largest entries and reclaimable bytes",
+    )
+    stats_parser.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="number of largest entries to list (default: %(default)s)",
+    )
+    evict_parser = subparsers.add_parser(
+        "evict",
+        parents=[max_size_parser],
+        help="evict least recently used, unpinned entries down to the size limit",
+    )
+    evict_parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report what would be evicted",
+    )
+    args = parser.parse_args()
+    if args.max_size is not None:
+        max_size: typing.Optional[int] = int(args.max_size * 1024 * 1024 * 1024)
+    else:
+        max_size = cache.max_size()
+
+    if args.command == "stats":
+        stats(args.top, max_size)
+    elif args.command == "evict":
+        if max_size is None:
+            parser.error("--max-size or $%s is required" % cache.MAX_SIZE_ENV)
+        evict(max_size, args.dry_run)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+# Compact binary encoding of chunked disk manifests (as written by
+# chunks.write_manifest). JSON manifests spend 34+ bytes per chunk on a quoted
+# hex signature (plus indentation), and list zero chunks one by one, which adds
+# up for large, mostly empty images.
+#
+# Layout (all integers are little-endian, varints are unsigned LEB128):
+#
+#   header:  magic "IMCM", version (u8), flags (u8), chunk size (u32),
+#            total size (u64), chunk count (varint), name length (varint), name
+#   runs:    until chunk count chunks have been described, each run is a tag
+#            byte and a varint count followed by:
+#              RUN_ZERO:    nothing (count zero chunks)
+#              RUN_LITERAL: count 16-byte signatures
+#              RUN_REPEAT:  one 16-byte signature, repeated count times
+#   starts:  if FLAG_CHUNK_STARTS is set, chunk count - 1 varint deltas between
+#            consecutive chunk starts (the first chunk always starts at 0)
+#   extra:   if FLAG_EXTRA is set, a varint length and a JSON object with any
+#            other manifest fields (e.g. "compression")
+#
+# decode() returns the same object that json.load() would for the equivalent
+# JSON manifest, so the two formats can be used interchangeably.
+
+import json
+import struct
+import typing
+
+MAGIC = b"IMCM"
+VERSION = 1
+
+FLAG_CHUNK_STARTS = 1 << 0
+FLAG_EXTRA = 1 << 1
+
+RUN_ZERO = 0
+RUN_LITERAL = 1
+RUN_REPEAT = 2
+
+SIGNATURE_SIZE = 16
+# Runs of identical chunks shorter than this are cheaper to keep in a literal
+# run than to split it.
+MIN_REPEAT_RUN = 3
+
+_HEADER = struct.Struct("<4sBBIQ")
+_KNOWN_FIELDS = {"name", "totalSize", "chunks", "chunkSize", "chunkStarts"}
+
+
+def _write_varint(output: bytearray, value: int) -> None:
+    while value >= 0x80:
+        output.append((value & 0x7F) | 0x80)
+        value >>= 7
+    output.append(value)
+
+
+def _read_varint(data: bytes, offset: int) -> typing.Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _iter_runs(
+    chunks: typing.List[str],
+) -> typing.Iterator[typing.Tuple[int, typing.List[str]]]:
+    i = 0
+    literal_start = 0
+    while i < len(chunks):
+        signature = chunks[i]
+        run_end = i + 1
+        while run_end < len(chunks) and chunks[run_end] == signature:
+            run_end += 1
+        if signature == "" or run_end - i >= MIN_REPEAT_RUN:
+            if literal_start < i:
+                yield RUN_LITERAL, chunks[literal_start:i]
+            yield (RUN_ZERO if signature == "" else RUN_REPEAT), chunks[i:run_end]
+            literal_start = run_end
+        i = run_end
+    if literal_start < len(chunks):
+        yield RUN_LITERAL, chunks[literal_start:]
+
+
+def encode(manifest: typing.Dict[str, typing.Any]) -> bytes:
+    chunks = manifest["chunks"]
+    chunk_starts = manifest.get("chunkStarts")
+    extra = {k: v for k, v in manifest.items() if k not in _KNOWN_FIELDS}
+    flags = 0
+    if chunk_starts is not None:
+        flags |= FLAG_CHUNK_STARTS
+    if extra:
+        flags |= FLAG_EXTRA
+
+    output = bytearray(
+        _HEADER.pack(
+            MAGIC, VERSION, flags, manifest["chunkSize"], manifest["totalSize"]
+        )
+    )
+    _write_varint(output, len(chunks))
+    name = manifest["name"].encode("utf-8")
+    _write_varint(output, len(name))
+    output += name
+
+    for run_type, run in _iter_runs(chunks):
+        output.append(run_type)
+        _write_varint(output, len(run))
+        if run_type == RUN_LITERAL:
+            output += bytes.fromhex("".join(run))
+        elif run_type == RUN_REPEAT:
+            output += bytes.fromhex(run[0])
+
+    if chunk_starts is not None:
+        if len(chunk_starts) != len(chunks) or (chunk_starts and chunk_starts[0]):
+            raise ValueError("chunkStarts does not match chunks")
+        for previous, start in zip(chunk_starts, chunk_starts[1:]):
+            _write_varint(output, start - previous)
+
+    if extra:
+        extra_json = json.dumps(extra, separators=(",", ":")).encode("utf-8")
+        _write_varint(output, len(extra_json))
+        output += extra_json
+    return bytes(output)
+
+
+def is_binary(data: bytes) -> bool:
+    return data[: len(MAGIC)] == MAGIC
+
+
+def decode(data: bytes) -> typing.Dict[str, typing.Any]:
+    magic, version, flags, chunk_size, total_size = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a binary manifest")
+    if version != VERSION:
+        raise ValueError("Unsupported binary manifest version %d" % version)
+    offset = _HEADER.size
+    chunk_count, offset = _read_varint(data, offset)
+    name_length, offset = _read_varint(data, offset)
+    name = data[offset : offset + name_length].decode("utf-8")
+    offset += name_length
+
+    chunks: typing.List[str] = []
+    while len(chunks) < chunk_count:
+        run_type = data[offset]
+        run_length, offset = _read_varint(data, offset + 1)
+        if run_type == RUN_ZERO:
+            chunks += [""] * run_length
+        elif run_type == RUN_LITERAL:
+            end = offset + run_length * SIGNATURE_SIZE
+            hex_signatures = data[offset:end].hex()
+            chunks += [
+                hex_signatures[i : i + SIGNATURE_SIZE * 2]
+                for i in range(0, len(hex_signatures), SIGNATURE_SIZE * 2)
+            ]
+            offset = end
+        elif run_type == RUN_REPEAT:
+            end = offset + SIGNATURE_SIZE
+            chunks += [data[offset:end].hex()] * run_length
+            offset = end
+        else:
+            raise ValueError("Unknown run type %d" % run_type)
+    if len(chunks) != chunk_count:
+        raise ValueError("Runs do not match chunk count")
+
+    # Same key order as chunks.write_manifest, so that re-serializing to JSON
+    # produces an identical file.
+    manifest: typing.Dict[str, typing.Any] = {
+        "name": name,
+        "totalSize": total_size,
+        "chunks": chunks,
+        "chunkSize": chunk_size,
+    }
+    if flags & FLAG_CHUNK_STARTS:
+        chunk_starts = [0] if chunk_count else []
+        for _ in range(chunk_count - 1):
+            delta, offset = _read_varint(data, offset)
+            chunk_starts.append(chunk_starts[-1] + delta)
+        manifest["chunkStarts"] = chunk_starts
+    if flags & FLAG_EXTRA:
+        extra_length, offset = _read_varint(data, offset)
+        manifest.update(json.loads(data[offset : offset + extra_length]))
+    return manifest
+
+
+def read_manifest(path: str) -> typing.Dict[str, typing.Any]:
+    # Accepts either format.
+    with open(path, "rb") as manifest_file:
+        data = manifest_file.read()
+    if is_binary(data):
+        return decode(data)
+    return json.loads(data)
+
+
+def write_binary_manifest(path: str, manifest: typing.Dict[str, typing.Any]) -> None:
+    with open(path, "wb") as manifest_file:
+        manifest_file.write(encode(manifest))
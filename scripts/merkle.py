@@ -0,0 +1,117 @@
+# Merkle trees over the chunk lists of disk manifests, so that a whole image
+# (or a range of its chunks, e.g. the ones that a client has cached) can be
+# checked against a single hash. Leaves are derived from the chunk signatures
+# (which are themselves content hashes), so a tree can be computed from a
+# manifest without reading any chunk data:
+#
+#   leaf:     blake2b(0x00 || signature bytes), zero chunks have no signature
+#   interior: blake2b(0x01 || left || right)
+#
+# Levels are built by pairing consecutive nodes, an odd node at the end of a
+# level is promoted unchanged. The node at level L, index i is thus the root of
+# the subtree over chunks [i * 2^L, (i + 1) * 2^L).
+#
+# The tree is stored in the manifest as:
+#
+#   "merkle": {"root": <hex>, "span": <chunks per node>, "nodes": [<hex>, ...]}
+#
+# where nodes are the interior nodes at the level that covers span chunks
+# each. The root can be recomputed from them, and each node can be checked
+# independently against the chunks that it covers. Storing every level would
+# roughly double the size of the manifest.
+
+import hashlib
+import json
+import os
+import paths
+import sys
+import typing
+
+DIGEST_SIZE = 16
+LEAF_PREFIX = b"\0"
+NODE_PREFIX = b"\1"
+# 64 chunks (16 MB with fixed-size chunks) per stored node.
+DEFAULT_SPAN = 64
+
+
+def leaf_hash(signature: str) -> bytes:
+    return hashlib.blake2b(
+        LEAF_PREFIX + bytes.fromhex(signature), digest_size=DIGEST_SIZE
+    ).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.blake2b(NODE_PREFIX + left + right, digest_size=DIGEST_SIZE).digest()
+
+
+def parent_level(level: typing.List[bytes]) -> typing.List[bytes]:
+    parents = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        parents.append(level[-1])
+    return parents
+
+
+def root_of(level: typing.List[bytes]) -> bytes:
+    if not level:
+        return leaf_hash("")
+    while len(level) > 1:
+        level = parent_level(level)
+    return level[0]
+
+
+def span_nodes(chunk_list: typing.List[str], span: int) -> typing.List[bytes]:
+    # Nodes at the level where each one covers span chunks (span must be a
+    # power of two).
+    level = [leaf_hash(c) for c in chunk_list]
+    while span > 1 and len(level) > 1:
+        level = parent_level(level)
+        span //= 2
+    return level
+
+
+def build_tree(
+    chunk_list: typing.List[str], span: int = DEFAULT_SPAN
+) -> typing.Dict[str, typing.Any]:
+    nodes = span_nodes(chunk_list, span)
+    return {
+        "root": root_of(nodes).hex(),
+        "span": span,
+        "nodes": [n.hex() for n in nodes],
+    }
+
+
+def check_tree(manifest: typing.Dict[str, typing.Any]) -> typing.List[int]:
+    # Returns the indexes of stored nodes that don't match the chunk list (or
+    # [-1] if the root doesn't match the stored nodes).
+    tree = manifest["merkle"]
+    nodes = [bytes.fromhex(n) for n in tree["nodes"]]
+    if root_of(nodes).hex() != tree["root"]:
+        return [-1]
+    expected_nodes = span_nodes(manifest["chunks"], tree["span"])
+    if len(expected_nodes) != len(nodes):
+        return [-1]
+    return [i for i, (a, b) in enumerate(zip(nodes, expected_nodes)) if a != b]
+
+
+def write_trees(
+    names: typing.Optional[typing.Iterable[str]] = None,
+    manifest_dir: str = paths.DATA_DIR,
+    span: int = DEFAULT_SPAN,
+) -> None:
+    # Adds trees to the manifests of the images with the given names (or all
+    # generated manifests).
+    if names is None:
+        manifest_paths = sorted(
+            os.path.join(manifest_dir, f)
+            for f in os.listdir(manifest_dir)
+            if f.endswith(".dsk.json")
+        )
+    else:
+        manifest_paths = [os.path.join(manifest_dir, f"{n}.json") for n in names]
+    for manifest_path in manifest_paths:
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        manifest["merkle"] = build_tree(manifest["chunks"], span)
+        with open(manifest_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+    sys.stderr.write("Added Merkle trees to %d manifests\n" % len(manifest_paths))
@@ -132,24 +132,62 @@ NEXTSTEP_ENCODING_MAP ={
     0xfffd: 0xff,
 }
 
+NEXTSTEP_DECODING_MAP = {b: u for u, b in NEXTSTEP_ENCODING_MAP.items()}
+
+# 256-character table in the format of the standard library's charmap codecs
+# (see e.g. encodings/mac_roman.py), undefined bytes are U+FFFE. Encoding and
+# decoding then happen in C, instead of a character at a time in Python.
+DECODING_TABLE = "".join(
+    chr(b) if b < 0x80 else chr(NEXTSTEP_DECODING_MAP.get(b, 0xFFFE))
+    for b in range(256)
+)
+ENCODING_TABLE = codecs.charmap_build(DECODING_TABLE)
+
+
 def nextstep_encode(input, errors="strict"):
-    result = bytearray()
-    for char in input:
-        u = ord(char)
-        if u < 0x80:
-            result.append(u)
-        elif u in NEXTSTEP_ENCODING_MAP:
-            result.append(NEXTSTEP_ENCODING_MAP[u])
-        else:
-            raise UnicodeEncodeError("nextstep", char, 0, 1, "character not in encoding")
-    return bytes(result), len(result)
-
-NEXTSTEP_CODEC_INFO = codecs.CodecInfo(encode=nextstep_encode, decode=None)
+    return codecs.charmap_encode(input, errors, ENCODING_TABLE)
+
+
+def nextstep_decode(input, errors="strict"):
+    return codecs.charmap_decode(input, errors, DECODING_TABLE)
+
+
+class IncrementalEncoder(codecs.IncrementalEncoder):
+    def encode(self, input, final=False):
+        return codecs.charmap_encode(input, self.errors, ENCODING_TABLE)[0]
+
+
+class IncrementalDecoder(codecs.IncrementalDecoder):
+    def decode(self, input, final=False):
+        return codecs.charmap_decode(input, self.errors, DECODING_TABLE)[0]
+
+
+class StreamWriter(codecs.StreamWriter):
+    def encode(self, input, errors="strict"):
+        return nextstep_encode(input, errors)
+
+
+class StreamReader(codecs.StreamReader):
+    def decode(self, input, errors="strict"):
+        return nextstep_decode(input, errors)
+
+
+NEXTSTEP_CODEC_INFO = codecs.CodecInfo(
+    name="nextstep",
+    encode=nextstep_encode,
+    decode=nextstep_decode,
+    incrementalencoder=IncrementalEncoder,
+    incrementaldecoder=IncrementalDecoder,
+    streamwriter=StreamWriter,
+    streamreader=StreamReader,
+)
+
 
 def nextstep_search_function(encoding):
     if encoding == "nextstep":
         return NEXTSTEP_CODEC_INFO
     return None
 
+
 def register_nextstep_codec():
     codecs.register(nextstep_search_function)
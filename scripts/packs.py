@@ -0,0 +1,229 @@
+# Packfiles group chunks that are usually read together, so that they can be
+# fetched with a single request instead of one (blocking) request per chunk.
+# Each image gets:
+#
+#   - boot packs, with the image's prefetchChunks (in prefetch order, and
+#     mapped to the manifest's chunks if they are content-defined), split so
+#     that no pack is larger than BOOT_PACK_MAX_SIZE
+#   - adjacency packs, with runs of consecutive non-zero chunks that are not in
+#     a boot pack, of up to ADJACENT_PACK_MAX_SIZE
+#
+# Chunks that would end up in a pack of their own are left unpacked. Packs are
+# written as {pack id}.pack next to the individual chunks (which are kept, so
+# clients can still fetch chunks one at a time), where the pack id is derived
+# from the signatures of its chunks. A chunk that is shared between images may
+# be in more than one pack.
+#
+# The pack index is stored in the manifest:
+#
+#   "packs": [<pack id>, ...],
+#   "chunkPacks": [[<index into packs>, <offset>, <length>] or null, ...]
+#
+# chunkPacks has one entry per entry in "chunks" (null for zero and unpacked
+# chunks).
+
+import chunks
+import hashlib
+import json
+import os
+import paths
+import prefetch
+import sys
+import tempfile
+import typing
+
+BOOT_PACK_MAX_SIZE = 4 * 1024 * 1024
+ADJACENT_PACK_MAX_SIZE = 1024 * 1024
+PACK_ID_SALT = b"pack"
+
+
+class Pack(typing.NamedTuple):
+    # Indexes into the manifest's chunk list, in pack order.
+    chunk_indexes: typing.List[int]
+    size: int
+    is_boot: bool
+
+
+def chunk_sizes(
+    manifest: typing.Dict[str, typing.Any], chunk_dir: str = paths.DISK_DIR
+) -> typing.Dict[str, int]:
+    sizes = {}
+    for signature in set(manifest["chunks"]):
+        if not signature:
+            continue
+        try:
+            sizes[signature] = os.path.getsize(chunks.chunk_path(signature, chunk_dir))
+        except FileNotFoundError:
+            # Only matters for simulations, write_pack needs the chunk itself.
+            sizes[signature] = manifest["chunkSize"]
+    return sizes
+
+
+def group_chunks(
+    chunk_list: typing.List[str],
+    sizes: typing.Dict[str, int],
+    prefetch_chunks: typing.List[int],
+    boot_pack_max_size: int = BOOT_PACK_MAX_SIZE,
+    adjacent_pack_max_size: int = ADJACENT_PACK_MAX_SIZE,
+) -> typing.List[Pack]:
+    packs = []
+
+    def add_group(indexes: typing.List[int], size: int, is_boot: bool) -> None:
+        if len(indexes) > 1:
+            packs.append(Pack(indexes, size, is_boot))
+
+    boot_indexes = []
+    boot_set = set()
+    for i in prefetch_chunks:
+        if i < len(chunk_list) and chunk_list[i] and i not in boot_set:
+            boot_indexes.append(i)
+            boot_set.add(i)
+    group: typing.List[int] = []
+    group_size = 0
+    for i in boot_indexes:
+        size = sizes[chunk_list[i]]
+        if group and group_size + size > boot_pack_max_size:
+            add_group(group, group_size, is_boot=True)
+            group, group_size = [], 0
+        group.append(i)
+        group_size += size
+    add_group(group, group_size, is_boot=True)
+
+    group, group_size = [], 0
+    for i, signature in enumerate(chunk_list):
+        if not signature or i in boot_set:
+            add_group(group, group_size, is_boot=False)
+            group, group_size = [], 0
+            continue
+        size = sizes[signature]
+        if group and group_size + size > adjacent_pack_max_size:
+            add_group(group, group_size, is_boot=False)
+            group, group_size = [], 0
+        group.append(i)
+        group_size += size
+    add_group(group, group_size, is_boot=False)
+    return packs
+
+
+def pack_id(chunk_list: typing.List[str], pack: Pack) -> str:
+    digest = hashlib.blake2b(digest_size=16, salt=PACK_ID_SALT)
+    for i in pack.chunk_indexes:
+        digest.update(bytes.fromhex(chunk_list[i]))
+    return digest.hexdigest()
+
+
+def write_pack(
+    pack_name: str,
+    chunk_list: typing.List[str],
+    pack: Pack,
+    chunk_dir: str = paths.DISK_DIR,
+) -> bool:
+    path = os.path.join(chunk_dir, f"{pack_name}.pack")
+    if os.path.exists(path):
+        return False
+    with tempfile.NamedTemporaryFile(
+        dir=chunk_dir, prefix=f".{pack_name}.", suffix=".tmp", delete=False
+    ) as pack_file:
+        for i in pack.chunk_indexes:
+            with open(chunks.chunk_path(chunk_list[i], chunk_dir), "rb") as f:
+                pack_file.write(f.read())
+    chunks.replace_temp_file(pack_file.name, path)
+    return True
+
+
+def build_pack_index(
+    chunk_list: typing.List[str],
+    sizes: typing.Dict[str, int],
+    packs: typing.List[Pack],
+) -> typing.Tuple[typing.List[str], typing.List[typing.Optional[typing.List[int]]]]:
+    pack_names = []
+    chunk_packs: typing.List[typing.Optional[typing.List[int]]] = [None] * len(
+        chunk_list
+    )
+    for pack in packs:
+        pack_index = len(pack_names)
+        pack_names.append(pack_id(chunk_list, pack))
+        offset = 0
+        for i in pack.chunk_indexes:
+            size = sizes[chunk_list[i]]
+            chunk_packs[i] = [pack_index, offset, size]
+            offset += size
+    return pack_names, chunk_packs
+
+
+def write_packs(
+    names: typing.Optional[typing.Iterable[str]] = None,
+    chunk_dir: str = paths.DISK_DIR,
+    manifest_dir: str = paths.DATA_DIR,
+) -> None:
+    # Packs the images with the given names (or all generated manifests), and
+    # adds the pack index to their manifests.
+    if names is None:
+        manifest_paths = sorted(
+            os.path.join(manifest_dir, f)
+            for f in os.listdir(manifest_dir)
+            if f.endswith(".dsk.json")
+        )
+    else:
+        manifest_paths = [os.path.join(manifest_dir, f"{n}.json") for n in names]
+    all_prefetch_chunks = prefetch.read_prefetch_chunks()
+    pack_count = 0
+    new_pack_count = 0
+    pack_size = 0
+    for manifest_path in manifest_paths:
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        chunk_list = manifest["chunks"]
+        sizes = chunk_sizes(manifest, chunk_dir)
+        prefetch_chunks = prefetch.manifest_chunk_indexes(
+            manifest, all_prefetch_chunks.get(manifest["name"], [])
+        )
+        packs = group_chunks(chunk_list, sizes, prefetch_chunks)
+        pack_names, chunk_packs = build_pack_index(chunk_list, sizes, packs)
+        for pack_name, pack in zip(pack_names, packs):
+            if write_pack(pack_name, chunk_list, pack, chunk_dir):
+                new_pack_count += 1
+            pack_size += pack.size
+        pack_count += len(packs)
+        if packs:
+            manifest["packs"] = pack_names
+            manifest["chunkPacks"] = chunk_packs
+        else:
+            manifest.pop("packs", None)
+            manifest.pop("chunkPacks", None)
+        with open(manifest_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+    sys.stderr.write(
+        "Packed %d manifests into %d packs (%d new, %.1f MB)\n"
+        % (len(manifest_paths), pack_count, new_pack_count, pack_size / 1024 / 1024)
+    )
+
+
+def count_requests(
+    chunk_list: typing.List[str],
+    sizes: typing.Dict[str, int],
+    packs: typing.List[Pack],
+    accessed_chunks: typing.Iterable[int],
+) -> typing.Tuple[int, int]:
+    # Number of requests and bytes transferred to read the given chunks, if
+    # any chunk in a pack is read by fetching the whole pack.
+    pack_by_chunk = {}
+    for pack_index, pack in enumerate(packs):
+        for i in pack.chunk_indexes:
+            pack_by_chunk[i] = pack_index
+    fetched_packs = set()
+    request_count = 0
+    fetched_size = 0
+    for i in set(accessed_chunks):
+        if i >= len(chunk_list) or not chunk_list[i]:
+            continue
+        if i in pack_by_chunk:
+            pack_index = pack_by_chunk[i]
+            if pack_index in fetched_packs:
+                continue
+            fetched_packs.add(pack_index)
+            fetched_size += packs[pack_index].size
+        else:
+            fetched_size += sizes[chunk_list[i]]
+        request_count += 1
+    return request_count, fetched_size
@@ -6,10 +6,14 @@ LIBRARY_DIR = os.path.join(ROOT_DIR, "Library")
 CD_ROMS_DIR = os.path.join(ROOT_DIR, "CD-ROMs")
 CD_ROMS_BUILD_DIR = os.path.join(CD_ROMS_DIR, "build")
 DISK_DIR = os.path.join(ROOT_DIR, "Images", "build")
+BUILD_STATE_PATH = os.path.join(DISK_DIR, "build-state.json")
 COVERS_DIR = os.path.join(ROOT_DIR, "public", "Covers")
 DATA_DIR = os.path.join(ROOT_DIR, "src", "Data")
 STRINGS_DIR = os.path.join(ROOT_DIR, "scripts", "strings")
 CACHE_DIR = os.path.expanduser(os.path.join("~", ".infinite-mac-cache"))
+HASH_REGISTRY_PATH = os.path.join(CACHE_DIR, "hashes.sqlite")
+DECOMPRESSED_DIR = os.path.join(CACHE_DIR, "decompressed")
+BLOBS_DIR = os.path.join(CACHE_DIR, "blobs")
 XADMASTER_PATH = os.path.join(ROOT_DIR, "XADMaster-build", "Release")
 UNAR_PATH = os.path.join(XADMASTER_PATH, "unar")
 LSAR_PATH = os.path.join(XADMASTER_PATH, "lsar")
@@ -0,0 +1,464 @@
+# Locates the placeholder files (see load-placeholder-stickies-file.py) in
+# system disk images, so that they can be replaced with customized contents
+# (as patches that are applied when the image is chunked).
+#
+# For HFS and HFS+ volumes (bare, or in an Apple partition map) the file is
+# looked up by path in the catalog B-tree, and its data fork extents (including
+# any in the extents overflow B-tree) are resolved, so it doesn't need to be
+# contiguous. Anything else (e.g. the NeXT UFS disks), or a file that is not
+# where it's expected, falls back to a single pass over the image that looks
+# for all placeholders at once.
+#
+# The same catalog walk also lists every allocated extent of a volume, so that
+# free space zeroing (see freespace.py, which uses the allocation bitmap) can
+# be checked against it.
+
+import bisect
+import freespace
+import struct
+import typing
+import unicodedata
+
+# All placeholders contain this, the scan only needs to look for it and then
+# check which placeholder (if any) surrounds it.
+SCAN_ANCHOR = b"Placeholder "
+
+HFS_ROOT_FOLDER_ID = 2
+HFS_FOLDER_RECORD = 1
+HFS_FILE_RECORD = 2
+HFS_DATA_FORK = 0
+HFS_RESOURCE_FORK = 0xFF
+BTREE_LEAF_NODE = 0xFF
+
+# (offset, length) byte ranges in the image, in file order.
+Extents = typing.List[typing.Tuple[int, int]]
+# (description, offset, length) of allocated byte ranges in the image.
+AllocatedExtents = typing.List[typing.Tuple[str, int, int]]
+
+
+class Placeholder(typing.NamedTuple):
+    # The placeholder contents that were found (one of the candidates).
+    data: bytes
+    extents: Extents
+
+
+def _pascal_name(data: bytes, offset: int) -> str:
+    length = data[offset]
+    return data[offset + 1 : offset + 1 + length].decode("mac_roman").lower()
+
+
+def _unicode_name(data: bytes, offset: int) -> str:
+    length = struct.unpack_from(">H", data, offset)[0]
+    name = data[offset + 2 : offset + 2 + length * 2].decode("utf-16-be")
+    return unicodedata.normalize("NFD", name).casefold()
+
+
+def _read_extents(image_data: bytes, extents: Extents) -> bytes:
+    return b"".join(image_data[start : start + length] for start, length in extents)
+
+
+class _Volume:
+    # The parts of an HFS or HFS+ volume that are needed to look up a file.
+    def __init__(self, image_data: bytes, volume_offset: int, header: bytes):
+        self.image_data = image_data
+        self.header = header
+        self._entries = None
+        self.is_plus = header[:2] in freespace.HFS_PLUS_SIGNATURES
+        if self.is_plus:
+            self.block_size = struct.unpack_from(">I", header, 40)[0]
+            self.blocks_offset = volume_offset
+            extents_fork, catalog_fork = header[192:272], header[272:352]
+            self.extents_file = self._read_fork(
+                self._fork_extents(extents_fork, 16, ">II", 8),
+                struct.unpack_from(">Q", extents_fork)[0],
+            )
+            self.catalog_file = self._read_fork(
+                self._fork_extents(catalog_fork, 16, ">II", 8),
+                struct.unpack_from(">Q", catalog_fork)[0],
+            )
+        else:
+            self.block_size = struct.unpack_from(">I", header, 20)[0]
+            first_block_sector = struct.unpack_from(">H", header, 28)[0]
+            self.blocks_offset = volume_offset + first_block_sector * 512
+            self.extents_file = self._read_fork(
+                self._fork_extents(header, 134, ">HH", 3),
+                struct.unpack_from(">I", header, 130)[0],
+            )
+            self.catalog_file = self._read_fork(
+                self._fork_extents(header, 150, ">HH", 3),
+                struct.unpack_from(">I", header, 146)[0],
+            )
+
+    @staticmethod
+    def _fork_extents(
+        data: bytes, offset: int, extent_format: str, count: int
+    ) -> typing.List[typing.Tuple[int, int]]:
+        extent_size = struct.calcsize(extent_format)
+        return [
+            struct.unpack_from(extent_format, data, offset + i * extent_size)
+            for i in range(count)
+        ]
+
+    def byte_extents(
+        self, block_extents: typing.List[typing.Tuple[int, int]], length: int
+    ) -> Extents:
+        # Converts allocation block extents to byte ranges in the image,
+        # truncated to the logical length of the fork.
+        extents = []
+        for start, count in block_extents:
+            if length <= 0:
+                break
+            if not count:
+                continue
+            extent_length = min(count * self.block_size, length)
+            extents.append(
+                (self.blocks_offset + start * self.block_size, extent_length)
+            )
+            length -= extent_length
+        if length > 0:
+            raise ValueError("Fork extends past its extents")
+        return extents
+
+    def _read_fork(
+        self, block_extents: typing.List[typing.Tuple[int, int]], length: int
+    ) -> bytes:
+        # The B-tree files themselves are assumed not to need the extents
+        # overflow file (byte_extents raises if they do).
+        return _read_extents(self.image_data, self.byte_extents(block_extents, length))
+
+    def _leaf_records(
+        self, btree_file: bytes
+    ) -> typing.Iterator[typing.Tuple[bytes, int, int]]:
+        # Yields (node, key offset, record offset) for every leaf record.
+        first_leaf = struct.unpack_from(">I", btree_file, 24)[0]
+        node_size = struct.unpack_from(">H", btree_file, 32)[0]
+        node_index = first_leaf
+        visited = set()
+        while node_index and node_index not in visited:
+            visited.add(node_index)
+            node = btree_file[node_index * node_size : (node_index + 1) * node_size]
+            if len(node) < node_size or node[8] != BTREE_LEAF_NODE:
+                break
+            next_node = struct.unpack_from(">I", node)[0]
+            record_count = struct.unpack_from(">H", node, 10)[0]
+            for i in range(record_count):
+                key_offset = struct.unpack_from(">H", node, node_size - 2 * (i + 1))[0]
+                if self.is_plus:
+                    key_length = struct.unpack_from(">H", node, key_offset)[0] + 2
+                else:
+                    # HFS keys are padded to an even length.
+                    key_length = (node[key_offset] + 2) & ~1
+                yield node, key_offset, key_offset + key_length
+            node_index = next_node
+
+    def _catalog_entries(
+        self,
+    ) -> typing.Dict[typing.Tuple[int, str], typing.Tuple[int, bytes, int]]:
+        # (parent ID, name) to (record type, node, record offset) of every
+        # file and folder.
+        if self._entries is not None:
+            return self._entries
+        entries = {}
+        for node, key_offset, record_offset in self._leaf_records(self.catalog_file):
+            parent_id = struct.unpack_from(">I", node, key_offset + 2)[0]
+            if self.is_plus:
+                name = _unicode_name(node, key_offset + 6)
+                record_type = struct.unpack_from(">H", node, record_offset)[0]
+            else:
+                name = _pascal_name(node, key_offset + 6)
+                record_type = node[record_offset]
+            if record_type in (HFS_FOLDER_RECORD, HFS_FILE_RECORD):
+                entries[(parent_id, name)] = (record_type, node, record_offset)
+        self._entries = entries
+        return entries
+
+    def find_file(self, path: typing.List[str]) -> typing.Optional[Extents]:
+        # Returns the data fork extents of the file at the given path (relative
+        # to the root folder).
+        entries = self._catalog_entries()
+
+        parent_id = HFS_ROOT_FOLDER_ID
+        for i, component in enumerate(path):
+            if self.is_plus:
+                component = unicodedata.normalize("NFD", component).casefold()
+            else:
+                component = component.lower()
+            entry = entries.get((parent_id, component))
+            if entry is None:
+                return None
+            record_type, node, record_offset = entry
+            is_last = i == len(path) - 1
+            if not is_last:
+                if record_type != HFS_FOLDER_RECORD:
+                    return None
+                parent_id = struct.unpack_from(
+                    ">I", node, record_offset + (8 if self.is_plus else 6)
+                )[0]
+                continue
+            if record_type != HFS_FILE_RECORD:
+                return None
+            if self.is_plus:
+                file_id = struct.unpack_from(">I", node, record_offset + 8)[0]
+                fork = node[record_offset + 88 : record_offset + 168]
+                length = struct.unpack_from(">Q", fork)[0]
+                block_extents = self._fork_extents(fork, 16, ">II", 8)
+            else:
+                file_id = struct.unpack_from(">I", node, record_offset + 20)[0]
+                length = struct.unpack_from(">I", node, record_offset + 26)[0]
+                block_extents = self._fork_extents(node, record_offset + 74, ">HH", 3)
+            block_count = sum(count for _, count in block_extents)
+            if block_count * self.block_size < length:
+                block_extents += self._overflow_extents(file_id, block_count)
+            return self.byte_extents(block_extents, length)
+        return None
+
+    def _overflow_extents(
+        self, file_id: int, start_block: int
+    ) -> typing.List[typing.Tuple[int, int]]:
+        # Extents of the data fork past the ones in the catalog record, in
+        # order of their starting (file-relative) block.
+        records = []
+        for node, key_offset, record_offset in self._leaf_records(self.extents_file):
+            if self.is_plus:
+                fork_type, key_file_id, key_start_block = struct.unpack_from(
+                    ">BxII", node, key_offset + 2
+                )
+                extent_format, extent_count = ">II", 8
+            else:
+                fork_type, key_file_id, key_start_block = struct.unpack_from(
+                    ">BIH", node, key_offset + 1
+                )
+                extent_format, extent_count = ">HH", 3
+            if (
+                fork_type == HFS_DATA_FORK
+                and key_file_id == file_id
+                and key_start_block >= start_block
+            ):
+                records.append(
+                    (
+                        key_start_block,
+                        self._fork_extents(
+                            node, record_offset, extent_format, extent_count
+                        ),
+                    )
+                )
+        return [extent for _, extents in sorted(records) for extent in extents]
+
+    def _block_extents(
+        self, description: str, block_extents: typing.List[typing.Tuple[int, int]]
+    ) -> AllocatedExtents:
+        # All allocated blocks, regardless of the fork's logical length.
+        return [
+            (
+                description,
+                self.blocks_offset + start * self.block_size,
+                count * self.block_size,
+            )
+            for start, count in block_extents
+            if count
+        ]
+
+    def allocated_extents(self) -> AllocatedExtents:
+        # The special files (B-trees, and the allocation, attributes and
+        # startup files of HFS+), the forks of every file in the catalog and
+        # every extents overflow record.
+        extents = []
+        if self.is_plus:
+            for name, offset in [
+                ("allocation file", 112),
+                ("extents file", 192),
+                ("catalog file", 272),
+                ("attributes file", 352),
+                ("startup file", 432),
+            ]:
+                extents += self._block_extents(
+                    name, self._fork_extents(self.header, offset + 16, ">II", 8)
+                )
+        else:
+            extents += self._block_extents(
+                "extents file", self._fork_extents(self.header, 134, ">HH", 3)
+            )
+            extents += self._block_extents(
+                "catalog file", self._fork_extents(self.header, 150, ">HH", 3)
+            )
+
+        for node, key_offset, record_offset in self._leaf_records(self.catalog_file):
+            if self.is_plus:
+                if struct.unpack_from(">H", node, record_offset)[0] != HFS_FILE_RECORD:
+                    continue
+                file_id = struct.unpack_from(">I", node, record_offset + 8)[0]
+                forks = [
+                    ("data", node[record_offset + 88 : record_offset + 168]),
+                    ("resource", node[record_offset + 168 : record_offset + 248]),
+                ]
+                for fork_name, fork in forks:
+                    extents += self._block_extents(
+                        "file %d %s fork" % (file_id, fork_name),
+                        self._fork_extents(fork, 16, ">II", 8),
+                    )
+            else:
+                if node[record_offset] != HFS_FILE_RECORD:
+                    continue
+                file_id = struct.unpack_from(">I", node, record_offset + 20)[0]
+                for fork_name, offset in [("data", 74), ("resource", 86)]:
+                    extents += self._block_extents(
+                        "file %d %s fork" % (file_id, fork_name),
+                        self._fork_extents(node, record_offset + offset, ">HH", 3),
+                    )
+
+        for node, key_offset, record_offset in self._leaf_records(self.extents_file):
+            if self.is_plus:
+                fork_type, file_id = struct.unpack_from(">BxI", node, key_offset + 2)
+                extent_format, extent_count = ">II", 8
+            else:
+                fork_type, file_id = struct.unpack_from(">BI", node, key_offset + 1)
+                extent_format, extent_count = ">HH", 3
+            extents += self._block_extents(
+                "file %d %s fork (overflow)"
+                % (file_id, "resource" if fork_type == HFS_RESOURCE_FORK else "data"),
+                self._fork_extents(node, record_offset, extent_format, extent_count),
+            )
+        return extents
+
+
+def _volume_offsets(image_data: bytes) -> typing.List[int]:
+    # Offsets of the HFS partitions in an Apple partition map, or just the
+    # start of the image if there is no partition map.
+    if image_data[:2] != b"ER" or image_data[512:514] != b"PM":
+        return [0]
+    offsets = []
+    entry_count = struct.unpack_from(">I", image_data, 512 + 4)[0]
+    for i in range(entry_count):
+        entry = image_data[(i + 1) * 512 : (i + 2) * 512]
+        if entry[:2] != b"PM":
+            break
+        if entry[48:80].split(b"\0", 1)[0] == b"Apple_HFS":
+            offsets.append(struct.unpack_from(">I", entry, 8)[0] * 512)
+    return offsets
+
+
+def _volumes(image_data: bytes) -> typing.Iterator[_Volume]:
+    for volume_offset in _volume_offsets(image_data):
+        header_offset = volume_offset + freespace.MDB_OFFSET
+        header = bytes(image_data[header_offset : header_offset + 512])
+        signature = header[:2]
+        if signature == freespace.HFS_SIGNATURE and (
+            header[0x7C:0x7E] in freespace.HFS_PLUS_SIGNATURES
+        ):
+            # HFS wrapper around an HFS+ volume.
+            block_size = struct.unpack_from(">I", header, 20)[0]
+            first_block_sector = struct.unpack_from(">H", header, 28)[0]
+            embedded_start = struct.unpack_from(">H", header, 0x7E)[0]
+            volume_offset += first_block_sector * 512 + embedded_start * block_size
+            header_offset = volume_offset + freespace.MDB_OFFSET
+            header = bytes(image_data[header_offset : header_offset + 512])
+            signature = header[:2]
+        if signature == freespace.HFS_SIGNATURE or (
+            signature in freespace.HFS_PLUS_SIGNATURES
+        ):
+            yield _Volume(image_data, volume_offset, header)
+
+
+def find_in_catalog(
+    image_data: bytes,
+    paths: typing.Sequence[typing.List[str]],
+    candidates: typing.List[bytes],
+) -> typing.Optional[Placeholder]:
+    # Returns the placeholder at the first of the paths that has one.
+    for volume in _volumes(image_data):
+        for path in paths:
+            try:
+                extents = volume.find_file(path)
+            except (struct.error, IndexError, ValueError, UnicodeDecodeError):
+                # Truncated or corrupted catalog, leave it to the scan.
+                break
+            if extents is None:
+                continue
+            contents = _read_extents(image_data, extents)
+            for candidate in candidates:
+                if contents.startswith(candidate):
+                    return Placeholder(candidate, extents)
+    return None
+
+
+def allocated_extents(image_data: bytes) -> typing.Optional[AllocatedExtents]:
+    # Allocated extents of all HFS and HFS+ volumes in the image, or None if
+    # there are none.
+    volumes = list(_volumes(image_data))
+    if not volumes:
+        return None
+    return [extent for volume in volumes for extent in volume.allocated_extents()]
+
+
+def allocated_in(
+    image_data: bytes, ranges: freespace.Ranges
+) -> typing.Optional[typing.List[str]]:
+    # Descriptions of the allocated extents that overlap any of the (sorted)
+    # ranges, or None if the image has no HFS or HFS+ volumes.
+    extents = allocated_extents(image_data)
+    if extents is None:
+        return None
+    range_ends = [end for _, end in ranges]
+    overlapping = []
+    for description, offset, length in extents:
+        i = bisect.bisect_right(range_ends, offset)
+        if i < len(ranges) and ranges[i][0] < offset + length:
+            overlapping.append(description)
+    return overlapping
+
+
+def scan(
+    image_data: bytes, candidates: typing.List[bytes]
+) -> typing.Optional[Placeholder]:
+    # Finds the first occurrence of the first candidate (in priority order)
+    # that is in the image, in a single pass. Candidates need to be contiguous
+    # in the image.
+    anchor_offsets = [c.index(SCAN_ANCHOR) for c in candidates]
+    found: typing.Dict[int, int] = {}
+    position = image_data.find(SCAN_ANCHOR)
+    while position != -1 and 0 not in found:
+        for i, (candidate, anchor_offset) in enumerate(zip(candidates, anchor_offsets)):
+            start = position - anchor_offset
+            if (
+                i not in found
+                and start >= 0
+                and image_data[start : start + len(candidate)] == candidate
+            ):
+                found[i] = start
+        position = image_data.find(SCAN_ANCHOR, position + 1)
+    if not found:
+        return None
+    i = min(found)
+    return Placeholder(candidates[i], [(found[i], len(candidates[i]))])
+
+
+def find(
+    image_data: bytes,
+    candidates: typing.List[bytes],
+    paths: typing.Sequence[typing.List[str]] = (),
+) -> typing.Optional[Placeholder]:
+    # Candidates are in priority order, paths are where they're expected to
+    # be (any of them may be missing).
+    if paths:
+        placeholder = find_in_catalog(image_data, paths, candidates)
+        if placeholder:
+            return placeholder
+    return scan(image_data, candidates)
+
+
+def patches(
+    placeholder: Placeholder, data: bytes, fill_byte: bytes = b"\x00"
+) -> typing.List[typing.Tuple[int, bytes]]:
+    # (offset, data) edits that replace the placeholder, the remainder is
+    # filled with fill_byte. The caller is responsible for data not being
+    # larger than the placeholder.
+    contents = data + fill_byte * (len(placeholder.data) - len(data))
+    edits = []
+    offset = 0
+    for start, length in placeholder.extents:
+        length = min(length, len(contents) - offset)
+        if length <= 0:
+            break
+        edits.append((start, contents[offset : offset + length]))
+        offset += length
+    return sorted(edits)
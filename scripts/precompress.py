@@ -0,0 +1,330 @@
+# Pre-compressed variants of disk chunks. A dictionary is trained over a sample
+# of all chunks referenced by the manifests in src/Data, and every chunk is
+# compressed with it. The many small HFS metadata-heavy chunks (catalog and
+# extents B-tree nodes, resource forks) share a lot of structure that on-the-fly
+# CDN compression can't take advantage of, since it sees one chunk at a time.
+#
+# Variants are written next to the raw chunks as {signature}.{dictionary}.{codec}
+# and the dictionary itself as {dictionary}.dict, so that a dictionary change
+# never leaves a variant that was compressed with a different dictionary under
+# the same name. Manifests record the codec and dictionary that were used.
+#
+# The dictionary that the current manifests use is reused by later builds
+# (unless retraining is requested), since a new one changes the names of all
+# variants, which then all have to be written and uploaded again.
+
+import chunks
+import collections
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import paths
+import sys
+import tempfile
+import time
+import typing
+import zlib
+
+try:
+    from compression import zstd  # Python 3.14+
+except ImportError:
+    zstd = None
+
+# Deflate can only refer back 32K, so a larger dictionary is not useful.
+DEFLATE_DICTIONARY_SIZE = 32 * 1024
+ZSTD_DICTIONARY_SIZE = 112 * 1024
+ZSTD_LEVEL = 19
+# Number of chunks that the dictionary is trained over. They are picked evenly
+# from the sorted signature list, so that the same chunk set always produces
+# the same dictionary (and thus the same variant names).
+SAMPLE_CHUNK_COUNT = 256
+# Granularity at which recurring data is found when building a deflate
+# dictionary.
+SEGMENT_SIZE = 64
+
+
+def available_codecs() -> typing.List[str]:
+    codecs = ["deflate"]
+    if zstd is not None:
+        codecs.append("zstd")
+    return codecs
+
+
+class Dictionary(typing.NamedTuple):
+    codec: str
+    id: str
+    data: bytes
+
+
+class CompressionStats(typing.NamedTuple):
+    chunk_count: int
+    raw_stored_size: int
+    compressed_stored_size: int
+    raw_transferred_size: int
+    compressed_transferred_size: int
+
+
+def manifest_paths(manifest_dir: str = paths.DATA_DIR) -> typing.List[str]:
+    return sorted(glob.glob(os.path.join(manifest_dir, "*.dsk.json")))
+
+
+def variant_path(
+    signature: str, dictionary: Dictionary, chunk_dir: str = paths.DISK_DIR
+) -> str:
+    return os.path.join(chunk_dir, f"{signature}.{dictionary.id}.{dictionary.codec}")
+
+
+def read_chunk(signature: str, chunk_dir: str = paths.DISK_DIR) -> bytes:
+    with open(chunks.chunk_path(signature, chunk_dir), "rb") as chunk_file:
+        return chunk_file.read()
+
+
+def sample_signatures(signatures: typing.List[str]) -> typing.List[str]:
+    if len(signatures) <= SAMPLE_CHUNK_COUNT:
+        return signatures
+    step = len(signatures) / SAMPLE_CHUNK_COUNT
+    return [signatures[int(i * step)] for i in range(SAMPLE_CHUNK_COUNT)]
+
+
+def train_deflate_dictionary(samples: typing.Iterable[bytes]) -> bytes:
+    # zlib has no dictionary trainer, approximate one by finding the aligned
+    # segments that occur in the most chunks (repetition within a single chunk
+    # is already handled by the compressor itself). Deflate encodes closer
+    # matches more cheaply, and the end of the dictionary is closest to the
+    # data, so the most common segments go last.
+    zero_segment = bytes(SEGMENT_SIZE)
+    counts: typing.Counter[bytes] = collections.Counter()
+    for sample in samples:
+        counts.update(
+            set(
+                sample[i : i + SEGMENT_SIZE]
+                for i in range(0, len(sample) - SEGMENT_SIZE + 1, SEGMENT_SIZE)
+            )
+        )
+    counts.pop(zero_segment, None)
+    segments = [
+        segment
+        for segment, count in counts.most_common(
+            DEFLATE_DICTIONARY_SIZE // SEGMENT_SIZE
+        )
+        if count > 1
+    ]
+    return b"".join(reversed(segments))
+
+
+def dictionary_path(dictionary_id: str, chunk_dir: str = paths.DISK_DIR) -> str:
+    return os.path.join(chunk_dir, f"{dictionary_id}.dict")
+
+
+def existing_dictionary(
+    codec: str,
+    manifests: typing.Iterable[typing.Dict[str, typing.Any]],
+    chunk_dir: str = paths.DISK_DIR,
+) -> typing.Optional[Dictionary]:
+    # The dictionary that most manifests were compressed with, if it's still
+    # stored.
+    counts = collections.Counter(
+        manifest["compression"]["dictionary"]
+        for manifest in manifests
+        if manifest.get("compression", {}).get("codec") == codec
+    )
+    for dictionary_id, _ in counts.most_common():
+        try:
+            with open(dictionary_path(dictionary_id, chunk_dir), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            continue
+        if hashlib.sha256(data).hexdigest()[:16] == dictionary_id:
+            return Dictionary(codec, dictionary_id, data)
+    return None
+
+
+def train_dictionary(
+    codec: str, signatures: typing.List[str], chunk_dir: str = paths.DISK_DIR
+) -> Dictionary:
+    samples = (read_chunk(s, chunk_dir) for s in sample_signatures(signatures))
+    if codec == "zstd":
+        data = zstd.train_dict(list(samples), ZSTD_DICTIONARY_SIZE).dict_content
+    else:
+        data = train_deflate_dictionary(samples)
+    return Dictionary(codec, hashlib.sha256(data).hexdigest()[:16], data)
+
+
+def compress_chunk(
+    chunk: bytes, dictionary: typing.Optional[Dictionary], codec: str
+) -> bytes:
+    if codec == "zstd":
+        zstd_dict = zstd.ZstdDict(dictionary.data) if dictionary else None
+        return zstd.compress(chunk, level=ZSTD_LEVEL, zstd_dict=zstd_dict)
+    # Raw deflate, the dictionary is identified by the manifest, so the zlib
+    # header (and its dictionary checksum) would be redundant.
+    if dictionary:
+        compressor = zlib.compressobj(
+            9, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary.data
+        )
+    else:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(chunk) + compressor.flush()
+
+
+def write_variant(
+    signature: str, dictionary: Dictionary, chunk_dir: str = paths.DISK_DIR
+) -> int:
+    path = variant_path(signature, dictionary, chunk_dir)
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        pass
+    compressed = compress_chunk(
+        read_chunk(signature, chunk_dir), dictionary, dictionary.codec
+    )
+    with tempfile.NamedTemporaryFile(
+        dir=chunk_dir, prefix=f".{signature}.", suffix=".tmp", delete=False
+    ) as variant_file:
+        variant_file.write(compressed)
+    chunks.replace_temp_file(variant_file.name, path)
+    return len(compressed)
+
+
+def write_dictionary(dictionary: Dictionary, chunk_dir: str = paths.DISK_DIR) -> None:
+    # Renamed into place like chunks, so that an interrupted run doesn't leave
+    # a truncated dictionary behind.
+    with tempfile.NamedTemporaryFile(
+        dir=chunk_dir, prefix=f".{dictionary.id}.", suffix=".tmp", delete=False
+    ) as dictionary_file:
+        dictionary_file.write(dictionary.data)
+    chunks.replace_temp_file(
+        dictionary_file.name, dictionary_path(dictionary.id, chunk_dir)
+    )
+
+
+def log_dictionary_gain(
+    dictionary: Dictionary,
+    signatures: typing.List[str],
+    chunk_dir: str,
+    trained: bool,
+) -> None:
+    # Compares against compressing the same codec without a dictionary, which
+    # is roughly what the CDN does with chunks today.
+    raw_size = 0
+    plain_size = 0
+    dictionary_size = 0
+    for signature in sample_signatures(signatures):
+        chunk = read_chunk(signature, chunk_dir)
+        raw_size += len(chunk)
+        plain_size += len(compress_chunk(chunk, None, dictionary.codec))
+        dictionary_size += len(compress_chunk(chunk, dictionary, dictionary.codec))
+    if not raw_size:
+        return
+    sys.stderr.write(
+        "%s %s dictionary %s (%d bytes): sampled chunks compress to %.1f%% "
+        "without it, %.1f%% with it\n"
+        % (
+            "Trained" if trained else "Reusing",
+            dictionary.codec,
+            dictionary.id,
+            len(dictionary.data),
+            plain_size / raw_size * 100,
+            dictionary_size / raw_size * 100,
+        )
+    )
+
+
+def write_compressed_chunks(
+    codec: str,
+    jobs: int = 1,
+    chunk_dir: str = paths.DISK_DIR,
+    manifest_dir: str = paths.DATA_DIR,
+    retrain_dictionary: bool = False,
+) -> CompressionStats:
+    start_time = time.monotonic()
+    manifests = {}
+    for manifest_path in manifest_paths(manifest_dir):
+        with open(manifest_path, "r") as manifest_file:
+            manifests[manifest_path] = json.load(manifest_file)
+    stored_chunks = chunks.list_stored_chunks(chunk_dir)
+    signatures = sorted(
+        set(
+            signature
+            for manifest in manifests.values()
+            for signature in manifest["chunks"]
+            # Manifests of images that were not built in this run (e.g. when
+            # using a filter) may refer to chunks that are not available.
+            if signature and signature in stored_chunks
+        )
+    )
+
+    dictionary = None
+    if not retrain_dictionary:
+        dictionary = existing_dictionary(codec, manifests.values(), chunk_dir)
+    trained = dictionary is None
+    if dictionary is None:
+        dictionary = train_dictionary(codec, signatures, chunk_dir)
+        write_dictionary(dictionary, chunk_dir)
+    log_dictionary_gain(dictionary, signatures, chunk_dir, trained)
+
+    # zlib and zstd release the GIL while compressing.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        compressed_sizes = dict(
+            zip(
+                signatures,
+                executor.map(
+                    lambda s: write_variant(s, dictionary, chunk_dir), signatures
+                ),
+            )
+        )
+    raw_sizes = {
+        s: os.path.getsize(chunks.chunk_path(s, chunk_dir)) for s in signatures
+    }
+
+    raw_transferred_size = 0
+    compressed_transferred_size = 0
+    for manifest_path, manifest in manifests.items():
+        manifest_signatures = [c for c in manifest["chunks"] if c]
+        if not all(s in compressed_sizes for s in manifest_signatures):
+            manifest.pop("compression", None)
+        else:
+            manifest["compression"] = {
+                "codec": dictionary.codec,
+                "dictionary": dictionary.id,
+            }
+            raw_transferred_size += sum(raw_sizes[s] for s in manifest_signatures)
+            compressed_transferred_size += sum(
+                compressed_sizes[s] for s in manifest_signatures
+            )
+        with open(manifest_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+
+    stats = CompressionStats(
+        chunk_count=len(signatures),
+        raw_stored_size=sum(raw_sizes.values()),
+        compressed_stored_size=sum(compressed_sizes.values()) + len(dictionary.data),
+        raw_transferred_size=raw_transferred_size,
+        compressed_transferred_size=compressed_transferred_size,
+    )
+    log_compression_stats(stats, time.monotonic() - start_time)
+    return stats
+
+
+def log_compression_stats(stats: CompressionStats, elapsed: float) -> None:
+    # Variants (and the dictionary) are stored in addition to the raw chunks,
+    # so they only save transfer, not storage.
+    sys.stderr.write(
+        "Compressed %d chunks in %.1fs\n"
+        "  stored: %.1f MB of raw chunks, %.1f MB (%.1f%%) added\n"
+        "  transferred: %.1f MB -> %.1f MB, %.1f MB saved\n"
+        % (
+            stats.chunk_count,
+            elapsed,
+            stats.raw_stored_size / 1024 / 1024,
+            stats.compressed_stored_size / 1024 / 1024,
+            stats.compressed_stored_size / max(stats.raw_stored_size, 1) * 100,
+            stats.raw_transferred_size / 1024 / 1024,
+            stats.compressed_transferred_size / 1024 / 1024,
+            (stats.raw_transferred_size - stats.compressed_transferred_size)
+            / 1024
+            / 1024,
+        )
+    )
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import argparse
+import cache
+import concurrent.futures
+import inputs
+import os
+import registry
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+import urls
+
+
+def format_mb(size: int) -> str:
+    return "%.1f MB" % (size / 1024 / 1024)
+
+
+def prefetch_all(pending: typing.List[inputs.Input], jobs: int, per_host: int) -> bool:
+    # Downloads for a host are queued on its own executor (so that a slow host
+    # only holds up its own downloads), and all of them share the global
+    # limit. Returns whether all of them succeeded.
+    inputs_by_host: typing.Dict[str, typing.List[inputs.Input]] = {}
+    for i in pending:
+        inputs_by_host.setdefault(urllib.parse.urlsplit(i.url).netloc, []).append(i)
+    pool = urls.ConnectionPool()
+    download_slots = threading.BoundedSemaphore(max(jobs, 1))
+
+    def prefetch(i: inputs.Input) -> typing.Optional[int]:
+        # Returns the downloaded size, or None if the cached copy was still
+        # valid.
+        downloaded = False
+
+        def on_cache_miss() -> None:
+            nonlocal downloaded
+            downloaded = True
+
+        with download_slots:
+            cache_path = urls.read_url_to_path(
+                i.url,
+                headers=i.headers,
+                on_cache_miss=on_cache_miss,
+                pool=pool,
+                sha256=i.sha256,
+            )
+        return os.path.getsize(cache_path) if downloaded else None
+
+    start_time = time.monotonic()
+    executors = []
+    futures: typing.Dict[concurrent.futures.Future, inputs.Input] = {}
+    for host_inputs in inputs_by_host.values():
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(min(per_host, len(host_inputs)), 1)
+        )
+        executors.append(executor)
+        for i in host_inputs:
+            futures[executor.submit(prefetch, i)] = i
+
+    downloaded_size = 0
+    failures: typing.List[typing.Tuple[inputs.Input, Exception]] = []
+    try:
+        for done_count, future in enumerate(
+            concurrent.futures.as_completed(futures), start=1
+        ):
+            i = futures[future]
+            try:
+                size = future.result()
+            except Exception as e:
+                failures.append((i, e))
+                status = "failed: %s" % e
+            else:
+                if size is None:
+                    status = "unchanged"
+                else:
+                    downloaded_size += size
+                    status = "headers" if i.headers else format_mb(size)
+            sys.stderr.write(
+                "[%d/%d] %s (%s)\n" % (done_count, len(futures), i.url, status)
+            )
+    finally:
+        for executor in executors:
+            executor.shutdown(cancel_futures=True)
+        pool.close()
+
+    elapsed = time.monotonic() - start_time
+    sys.stderr.write(
+        "Prefetched %d URLs (%s) from %d hosts in %.1fs, %d failed\n"
+        % (
+            len(futures) - len(failures),
+            format_mb(downloaded_size),
+            len(inputs_by_host),
+            elapsed,
+            len(failures),
+        )
+    )
+    for i, e in failures:
+        print("%s (%s): %s" % (i.url, i.source, e))
+    return not failures
+
+
+def print_digests(all_inputs: typing.Iterable[inputs.Input]) -> None:
+    # Digests of cached downloads that don't declare one yet, to add to
+    # disks.py (sha256) or Library/ manifests (src_sha256).
+    for i in all_inputs:
+        if i.headers or i.sha256:
+            continue
+        cache_path = urls.url_cache_path(i.url)
+        if os.path.exists(cache_path):
+            print("%s  %s (%s)" % (registry.hash_file(cache_path), i.url, i.source))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Download every URL that the build scripts read (Library/ and "
+            "CD-ROMs/ manifests, and system disk images) into the cache "
+            "directory concurrently, so that builds only see cache hits."
+        )
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=16,
+        help="number of concurrent downloads (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=4,
+        help="number of concurrent downloads per host (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--only",
+        choices=["library", "cd-roms", "disks"],
+        action="append",
+        help="only prefetch these inputs (can be repeated)",
+    )
+    parser.add_argument(
+        "--revalidate",
+        action="store_true",
+        help=(
+            "also check already cached URLs against the server, and download "
+            "the ones that have changed again"
+        ),
+    )
+    parser.add_argument(
+        "--print-digests",
+        action="store_true",
+        help=(
+            "print the SHA-256 digests of cached downloads that don't declare "
+            "one (for disks.py and Library/ manifests)"
+        ),
+    )
+    args = parser.parse_args()
+    if args.revalidate:
+        urls.enable_revalidation()
+
+    input_sources = {
+        "library": inputs.library_inputs,
+        "cd-roms": inputs.cd_rom_inputs,
+        "disks": inputs.disk_inputs,
+    }
+    unique_inputs: typing.Dict[typing.Tuple[str, bool], inputs.Input] = {}
+    for name, get_inputs in input_sources.items():
+        if args.only and name not in args.only:
+            continue
+        for i in get_inputs():
+            unique_inputs.setdefault((i.url, i.headers), i)
+    pending = [
+        i for i in unique_inputs.values() if args.revalidate or not i.is_cached()
+    ]
+    if args.revalidate:
+        sys.stderr.write("Prefetching and revalidating %d URLs\n" % len(pending))
+    else:
+        sys.stderr.write(
+            "Prefetching %d URLs (%d already cached)\n"
+            % (len(pending), len(unique_inputs) - len(pending))
+        )
+
+    succeeded = prefetch_all(pending, args.jobs, args.per_host) if pending else True
+    if args.print_digests:
+        print_digests(unique_inputs.values())
+    cache.enforce_max_size(inputs.pinned_cache_paths(), sys.stderr.write)
+    return 0 if succeeded else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+# Helpers for the prefetchChunks lists in src/defs/disks.ts, and for reading
+# the chunk access traces that they can be generated from (the format is
+# documented in generate-prefetch-chunks.py).
+
+import bisect
+import chunks
+import collections
+import json
+import os
+import paths
+import re
+import sys
+import typing
+
+DISKS_TS_PATH = os.path.join(paths.ROOT_DIR, "src", "defs", "disks.ts")
+DISK_DEF_RE = re.compile(
+    r"^(?:export )?const (\w+)\b[^=\n]*= \{\n(.*?)^\};", re.MULTILINE | re.DOTALL
+)
+PREFETCH_CHUNKS_RE = re.compile(r"^    prefetchChunks: \[[^\]]*\],\n", re.MULTILINE)
+GENERATED_SPEC_RE = re.compile(
+    r'generatedSpec: \(\) =>\s*import\("@/Data/(.+?)\.dsk\.json"\)'
+)
+
+
+class Trace(typing.NamedTuple):
+    # Chunk indexes loaded before the first idle point, in load order.
+    boot_chunks: typing.List[int]
+    # Milliseconds between will_load_chunk and did_load_chunk, by chunk.
+    load_times: typing.Dict[int, float]
+
+
+def read_traces(
+    trace_paths: typing.List[str],
+) -> typing.Dict[str, typing.List[Trace]]:
+    events_by_trace: typing.Dict[str, typing.List[dict]] = collections.defaultdict(list)
+    for trace_path in trace_paths:
+        with open(trace_path, "r") as trace_file:
+            for line_number, line in enumerate(trace_file, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError as e:
+                    sys.stderr.write(
+                        "Skipping %s:%d: %s\n" % (trace_path, line_number, e)
+                    )
+                    continue
+                trace_id = "%s:%s" % (trace_path, event.get("trace", ""))
+                events_by_trace[trace_id].append(event)
+
+    traces_by_disk: typing.Dict[str, typing.List[Trace]] = collections.defaultdict(list)
+    for trace_id, events in events_by_trace.items():
+        events.sort(key=lambda e: e["time"])
+        quiescent_time = next(
+            (e["time"] for e in events if e["event"] == "quiescent"), None
+        )
+        if quiescent_time is None:
+            sys.stderr.write(
+                "Trace %s never became quiescent, using all of its events\n" % trace_id
+            )
+            quiescent_time = float("inf")
+        boot_chunks: typing.Dict[str, typing.List[int]] = collections.defaultdict(list)
+        load_starts: typing.Dict[typing.Tuple[str, int], float] = {}
+        load_times: typing.Dict[str, typing.Dict[int, float]] = collections.defaultdict(
+            dict
+        )
+        for event in events:
+            if event["event"] == "will_load_chunk":
+                key = (event["disk"], event["chunk"])
+                load_starts[key] = event["time"]
+                disk_chunks = boot_chunks[event["disk"]]
+                if (
+                    event["time"] <= quiescent_time
+                    and event["chunk"] not in disk_chunks
+                ):
+                    disk_chunks.append(event["chunk"])
+            elif event["event"] == "did_load_chunk":
+                key = (event["disk"], event["chunk"])
+                if key in load_starts:
+                    load_times[event["disk"]][event["chunk"]] = event[
+                        "time"
+                    ] - load_starts.pop(key)
+        for disk_name in boot_chunks.keys() | load_times.keys():
+            traces_by_disk[disk_name].append(
+                Trace(boot_chunks[disk_name], load_times[disk_name])
+            )
+    return traces_by_disk
+
+
+def read_disks_ts() -> str:
+    with open(DISKS_TS_PATH, "r") as disks_ts_file:
+        return disks_ts_file.read()
+
+
+def read_prefetch_chunks(
+    disks_ts: typing.Optional[str] = None,
+) -> typing.Dict[str, typing.List[int]]:
+    # Keyed by manifest name (e.g. "System 7.0 HD").
+    if disks_ts is None:
+        disks_ts = read_disks_ts()
+    prefetch_chunks = {}
+    for disk_def in DISK_DEF_RE.finditer(disks_ts):
+        body = disk_def.group(2)
+        spec_match = GENERATED_SPEC_RE.search(body)
+        prefetch_match = PREFETCH_CHUNKS_RE.search(body)
+        if not spec_match or not prefetch_match:
+            continue
+        chunk_list = prefetch_match.group(0).split("[", 1)[1].rsplit("]", 1)[0]
+        prefetch_chunks[spec_match.group(1)] = [
+            int(c) for c in chunk_list.replace("\n", " ").split(",") if c.strip()
+        ]
+    return prefetch_chunks
+
+
+def _chunk_index(manifest: dict, offset: int) -> int:
+    chunk_starts = manifest.get("chunkStarts")
+    if chunk_starts is None:
+        return offset // manifest["chunkSize"]
+    return bisect.bisect_right(chunk_starts, offset) - 1
+
+
+def _chunk_range(manifest: dict, chunk_index: int) -> typing.Tuple[int, int]:
+    total_size = manifest["totalSize"]
+    chunk_starts = manifest.get("chunkStarts")
+    if chunk_starts is None:
+        start = chunk_index * manifest["chunkSize"]
+        return start, min(start + manifest["chunkSize"], total_size)
+    if chunk_index >= len(chunk_starts):
+        return total_size, total_size
+    if chunk_index + 1 < len(chunk_starts):
+        return chunk_starts[chunk_index], chunk_starts[chunk_index + 1]
+    return chunk_starts[chunk_index], total_size
+
+
+def manifest_chunk_indexes(
+    manifest: dict, prefetch_chunks: typing.List[int]
+) -> typing.List[int]:
+    # prefetchChunks lists are indexes of fixed-size (chunks.CHUNK_SIZE)
+    # chunks. Content-defined manifests (with chunkStarts) have other chunk
+    # boundaries, so the lists are mapped to the manifest's chunks that cover
+    # the same bytes, in the same order (getPrefetchChunks() in the client
+    # does the same).
+    chunk_indexes: typing.Dict[int, None] = {}
+    for i in prefetch_chunks:
+        start = i * chunks.CHUNK_SIZE
+        end = min(start + chunks.CHUNK_SIZE, manifest["totalSize"])
+        if start >= end:
+            continue
+        first = _chunk_index(manifest, start)
+        last = _chunk_index(manifest, end - 1)
+        for j in range(first, last + 1):
+            chunk_indexes[j] = None
+    return list(chunk_indexes)
+
+
+def prefetch_chunk_indexes(
+    manifest: dict, chunk_indexes: typing.List[int]
+) -> typing.List[int]:
+    # The inverse of manifest_chunk_indexes(): the fixed-size chunks that
+    # cover the given chunks of the manifest (e.g. from a trace).
+    prefetch_chunks: typing.Dict[int, None] = {}
+    for j in chunk_indexes:
+        start, end = _chunk_range(manifest, j)
+        if start >= end:
+            continue
+        first = start // chunks.CHUNK_SIZE
+        last = (end - 1) // chunks.CHUNK_SIZE
+        for i in range(first, last + 1):
+            prefetch_chunks[i] = None
+    return list(prefetch_chunks)
+
+
+def prefetch_trace(manifest: dict, trace: Trace) -> Trace:
+    # Maps a trace of the manifest's chunks to fixed-size chunk indexes, so
+    # that it can be compared with (and generate) prefetchChunks lists.
+    if "chunkStarts" not in manifest:
+        return trace
+    load_times = {}
+    for j, load_time in trace.load_times.items():
+        for i in prefetch_chunk_indexes(manifest, [j]):
+            load_times[i] = max(load_time, load_times.get(i, 0))
+    return Trace(prefetch_chunk_indexes(manifest, trace.boot_chunks), load_times)
+
+
+def format_prefetch_chunks(chunk_list: typing.List[int]) -> str:
+    # Matches how prettier formats the lists in disks.ts.
+    single_line = "    prefetchChunks: [%s],\n" % ", ".join(str(c) for c in chunk_list)
+    if len(single_line) <= 81:
+        return single_line
+    lines = ["    prefetchChunks: ["]
+    line = "       "
+    for chunk in chunk_list:
+        item = " %d," % chunk
+        if len(line) + len(item) > 80:
+            lines.append(line)
+            line = "       "
+        line += item
+    lines.append(line)
+    lines.append("    ],")
+    return "\n".join(lines) + "\n"
+
+
+def update_disks_ts(
+    disks_ts: str, generated: typing.Dict[str, typing.List[int]]
+) -> str:
+    def replace_disk_def(disk_def: re.Match) -> str:
+        spec_match = GENERATED_SPEC_RE.search(disk_def.group(2))
+        if not spec_match or spec_match.group(1) not in generated:
+            return disk_def.group(0)
+        return PREFETCH_CHUNKS_RE.sub(
+            lambda _: format_prefetch_chunks(generated[spec_match.group(1)]),
+            disk_def.group(0),
+            count=1,
+        )
+
+    return DISK_DEF_RE.sub(replace_disk_def, disks_ts)
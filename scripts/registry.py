@@ -0,0 +1,154 @@
+# Persistent registry of content hashes of build inputs, so that files that
+# have not changed since the last run do not need to be read and hashed again.
+# Entries are keyed by path and are only considered valid if the file's size,
+# modification time and inode all still match.
+
+import hashlib
+import json
+import os
+import paths
+import sqlite3
+import threading
+import typing
+
+_connection: typing.Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+
+
+class Fingerprint(typing.NamedTuple):
+    path: str
+    size: int
+    mtime_ns: int
+    inode: int
+
+
+def fingerprint(path: str) -> Fingerprint:
+    stat = os.stat(path)
+    return Fingerprint(
+        os.path.realpath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino
+    )
+
+
+def _get_connection() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        os.makedirs(os.path.dirname(paths.HASH_REGISTRY_PATH), exist_ok=True)
+        # Chunking happens on multiple threads, access is serialized via _lock.
+        # System images are also chunked by multiple processes, which wait for
+        # each other's writes (they're short) instead of failing.
+        _connection = sqlite3.connect(
+            paths.HASH_REGISTRY_PATH, check_same_thread=False, timeout=60
+        )
+        _connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "  path TEXT NOT NULL,"
+            "  kind TEXT NOT NULL,"
+            "  size INTEGER NOT NULL,"
+            "  mtime_ns INTEGER NOT NULL,"
+            "  inode INTEGER NOT NULL,"
+            "  value TEXT NOT NULL,"
+            "  PRIMARY KEY (path, kind)"
+            ")"
+        )
+    return _connection
+
+
+def get(fp: Fingerprint, kind: str) -> typing.Optional[str]:
+    with _lock:
+        row = (
+            _get_connection()
+            .execute(
+                "SELECT size, mtime_ns, inode, value FROM hashes "
+                "WHERE path = ? AND kind = ?",
+                (fp.path, kind),
+            )
+            .fetchone()
+        )
+    if row is None or tuple(row[:3]) != (fp.size, fp.mtime_ns, fp.inode):
+        return None
+    return row[3]
+
+
+def put(fp: Fingerprint, kind: str, value: str) -> None:
+    with _lock:
+        connection = _get_connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO hashes "
+            "(path, kind, size, mtime_ns, inode, value) VALUES (?, ?, ?, ?, ?, ?)",
+            (fp.path, kind, fp.size, fp.mtime_ns, fp.inode, value),
+        )
+        connection.commit()
+
+
+def put_many(entries: typing.Iterable[typing.Tuple[Fingerprint, str, str]]) -> None:
+    # Like put for (fingerprint, kind, value) entries, but with a single
+    # commit, for callers that hash many small files.
+    with _lock:
+        connection = _get_connection()
+        connection.executemany(
+            "INSERT OR REPLACE INTO hashes "
+            "(path, kind, size, mtime_ns, inode, value) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (fp.path, kind, fp.size, fp.mtime_ns, fp.inode, value)
+                for fp, kind, value in entries
+            ],
+        )
+        connection.commit()
+
+
+def get_file_hash(fp: Fingerprint, kind: str = "sha256") -> typing.Optional[str]:
+    return get(fp, kind)
+
+
+def put_file_hash(fp: Fingerprint, file_hash: str, kind: str = "sha256") -> None:
+    put(fp, kind, file_hash)
+
+
+def _chunks_kind(chunk_size: int, variant: str) -> str:
+    # variant distinguishes different chunkings of the same file (e.g. with
+    # patches applied on top of it).
+    if variant:
+        return "chunks:%d:%s" % (chunk_size, variant)
+    return "chunks:%d" % chunk_size
+
+
+def get_chunk_signatures(
+    fp: Fingerprint, chunk_size: int, variant: str = ""
+) -> typing.Optional[typing.List[str]]:
+    value = get(fp, _chunks_kind(chunk_size, variant))
+    if value is None:
+        return None
+    return json.loads(value)
+
+
+def put_chunk_signatures(
+    fp: Fingerprint, chunk_size: int, signatures: typing.List[str], variant: str = ""
+) -> None:
+    put(fp, _chunks_kind(chunk_size, variant), json.dumps(signatures))
+
+
+def prune() -> int:
+    # Removes entries for files that no longer exist (e.g. images that were
+    # built in a temporary directory by a previous run).
+    with _lock:
+        connection = _get_connection()
+        missing_paths = [
+            path
+            for (path,) in connection.execute("SELECT DISTINCT path FROM hashes")
+            if not os.path.exists(path)
+        ]
+        connection.executemany(
+            "DELETE FROM hashes WHERE path = ?", [(p,) for p in missing_paths]
+        )
+        connection.commit()
+    return len(missing_paths)
+
+
+def hash_file(path: str, kind: str = "sha256") -> str:
+    file_fingerprint = fingerprint(path)
+    file_hash = get_file_hash(file_fingerprint, kind)
+    if file_hash is None:
+        with open(path, "rb") as f:
+            file_hash = hashlib.file_digest(f, kind).hexdigest()
+        put_file_hash(file_fingerprint, file_hash, kind)
+    return file_hash
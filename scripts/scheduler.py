@@ -0,0 +1,150 @@
+# Runs independent build jobs (e.g. customizing and chunking a system image)
+# in worker processes. Images range from 400K floppies to multi-GB hard disks,
+# so instead of a fixed number of jobs in flight, jobs are admitted against a
+# memory budget, based on an estimate of how much each one needs. Jobs are
+# started largest-first (so that the big ones don't end up running alone at
+# the end), with smaller ones filling in whatever budget is left.
+#
+# Output from a job is captured in the worker and written out in one piece
+# when it finishes, so that logs for different images are not interleaved.
+
+import concurrent.futures
+import contextlib
+import io
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+import typing
+
+# Used if the amount of physical memory can't be determined.
+FALLBACK_MEMORY_BUDGET = 8 * 1024 * 1024 * 1024
+
+
+class Job(typing.NamedTuple):
+    name: str
+    # Estimated peak memory use, in bytes.
+    cost: int
+    # Must be picklable (i.e. a module-level function).
+    fn: typing.Callable[..., typing.Any]
+    args: typing.Tuple[typing.Any, ...] = ()
+
+
+class JobResult(typing.NamedTuple):
+    name: str
+    value: typing.Any
+    elapsed: float
+
+
+class JobError(Exception):
+    pass
+
+
+class RunStats(typing.NamedTuple):
+    job_count: int
+    workers: int
+    elapsed: float
+    # Sum of the estimated costs of the jobs that were running at once, at its
+    # highest.
+    peak_cost: int
+
+
+def default_memory_budget() -> int:
+    # Half of physical memory, leaving the rest for the page cache (images are
+    # read via memory maps) and everything else.
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 2
+    except (ValueError, OSError, AttributeError):
+        return FALLBACK_MEMORY_BUDGET
+
+
+def _run_captured(
+    fn: typing.Callable[..., typing.Any], args: typing.Tuple[typing.Any, ...]
+) -> typing.Tuple[bool, typing.Any, str, float]:
+    # Runs in the worker process. Exceptions are returned (as text) instead of
+    # being raised, so that the output that led up to them is not lost.
+    start_time = time.monotonic()
+    output = io.StringIO()
+    with contextlib.redirect_stderr(output), contextlib.redirect_stdout(output):
+        try:
+            value = fn(*args)
+            ok = True
+        except Exception:
+            value = traceback.format_exc()
+            ok = False
+    return ok, value, output.getvalue(), time.monotonic() - start_time
+
+
+def run_jobs(
+    jobs: typing.List[Job],
+    workers: int,
+    memory_budget: int,
+    log: typing.Callable[[str], None] = sys.stderr.write,
+) -> typing.Tuple[typing.List[JobResult], RunStats]:
+    # Returns results in the same order as jobs. A job that is larger than the
+    # whole budget is still run, but only once nothing else is.
+    start_time = time.monotonic()
+    pending = sorted(range(len(jobs)), key=lambda i: jobs[i].cost, reverse=True)
+    results: typing.List[typing.Optional[JobResult]] = [None] * len(jobs)
+
+    if workers <= 1:
+        # In-process, so that output (e.g. progress) is shown as it happens.
+        for i in pending:
+            job = jobs[i]
+            job_start_time = time.monotonic()
+            value = job.fn(*job.args)
+            results[i] = JobResult(job.name, value, time.monotonic() - job_start_time)
+        peak_cost = max((j.cost for j in jobs), default=0)
+        return typing.cast(typing.List[JobResult], results), RunStats(
+            len(jobs), 1, time.monotonic() - start_time, peak_cost
+        )
+
+    running: typing.Dict[concurrent.futures.Future, int] = {}
+    running_cost = 0
+    peak_cost = 0
+    failed: typing.List[str] = []
+    # Spawned (instead of forked) workers don't inherit state such as open
+    # database connections or locks held by other threads.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        while pending or running:
+            # Once a job has failed, let the running ones finish (so that their
+            # output is not lost), but don't start any more.
+            while pending and len(running) < workers and not failed:
+                fitting = [
+                    i for i in pending if running_cost + jobs[i].cost <= memory_budget
+                ]
+                if fitting:
+                    i = fitting[0]
+                elif not running:
+                    i = pending[0]
+                else:
+                    break
+                pending.remove(i)
+                job = jobs[i]
+                running[executor.submit(_run_captured, job.fn, job.args)] = i
+                running_cost += job.cost
+                peak_cost = max(peak_cost, running_cost)
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                i = running.pop(future)
+                job = jobs[i]
+                running_cost -= job.cost
+                ok, value, output, elapsed = future.result()
+                log(output)
+                if ok:
+                    results[i] = JobResult(job.name, value, elapsed)
+                else:
+                    log(value)
+                    failed.append(job.name)
+    if failed:
+        raise JobError("Could not build %s" % ", ".join(failed))
+    return typing.cast(typing.List[JobResult], results), RunStats(
+        len(jobs), workers, time.monotonic() - start_time, peak_cost
+    )
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import argparse
+import disks
+import json
+import os
+import packs
+import paths
+import prefetch
+import sys
+import typing
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Simulate how many requests booting each system disk takes with "
+            "and without chunk packfiles."
+        )
+    )
+    parser.add_argument(
+        "--traces",
+        nargs="*",
+        default=[],
+        help=(
+            "chunk access traces (see generate-prefetch-chunks.py) to use as "
+            "the chunks read during boot, instead of the prefetchChunks lists "
+            "(which the packs are built from, so without traces the packed "
+            "results are a best case)"
+        ),
+    )
+    parser.add_argument(
+        "--boot-pack-max-size",
+        type=int,
+        default=packs.BOOT_PACK_MAX_SIZE,
+        help="maximum size of a pack of prefetched chunks",
+    )
+    parser.add_argument(
+        "--adjacent-pack-max-size",
+        type=int,
+        default=packs.ADJACENT_PACK_MAX_SIZE,
+        help="maximum size of a pack of adjacent chunks",
+    )
+    args = parser.parse_args()
+
+    all_prefetch_chunks = prefetch.read_prefetch_chunks()
+    traces_by_disk = prefetch.read_traces(args.traces) if args.traces else {}
+
+    print(
+        "%-40s %10s %10s %10s %10s %10s  %s"
+        % ("Disk", "Packs", "Requests", "Packed", "MB", "Packed MB", "Accesses")
+    )
+    totals = [0, 0, 0, 0, 0]
+    untraced_count = 0
+    for disk in disks.ALL_DISKS:
+        manifest_path = os.path.join(paths.DATA_DIR, f"{disk.name}.json")
+        if not os.path.exists(manifest_path):
+            sys.stderr.write("Skipping %s, manifest not generated\n" % disk.name)
+            continue
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        chunk_list = manifest["chunks"]
+        sizes = packs.chunk_sizes(manifest)
+        prefetch_chunks = prefetch.manifest_chunk_indexes(
+            manifest, all_prefetch_chunks.get(manifest["name"], [])
+        )
+        disk_packs = packs.group_chunks(
+            chunk_list,
+            sizes,
+            prefetch_chunks,
+            args.boot_pack_max_size,
+            args.adjacent_pack_max_size,
+        )
+
+        accessed_chunk_lists: typing.List[typing.List[int]] = [
+            t.boot_chunks for t in traces_by_disk.get(manifest["name"], [])
+        ]
+        if accessed_chunk_lists:
+            accesses = "%d traces" % len(accessed_chunk_lists)
+        else:
+            accessed_chunk_lists = [prefetch_chunks]
+            accesses = "prefetch*"
+            untraced_count += 1
+        results = []
+        for disk_packs_or_none in [[], disk_packs]:
+            request_counts, fetched_sizes = zip(
+                *(
+                    packs.count_requests(
+                        chunk_list, sizes, disk_packs_or_none, accessed_chunks
+                    )
+                    for accessed_chunks in accessed_chunk_lists
+                )
+            )
+            results.append(
+                (
+                    sum(request_counts) / len(request_counts),
+                    sum(fetched_sizes) / len(fetched_sizes),
+                )
+            )
+        (requests, fetched_size), (packed_requests, packed_fetched_size) = results
+        for i, value in enumerate(
+            [
+                len(disk_packs),
+                requests,
+                packed_requests,
+                fetched_size,
+                packed_fetched_size,
+            ]
+        ):
+            totals[i] += value
+        print(
+            "%-40s %10d %10.1f %10.1f %10.1f %10.1f  %s"
+            % (
+                disk.name[:40],
+                len(disk_packs),
+                requests,
+                packed_requests,
+                fetched_size / 1024 / 1024,
+                packed_fetched_size / 1024 / 1024,
+                accesses,
+            )
+        )
+    print(
+        "%-40s %10d %10.1f %10.1f %10.1f %10.1f"
+        % (
+            "Total",
+            totals[0],
+            totals[1],
+            totals[2],
+            totals[3] / 1024 / 1024,
+            totals[4] / 1024 / 1024,
+        )
+    )
+    if untraced_count:
+        print(
+            "\n* %d disks have no traces, so the chunks read during boot are "
+            "assumed to be exactly their prefetchChunks lists, which the packs "
+            "are built from. Their packed results are an upper bound on the "
+            "benefit of packs, pass --traces for realistic ones." % untraced_count
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
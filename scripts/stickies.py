@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import builddate
 import dataclasses
 import datetime
 import enum
@@ -56,8 +57,10 @@ class Sticky:
     bottom: int  # 2 bytes
     right: int  # 2 bytes
     unknown: int = 0  # 8 bytes
-    creation_date: datetime.datetime = datetime.datetime.now()  # 4 bytes
-    modification_date: datetime.datetime = datetime.datetime.now()  # 4 bytes
+    creation_date: datetime.datetime = dataclasses.field(
+        default_factory=builddate.now)  # 4 bytes
+    modification_date: datetime.datetime = dataclasses.field(
+        default_factory=builddate.now)  # 4 bytes
     font: Font = Font.GENEVA  # 2 bytes
     size: int = 9  # 1 byte
     style: typing.Set[Style] = dataclasses.field(default_factory=set)  # 1 byte
@@ -0,0 +1,206 @@
+# Mark-and-sweep garbage collection for the chunk store (Images/build). Every
+# chunk, pack, pre-compressed variant and dictionary that is referenced by a
+# manifest (the current ones in src/Data, optionally those from previous
+# releases, for clients that still have an older manifest cached) is marked,
+# and everything else in the store is unreferenced.
+
+import json
+import manifests
+import os
+import paths
+import subprocess
+import time
+import typing
+
+MANIFEST_PATHSPEC = "src/Data/*.dsk.json"
+# Temporary files from interrupted writes are only removed once they are old
+# enough that they can't belong to a build that is still running.
+TEMP_FILE_MAX_AGE = 60 * 60
+
+
+class Marked(typing.NamedTuple):
+    chunks: typing.Set[str]
+    packs: typing.Set[str]
+    dictionaries: typing.Set[str]
+
+    @staticmethod
+    def empty() -> "Marked":
+        return Marked(set(), set(), set())
+
+
+class SweepResult(typing.NamedTuple):
+    kept_count: int
+    kept_size: int
+    # Names of unreferenced files, relative to the chunk directory.
+    unreferenced: typing.List[str]
+    unreferenced_size: int
+
+
+def mark_manifest(manifest: typing.Dict[str, typing.Any], marked: Marked) -> None:
+    marked.chunks.update(c for c in manifest["chunks"] if c)
+    marked.packs.update(manifest.get("packs", []))
+    compression = manifest.get("compression")
+    if compression:
+        marked.dictionaries.add(compression["dictionary"])
+
+
+def read_manifest_dir(
+    manifest_dir: str,
+) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    # Manifests by file name (JSON or binary).
+    return {
+        name: manifests.read_manifest(os.path.join(manifest_dir, name))
+        for name in sorted(os.listdir(manifest_dir))
+        if name.endswith(".dsk.json") or name.endswith(".dsk.manifest")
+    }
+
+
+def mark_manifest_dir(manifest_dir: str, marked: Marked) -> int:
+    dir_manifests = read_manifest_dir(manifest_dir)
+    for manifest in dir_manifests.values():
+        mark_manifest(manifest, marked)
+    return len(dir_manifests)
+
+
+def previous_release_revisions(count: int) -> typing.List[str]:
+    # Every commit that changed the generated manifests is treated as a
+    # release. Once the manifests in src/Data are committed, the latest such
+    # commit is the current release rather than a previous one, so commits
+    # whose manifests are the current ones are skipped.
+    if count <= 0:
+        return []
+    current_manifests = {
+        name: manifest
+        for name, manifest in read_manifest_dir(paths.DATA_DIR).items()
+        if name.endswith(".dsk.json")
+    }
+    revisions = []
+    for revision in subprocess.check_output(
+        ["git", "log", "--format=%H", "--", MANIFEST_PATHSPEC],
+        cwd=paths.ROOT_DIR,
+        text=True,
+    ).split():
+        if len(revisions) == count:
+            break
+        if not revisions and read_revision_manifests(revision) == current_manifests:
+            continue
+        revisions.append(revision)
+    return revisions
+
+
+def read_revision_manifests(
+    revision: str,
+) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    # Manifests in src/Data at the given revision, by file name.
+    manifest_paths = [
+        p
+        for p in subprocess.check_output(
+            ["git", "ls-tree", "--name-only", revision, "src/Data/"],
+            cwd=paths.ROOT_DIR,
+            text=True,
+        ).splitlines()
+        if p.endswith(".dsk.json")
+    ]
+    if not manifest_paths:
+        return {}
+    # A single cat-file process for all manifests, instead of one git show
+    # per manifest.
+    output = subprocess.run(
+        ["git", "cat-file", "--batch"],
+        cwd=paths.ROOT_DIR,
+        input="".join(f"{revision}:{p}\n" for p in manifest_paths).encode(),
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+    revision_manifests = {}
+    offset = 0
+    for manifest_path in manifest_paths:
+        header_end = output.index(b"\n", offset)
+        size = int(output[offset:header_end].split()[2])
+        content_start = header_end + 1
+        revision_manifests[os.path.basename(manifest_path)] = json.loads(
+            output[content_start : content_start + size]
+        )
+        offset = content_start + size + 1
+    return revision_manifests
+
+
+def mark_revision(revision: str, marked: Marked) -> int:
+    revision_manifests = read_revision_manifests(revision)
+    for manifest in revision_manifests.values():
+        mark_manifest(manifest, marked)
+    return len(revision_manifests)
+
+
+def mark(
+    manifest_dirs: typing.Iterable[str] = (paths.DATA_DIR,),
+    previous_releases: int = 0,
+    log: typing.Callable[[str], None] = lambda _: None,
+) -> Marked:
+    marked = Marked.empty()
+    for manifest_dir in manifest_dirs:
+        manifest_count = mark_manifest_dir(manifest_dir, marked)
+        log("Marked %d manifests in %s\n" % (manifest_count, manifest_dir))
+    for revision in previous_release_revisions(previous_releases):
+        manifest_count = mark_revision(revision, marked)
+        log("Marked %d manifests from %s\n" % (manifest_count, revision[:12]))
+    return marked
+
+
+def is_referenced(name: str, marked: Marked) -> typing.Optional[bool]:
+    # Returns None for files that are not managed by the chunk store (e.g. the
+    # build state), which are left alone.
+    parts = name.split(".")
+    if len(parts) == 2:
+        base, ext = parts
+        if ext == "chunk":
+            return base in marked.chunks
+        if ext == "pack":
+            return base in marked.packs
+        if ext == "dict":
+            return base in marked.dictionaries
+    elif len(parts) == 3 and parts[2] in ("deflate", "zstd"):
+        # Pre-compressed variant: {signature}.{dictionary}.{codec}
+        return parts[0] in marked.chunks and parts[1] in marked.dictionaries
+    return None
+
+
+def sweep(
+    marked: Marked,
+    chunk_dir: str = paths.DISK_DIR,
+    dry_run: bool = False,
+) -> SweepResult:
+    kept_count = 0
+    kept_size = 0
+    unreferenced = []
+    unreferenced_size = 0
+    now = time.time()
+    with os.scandir(chunk_dir) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if entry.name.startswith(".") and entry.name.endswith(".tmp"):
+                if now - stat.st_mtime > TEMP_FILE_MAX_AGE and not dry_run:
+                    os.remove(entry.path)
+                continue
+            referenced = is_referenced(entry.name, marked)
+            if referenced is None:
+                continue
+            if referenced:
+                kept_count += 1
+                kept_size += stat.st_size
+                continue
+            unreferenced.append(entry.name)
+            unreferenced_size += stat.st_size
+            if not dry_run:
+                os.remove(entry.path)
+    unreferenced.sort()
+    return SweepResult(kept_count, kept_size, unreferenced, unreferenced_size)
+
+
+def unreferenced_remote(
+    remote_names: typing.Iterable[str], marked: Marked
+) -> typing.List[str]:
+    # remote_names is a listing of the remote store (e.g. from rclone lsf).
+    return sorted(n for n in remote_names if is_referenced(n, marked) is False)
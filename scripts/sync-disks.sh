@@ -2,21 +2,37 @@
 
 # Assumes that rclone is installed and access token with Object Read & Write
 # permissions is configured.
+#
+# By default only the objects that the manifests in src/Data reference, but
+# the previously published ones (at HEAD) don't, are uploaded (see
+# upload-disks.py for options). --full does a complete rclone sync instead,
+# which lists the entire bucket.
 
-echo "Syncing disk chunks to Cloudflare R2…"
-TIMEFORMAT='Synced disk chunks to Cloudflare R2: %R'
-time {
-    rclone \
-        --config=scripts/rclone.conf \
-        sync \
-        --progress \
-        --fast-list \
-        --exclude "/media/**" \
-        --s3-no-check-bucket \
-        --no-update-modtime \
-        --size-only \
-        --transfers 32 \
-        --checkers 32 \
-        Images/build \
-        cf:infinite-mac-disk
-}
+if [ "$1" == "--full" ]; then
+    shift
+    echo "Syncing disk chunks to Cloudflare R2…"
+    TIMEFORMAT='Synced disk chunks to Cloudflare R2: %R'
+    time {
+        rclone \
+            --config=scripts/rclone.conf \
+            sync \
+            --progress \
+            --fast-list \
+            --exclude "/media/**" \
+            --exclude "/build-state.json" \
+            --s3-no-check-bucket \
+            --no-update-modtime \
+            --size-only \
+            --transfers 32 \
+            --checkers 32 \
+            "$@" \
+            Images/build \
+            cf:infinite-mac-disk
+    }
+else
+    echo "Uploading new disk chunks to Cloudflare R2…"
+    TIMEFORMAT='Uploaded new disk chunks to Cloudflare R2: %R'
+    time {
+        uv run scripts/upload-disks.py "$@"
+    }
+fi
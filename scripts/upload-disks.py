@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import paths
+import sweep
+import sys
+import uploads
+
+DEFAULT_REMOTE = "cf:infinite-mac-disk"
+
+
+def format_mb(size: int) -> str:
+    return "%.1f MB" % (size / 1024 / 1024)
+
+
+def print_report(plan: uploads.UploadPlan) -> None:
+    print("%-48s %-10s %10s %12s %12s" % ("Image", "Status", "Objects", "New", "Size"))
+    for image in plan.images:
+        if image.status == "unchanged":
+            continue
+        print(
+            "%-48s %-10s %10d %12s %12s"
+            % (
+                image.name[:48],
+                image.status,
+                image.new_object_count,
+                format_mb(image.new_size),
+                format_mb(image.total_size),
+            )
+        )
+    print(
+        "%-48s %-10s %10d %12s"
+        % (
+            "Total (%d unchanged images)"
+            % sum(1 for i in plan.images if i.status == "unchanged"),
+            "",
+            len(plan.objects),
+            format_mb(plan.total_size),
+        )
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Upload the chunks (and packs, pre-compressed variants and "
+            "dictionaries) that are referenced by the manifests in src/Data "
+            "but not by the previously published ones, and report which "
+            "images changed."
+        )
+    )
+    parser.add_argument(
+        "--published-revision",
+        default="HEAD",
+        help=(
+            "git revision with the manifests that were last published "
+            "(default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--published-dir",
+        help="directory with the manifests that were last published, instead",
+    )
+    parser.add_argument(
+        "--remote",
+        default=DEFAULT_REMOTE,
+        help="rclone remote to upload to (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rclone-config",
+        default="scripts/rclone.conf",
+        help="rclone config file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dest-dir",
+        help="copy objects to this local directory instead of using rclone",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=uploads.DEFAULT_JOBS,
+        help="number of concurrent uploads (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--attempts",
+        type=int,
+        default=uploads.DEFAULT_ATTEMPTS,
+        help="attempts per object before giving up (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--report",
+        help="also write the release report (and list of objects) as JSON",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report what would be uploaded",
+    )
+    args = parser.parse_args()
+
+    new_manifests = sweep.read_manifest_dir(paths.DATA_DIR)
+    if args.published_dir:
+        published_manifests = sweep.read_manifest_dir(args.published_dir)
+        published_source = args.published_dir
+    else:
+        published_manifests = sweep.read_revision_manifests(args.published_revision)
+        published_source = args.published_revision
+    sys.stderr.write(
+        "Comparing %d manifests against %d published in %s\n"
+        % (len(new_manifests), len(published_manifests), published_source)
+    )
+    plan = uploads.plan_upload(new_manifests, published_manifests)
+    print_report(plan)
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(
+                {
+                    "published": published_source,
+                    "images": [i._asdict() for i in plan.images],
+                    "objects": [{"name": n, "size": s} for n, s in plan.objects],
+                    "missing": plan.missing,
+                },
+                f,
+                indent=4,
+            )
+
+    if plan.missing:
+        sys.stderr.write(
+            "%d objects are not in %s (was import-disks run with a filter?), "
+            "e.g. %s\n" % (len(plan.missing), paths.DISK_DIR, plan.missing[0])
+        )
+        return 1
+    if args.dry_run or not plan.objects:
+        return 0
+
+    if args.dest_dir:
+        backend = uploads.DirectoryBackend(args.dest_dir)
+    else:
+        backend = uploads.RcloneBackend(args.remote, args.rclone_config)
+    result = uploads.upload_objects(
+        plan.objects,
+        backend,
+        jobs=args.jobs,
+        attempts=args.attempts,
+        log=sys.stderr.write,
+    )
+    sys.stderr.write(
+        "Uploaded %d objects (%s) in %.1fs\n"
+        % (result.uploaded_count, format_mb(result.uploaded_size), result.elapsed)
+    )
+    if result.failed:
+        sys.stderr.write("%d objects could not be uploaded\n" % len(result.failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
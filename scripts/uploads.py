@@ -0,0 +1,246 @@
+# Incremental uploads of the chunk store (Images/build) to the remote bucket.
+# Instead of listing the entire bucket to find what changed (as rclone sync
+# does), the manifests that were just generated are diffed against the ones
+# that were previously published (those at a git revision, or in a directory).
+# Chunks, packs, pre-compressed variants and dictionaries are content-addressed,
+# so anything that the published manifests reference is already uploaded, and
+# only the remaining objects need to be.
+
+import chunks
+import collections
+import concurrent.futures
+import os
+import paths
+import shutil
+import subprocess
+import tempfile
+import time
+import typing
+
+DEFAULT_JOBS = 32
+DEFAULT_ATTEMPTS = 4
+# Delay before the first retry, doubled for every subsequent one.
+RETRY_DELAY = 1.0
+
+Manifests = typing.Dict[str, typing.Dict[str, typing.Any]]
+
+
+class ImageChange(typing.NamedTuple):
+    # Manifest file name (e.g. "System 7.5.3.dsk.json").
+    name: str
+    # "added", "changed", "removed" or "unchanged".
+    status: str
+    total_size: int
+    new_object_count: int
+    new_size: int
+
+
+class UploadPlan(typing.NamedTuple):
+    # Object names (relative to the chunk directory) and their sizes, in
+    # upload order.
+    objects: typing.List[typing.Tuple[str, int]]
+    images: typing.List[ImageChange]
+    # Objects that should be uploaded but that are not in the chunk directory
+    # (e.g. because the image was built on another machine).
+    missing: typing.List[str]
+
+    @property
+    def total_size(self) -> int:
+        return sum(size for _, size in self.objects)
+
+
+class UploadResult(typing.NamedTuple):
+    uploaded_count: int
+    uploaded_size: int
+    failed: typing.List[str]
+    elapsed: float
+
+
+class Backend(typing.Protocol):
+    # Uploads the named objects from the chunk directory, with up to jobs
+    # transfers at a time, and returns the ones that failed (with an error).
+    def upload(
+        self, chunk_dir: str, names: typing.List[str], jobs: int
+    ) -> typing.Dict[str, str]: ...
+
+
+class DirectoryBackend:
+    # Copies objects to a local directory (a stand-in for the bucket, or a
+    # mirror of it).
+    def __init__(self, dest_dir: str):
+        self.dest_dir = dest_dir
+        os.makedirs(dest_dir, exist_ok=True)
+
+    def upload(
+        self, chunk_dir: str, names: typing.List[str], jobs: int
+    ) -> typing.Dict[str, str]:
+        def copy(name: str) -> typing.Optional[str]:
+            try:
+                with open(os.path.join(chunk_dir, name), "rb") as src_file:
+                    with tempfile.NamedTemporaryFile(
+                        dir=self.dest_dir,
+                        prefix=f".{name}.",
+                        suffix=".tmp",
+                        delete=False,
+                    ) as dest_file:
+                        shutil.copyfileobj(src_file, dest_file)
+                chunks.replace_temp_file(
+                    dest_file.name, os.path.join(self.dest_dir, name)
+                )
+            except OSError as e:
+                return str(e)
+            return None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            errors = list(executor.map(copy, names))
+        return {name: e for name, e in zip(names, errors) if e is not None}
+
+
+class RcloneBackend:
+    # Uploads objects with a single rclone copy of the list of their names, to
+    # any remote it is configured for (Cloudflare R2 in production, or e.g. a
+    # local S3-compatible server). Spawning an rclone process per object is
+    # much slower than letting one do all the transfers.
+    def __init__(self, remote: str, config: str = "scripts/rclone.conf"):
+        self.remote = remote
+        self.config = config
+
+    def upload(
+        self, chunk_dir: str, names: typing.List[str], jobs: int
+    ) -> typing.Dict[str, str]:
+        with tempfile.NamedTemporaryFile(
+            "w", prefix="upload-", suffix=".txt"
+        ) as files_from_file:
+            files_from_file.write("".join(f"{name}\n" for name in names))
+            files_from_file.flush()
+            process = subprocess.run(
+                [
+                    "rclone",
+                    "--config=%s" % self.config,
+                    "copy",
+                    "--files-from=%s" % files_from_file.name,
+                    # The objects are new, there is no need to list the
+                    # (large) bucket to compare against it.
+                    "--no-traverse",
+                    "--transfers=%d" % jobs,
+                    "--s3-no-check-bucket",
+                    "--no-update-modtime",
+                    # Retries are handled by upload_objects.
+                    "--retries=1",
+                    "--low-level-retries=1",
+                    chunk_dir,
+                    self.remote,
+                ],
+                cwd=paths.ROOT_DIR,
+                capture_output=True,
+                text=True,
+            )
+        if process.returncode == 0:
+            return {}
+        # rclone doesn't say which transfers failed, so the whole list is
+        # retried (objects that made it are skipped, since they match).
+        error_lines = process.stderr.strip().splitlines()
+        error = "rclone exited with status %d%s" % (
+            process.returncode,
+            ": %s" % error_lines[-1] if error_lines else "",
+        )
+        return {name: error for name in names}
+
+
+def manifest_objects(manifest: typing.Dict[str, typing.Any]) -> typing.List[str]:
+    # Names of the objects in the chunk store that are needed to serve an
+    # image, matching the naming in chunks, packs and precompress.
+    signatures = sorted(set(c for c in manifest["chunks"] if c))
+    objects = [f"{s}.chunk" for s in signatures]
+    objects += [f"{p}.pack" for p in manifest.get("packs", [])]
+    compression = manifest.get("compression")
+    if compression:
+        dictionary = compression["dictionary"]
+        objects.append(f"{dictionary}.dict")
+        objects += [f"{s}.{dictionary}.{compression['codec']}" for s in signatures]
+    return objects
+
+
+def plan_upload(
+    new_manifests: Manifests,
+    published_manifests: Manifests,
+    chunk_dir: str = paths.DISK_DIR,
+) -> UploadPlan:
+    published_objects = set(
+        o for m in published_manifests.values() for o in manifest_objects(m)
+    )
+    objects = []
+    missing = []
+    images = []
+    planned = set()
+    for name, manifest in sorted(new_manifests.items()):
+        new_object_count = 0
+        new_size = 0
+        for object_name in manifest_objects(manifest):
+            if object_name in published_objects or object_name in planned:
+                continue
+            planned.add(object_name)
+            try:
+                size = os.path.getsize(os.path.join(chunk_dir, object_name))
+            except FileNotFoundError:
+                missing.append(object_name)
+                continue
+            objects.append((object_name, size))
+            new_object_count += 1
+            new_size += size
+        published_manifest = published_manifests.get(name)
+        if published_manifest is None:
+            status = "added"
+        elif published_manifest != manifest:
+            status = "changed"
+        else:
+            status = "unchanged"
+        images.append(
+            ImageChange(name, status, manifest["totalSize"], new_object_count, new_size)
+        )
+    for name, manifest in sorted(published_manifests.items()):
+        if name not in new_manifests:
+            images.append(ImageChange(name, "removed", manifest["totalSize"], 0, 0))
+    return UploadPlan(objects, images, missing)
+
+
+def upload_objects(
+    objects: typing.List[typing.Tuple[str, int]],
+    backend: Backend,
+    chunk_dir: str = paths.DISK_DIR,
+    jobs: int = DEFAULT_JOBS,
+    attempts: int = DEFAULT_ATTEMPTS,
+    log: typing.Callable[[str], None] = lambda _: None,
+) -> UploadResult:
+    start_time = time.monotonic()
+    sizes = dict(objects)
+    remaining = [name for name, _ in objects]
+    uploaded_count = 0
+    uploaded_size = 0
+    for attempt in range(attempts):
+        if not remaining:
+            break
+        if attempt:
+            time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            log(
+                "Retrying upload of %d objects (attempt %d of %d)\n"
+                % (len(remaining), attempt + 1, attempts)
+            )
+        failed = backend.upload(chunk_dir, remaining, max(jobs, 1))
+        for name in remaining:
+            if name not in failed:
+                uploaded_count += 1
+                uploaded_size += sizes[name]
+        log(
+            "Uploaded %d/%d objects (%.1f MB)\n"
+            % (uploaded_count, len(objects), uploaded_size / 1024 / 1024)
+        )
+        for error, count in collections.Counter(failed.values()).items():
+            log("Could not upload %d objects: %s\n" % (count, error))
+        remaining = [name for name in remaining if name in failed]
+    return UploadResult(
+        uploaded_count=uploaded_count,
+        uploaded_size=uploaded_size,
+        failed=remaining,
+        elapsed=time.monotonic() - start_time,
+    )
@@ -1,13 +1,40 @@
 import bs4
+import cache
 import hashlib
+import http.client
 import json
 import os
 import paths
+import registry
 import ssl
 import sys
+import threading
+import urllib.error
+import urllib.parse
 import urllib.request
 import typing
 
+USER_AGENT = "Infinite Mac (+https://infinitemac.org)"
+# Downloads are streamed to disk through a buffer of this size, instead of
+# being read into memory all at once.
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+# Suffix of incomplete downloads in the cache directory.
+PARTIAL_SUFFIX = ".partial"
+# Socket timeout for pooled connections (a stalled download should fail and be
+# resumed later, instead of holding up the others forever).
+POOL_TIMEOUT = 60
+MAX_REDIRECTS = 10
+# Suffix of the files next to cached downloads that record the response's
+# validators (ETag and Last-Modified), for revalidation.
+VALIDATORS_SUFFIX = cache.VALIDATORS_SUFFIX
+VALIDATOR_HEADERS = ["ETag", "Last-Modified"]
+# Set (to any value) to revalidate cached downloads, see enable_revalidation.
+REVALIDATE_ENV = "INFINITE_MAC_REVALIDATE_CACHE"
+
+# Cache paths that have already been revalidated by this process.
+_revalidated_paths: typing.Set[str] = set()
+_revalidated_paths_lock = threading.Lock()
+
 
 def read_url(url: str, on_cache_miss: typing.Callable[[], None] = None) -> bytes:
     cache_path = read_url_to_path(url, on_cache_miss=on_cache_miss)
@@ -20,10 +47,7 @@ def read_url_headers(url: str) -> dict:
         return json.load(f)
 
 
-def read_url_to_path(
-    url: str, headers: bool = False, on_cache_miss: typing.Callable[[], None] = None
-) -> str:
-    os.makedirs(paths.CACHE_DIR, exist_ok=True)
+def url_cache_path(url: str, headers: bool = False) -> str:
     cache_key = hashlib.sha256(url.encode()).hexdigest()
     if headers:
         cache_key += "-headers"
@@ -33,51 +57,550 @@ def read_url_to_path(
     # will name the extracted file after the cache key.
     if url.endswith(".gz") or url.endswith(".tgz"):
         filename = url.split("/")[-1]
-        cache_dir = cache_path + "-dir"
-        os.makedirs(cache_dir, exist_ok=True)
-        cache_path = os.path.join(cache_dir, filename)
+        cache_path = os.path.join(cache_path + "-dir", filename)
+    return cache_path
+
 
+def read_url_to_path(
+    url: str,
+    headers: bool = False,
+    on_cache_miss: typing.Callable[[], None] = None,
+    pool: typing.Optional["ConnectionPool"] = None,
+    sha256: typing.Optional[str] = None,
+) -> str:
+    # sha256 is the expected digest of the download, if known: the download is
+    # checked against it, and it's not downloaded at all if a blob with that
+    # digest is already in the cache (e.g. from a mirror).
+    cache_path = url_cache_path(url, headers)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    is_macgui_url = url.startswith("https://macgui.com/downloads/")
+    if sha256 and is_content_addressed(cache_path):
+        link_expected_blob(cache_path, sha256)
+    cache.record_access(cache_path, hit=os.path.exists(cache_path))
     if not os.path.exists(cache_path):
         if on_cache_miss:
             on_cache_miss()
-        if url.startswith("https://macgui.com/downloads/"):
-            contents = fetch_macgui_url(url, headers)
+        if headers:
+            if is_macgui_url:
+                contents = fetch_macgui_url(url, headers, pool)
+            else:
+                contents = fetch_url(url, headers, pool)
+            write_atomically(cache_path, contents)
         else:
-            contents = fetch_url(url, headers)
-        with open(cache_path, "wb+") as f:
-            f.write(contents)
+            download_url = macgui_download_url(url, pool) if is_macgui_url else url
+            download = download_to_path(download_url, cache_path, pool, sha256)
+            write_validators(cache_path, download.validators)
+            if is_content_addressed(cache_path):
+                store_blob(cache_path, download.sha256)
+    elif (
+        revalidation_enabled()
+        # macgui.com download URLs are only valid once, and downloads with an
+        # expected digest can't change.
+        and not is_macgui_url
+        and not sha256
+        and start_revalidation(cache_path)
+    ):
+        try:
+            if headers:
+                write_atomically(cache_path, fetch_url(url, headers, pool))
+            else:
+                revalidate(url, cache_path, on_cache_miss, pool)
+        except Exception as e:
+            sys.stderr.write(
+                "Could not revalidate %s (%s), using the cached copy\n" % (url, e)
+            )
 
     return cache_path
 
 
-def fetch_url(url: str, headers: bool = False) -> bytes:
+def is_content_addressed(cache_path: str) -> bool:
+    # Downloads that are cached under their original filename (see
+    # url_cache_path) are kept as is.
+    return os.path.dirname(cache_path) == paths.CACHE_DIR and not cache_path.endswith(
+        "-headers"
+    )
+
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(paths.BLOBS_DIR, sha256)
+
+
+def link_blob(blob: str, dest_path: str) -> None:
+    temp_path = dest_path + ".tmp"
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    os.link(blob, temp_path)
+    os.replace(temp_path, dest_path)
+
+
+def store_blob(path: str, sha256: str) -> None:
+    # Downloads are stored by content, in BLOBS_DIR, and the per-URL cache
+    # entries are hard links to them. If the same contents were already
+    # downloaded (from another URL), path is replaced with a link to them.
+    os.makedirs(paths.BLOBS_DIR, exist_ok=True)
+    blob = blob_path(sha256)
     try:
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-        request = urllib.request.Request(
+        os.link(path, blob)
+    except FileExistsError:
+        if not os.path.samefile(blob, path):
+            link_blob(blob, path)
+    # Readers of the download (e.g. build fingerprints) don't need to hash it
+    # again.
+    registry.put_file_hash(registry.fingerprint(path), sha256)
+
+
+def link_expected_blob(cache_path: str, sha256: str) -> None:
+    # Makes cache_path a link to the blob with the expected digest if there is
+    # one, and removes a cached copy that doesn't match it.
+    blob = blob_path(sha256)
+    if os.path.exists(cache_path):
+        if os.path.exists(blob) and os.path.samefile(blob, cache_path):
+            return
+        # Cached before blobs were stored (or the expected digest changed),
+        # it's hashed once.
+        if registry.hash_file(cache_path) == sha256:
+            store_blob(cache_path, sha256)
+            return
+        sys.stderr.write(
+            "Cached %s does not match the expected digest, removing it\n" % cache_path
+        )
+        os.remove(cache_path)
+    if os.path.exists(blob):
+        link_blob(blob, cache_path)
+
+
+def enable_revalidation() -> None:
+    # Cached downloads are checked against the server (once per process) the
+    # next time they are read, with a conditional request. Set in the
+    # environment, so that worker processes also pick it up.
+    os.environ[REVALIDATE_ENV] = "1"
+
+
+def revalidation_enabled() -> bool:
+    return bool(os.getenv(REVALIDATE_ENV))
+
+
+def start_revalidation(cache_path: str) -> bool:
+    with _revalidated_paths_lock:
+        if cache_path in _revalidated_paths:
+            return False
+        _revalidated_paths.add(cache_path)
+        return True
+
+
+def response_validators(headers: typing.Any) -> typing.Dict[str, str]:
+    return {name: headers[name] for name in VALIDATOR_HEADERS if headers.get(name)}
+
+
+def read_validators(cache_path: str) -> typing.Optional[typing.Dict[str, str]]:
+    try:
+        with open(cache_path + VALIDATORS_SUFFIX, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_validators(cache_path: str, validators: typing.Dict[str, str]) -> None:
+    write_atomically(cache_path + VALIDATORS_SUFFIX, json.dumps(validators).encode())
+
+
+def remove_validators(cache_path: str) -> None:
+    try:
+        os.remove(cache_path + VALIDATORS_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+def if_range_validator(validators: typing.Dict[str, str]) -> typing.Optional[str]:
+    # If-Range needs a strong validator, weak ETags can't be used.
+    etag = validators.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validators.get("Last-Modified")
+
+
+def revalidate(
+    url: str,
+    cache_path: str,
+    on_cache_miss: typing.Callable[[], None] = None,
+    pool: typing.Optional["ConnectionPool"] = None,
+) -> bool:
+    # Downloads url again if it has changed since it was cached, returns
+    # whether it did.
+    validators = read_validators(cache_path)
+    if validators is None:
+        # Cached before validators were recorded. The current ones are adopted
+        # if the cached copy is the same size, otherwise it's downloaded again.
+        with open_url(url, "HEAD", pool=pool) as response:
+            validators = response_validators(response.headers)
+            content_length = response.headers.get("Content-Length")
+        if content_length is None or int(content_length) == os.path.getsize(cache_path):
+            write_validators(cache_path, validators)
+            return False
+        response = open_url(url, pool=pool)
+    elif not validators:
+        # The server does not provide any, so there's nothing to check.
+        return False
+    else:
+        request_headers = {}
+        if "ETag" in validators:
+            request_headers["If-None-Match"] = validators["ETag"]
+        if "Last-Modified" in validators:
+            request_headers["If-Modified-Since"] = validators["Last-Modified"]
+        try:
+            response = open_url(url, request_headers=request_headers, pool=pool)
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            e.close()
+            return False
+        # Some servers ignore conditional requests, but still return the same
+        # validators for an unchanged resource.
+        if (
+            response.status == 304
+            or response_validators(response.headers) == validators
+        ):
+            response.close()
+            return False
+
+    sys.stderr.write("%s has changed, downloading it again\n" % url)
+    if on_cache_miss:
+        on_cache_miss()
+    partial_path = cache_path + PARTIAL_SUFFIX
+    with response:
+        write_validators(partial_path, response_validators(response.headers))
+        sha256 = write_response(response, partial_path, 0)
+    os.replace(partial_path, cache_path)
+    write_validators(cache_path, response_validators(response.headers))
+    remove_validators(partial_path)
+    if is_content_addressed(cache_path):
+        store_blob(cache_path, sha256)
+    return True
+
+
+def write_atomically(path: str, contents: bytes) -> None:
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(contents)
+    os.replace(temp_path, path)
+
+
+def ssl_context() -> ssl.SSLContext:
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class PooledResponse:
+    # The subset of http.client.HTTPResponse that callers of open_url use. The
+    # connection goes back to its pool on close, if the response was fully
+    # read (otherwise the unread remainder would be mistaken for the next
+    # response).
+    def __init__(
+        self,
+        url: str,
+        response: http.client.HTTPResponse,
+        release: typing.Callable[[bool], None],
+    ):
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self._response = response
+        self._release: typing.Optional[typing.Callable[[bool], None]] = release
+
+    def read(self, amt: typing.Optional[int] = None) -> bytes:
+        return self._response.read(amt)
+
+    def readinto(self, buffer: typing.Any) -> int:
+        return self._response.readinto(buffer)
+
+    def close(self) -> None:
+        if self._release is None:
+            return
+        reusable = self._response.isclosed() and not self._response.will_close
+        self._response.close()
+        self._release(reusable)
+        self._release = None
+
+    def __enter__(self) -> "PooledResponse":
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.close()
+
+
+class ConnectionPool:
+    # Keep-alive connections that are reused for requests to the same host
+    # (urllib.request makes a new connection, including a TLS handshake, for
+    # every request). Can be shared between threads, concurrency per host is
+    # up to the caller.
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._idle: typing.Dict[
+            typing.Tuple[str, str], typing.List[http.client.HTTPConnection]
+        ] = {}
+
+    def _connection(
+        self, scheme: str, netloc: str, reuse: bool
+    ) -> typing.Tuple[http.client.HTTPConnection, bool]:
+        if reuse:
+            with self._lock:
+                idle = self._idle.get((scheme, netloc))
+                if idle:
+                    return idle.pop(), True
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(
+                netloc, timeout=POOL_TIMEOUT, context=ssl_context()
+            )
+        else:
+            connection = http.client.HTTPConnection(netloc, timeout=POOL_TIMEOUT)
+        return connection, False
+
+    def _release(
+        self,
+        scheme: str,
+        netloc: str,
+        connection: http.client.HTTPConnection,
+        reusable: bool,
+    ) -> None:
+        if not reusable:
+            connection.close()
+            return
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(connection)
+
+    def open(
+        self,
+        url: str,
+        method: str = "GET",
+        request_headers: typing.Optional[typing.Dict[str, str]] = None,
+    ) -> PooledResponse:
+        # Like urllib.request.urlopen: follows redirects, and raises HTTPError
+        # for error statuses.
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            reuse = True
+            while True:
+                connection, reused = self._connection(parts.scheme, parts.netloc, reuse)
+                try:
+                    connection.request(
+                        method,
+                        path,
+                        headers={"User-Agent": USER_AGENT, **(request_headers or {})},
+                    )
+                    response = connection.getresponse()
+                    break
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    # The server may have closed an idle connection, retry
+                    # with a new one.
+                    if not reused:
+                        raise
+                    reuse = False
+            pooled_response = PooledResponse(
+                url,
+                response,
+                lambda reusable, p=parts, c=connection: self._release(
+                    p.scheme, p.netloc, c, reusable
+                ),
+            )
+            location = response.headers.get("Location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                pooled_response.read()
+                pooled_response.close()
+                url = urllib.parse.urljoin(url, location)
+                if response.status == 303 and method != "HEAD":
+                    method = "GET"
+                continue
+            if response.status >= 400:
+                raise urllib.error.HTTPError(
+                    url,
+                    response.status,
+                    response.reason,
+                    response.headers,
+                    pooled_response,
+                )
+            return pooled_response
+        raise IOError("Too many redirects for %s" % url)
+
+    def close(self) -> None:
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+
+Response = typing.Union[http.client.HTTPResponse, PooledResponse]
+
+
+def open_url(
+    url: str,
+    method: str = "GET",
+    request_headers: typing.Optional[typing.Dict[str, str]] = None,
+    pool: typing.Optional[ConnectionPool] = None,
+) -> Response:
+    if pool:
+        return pool.open(url, method, request_headers)
+    request = urllib.request.Request(
+        url,
+        method=method,
+        data=None,
+        headers={"User-Agent": USER_AGENT, **(request_headers or {})},
+    )
+    return urllib.request.urlopen(request, context=ssl_context())
+
+
+def fetch_url(
+    url: str, headers: bool = False, pool: typing.Optional[ConnectionPool] = None
+) -> bytes:
+    try:
+        with open_url(url, "HEAD" if headers else "GET", pool=pool) as response:
+            if headers:
+                return json.dumps(dict(response.headers)).encode()
+            return response.read()
+    except:
+        sys.stderr.write("Failed to download %s\n" % url)
+        raise
+
+
+def open_url_from(
+    url: str,
+    offset: int,
+    pool: typing.Optional[ConnectionPool] = None,
+    validators: typing.Optional[typing.Dict[str, str]] = None,
+) -> typing.Tuple[typing.Optional[Response], int]:
+    # Requests url starting at offset, if it has not changed since the first
+    # offset bytes were downloaded (validators are from that response). Returns
+    # the response and the offset that it actually starts at (0 if the
+    # resource has changed, can't be checked for changes, or the server does
+    # not support ranges), or no response if the resource is exactly offset
+    # bytes long.
+    if_range = if_range_validator(validators) if validators else None
+    if not offset or not if_range:
+        return open_url(url, pool=pool), 0
+    try:
+        response = open_url(
             url,
-            method="HEAD" if headers else "GET",
-            data=None,
-            headers={"User-Agent": "Infinite Mac (+https://infinitemac.org)"},
+            request_headers={"Range": "bytes=%d-" % offset, "If-Range": if_range},
+            pool=pool,
         )
-        response = urllib.request.urlopen(request, context=context)
-        if headers:
-            return json.dumps(dict(response.headers)).encode()
-        return response.read()
+    except urllib.error.HTTPError as e:
+        if e.code != 416:
+            raise
+        # The partial file is at least as long as the resource, it's complete
+        # if the lengths match.
+        content_range = e.headers.get("Content-Range", "")
+        e.close()
+        if content_range == "bytes */%d" % offset:
+            return None, offset
+        return open_url(url, pool=pool), 0
+    if response.status != 206:
+        # The resource has changed (or ranges are not supported), this is the
+        # whole resource.
+        return response, 0
+    current_validators = response_validators(response.headers)
+    # Validators are also compared here, for servers that ignore If-Range.
+    if not response.headers.get("Content-Range", "").startswith(
+        "bytes %d-" % offset
+    ) or any(current_validators.get(n, v) != v for n, v in validators.items()):
+        response.close()
+        return open_url(url, pool=pool), 0
+    return response, offset
+
+
+def write_response(response: Response, partial_path: str, offset: int) -> str:
+    # Streams the response to partial_path, starting at offset, and checks
+    # that all of it was received. Returns the SHA-256 digest of the file,
+    # which is computed while streaming (only the first offset bytes, from an
+    # earlier attempt, are read back).
+    content_length = response.headers.get("Content-Length")
+    digest = hashlib.sha256()
+    with open(partial_path, "r+b" if offset else "wb") as partial_file:
+        if offset:
+            partial_file.truncate(offset)
+            for data in iter(lambda: partial_file.read(DOWNLOAD_BUFFER_SIZE), b""):
+                digest.update(data)
+        while data := response.read(DOWNLOAD_BUFFER_SIZE):
+            digest.update(data)
+            partial_file.write(data)
+        size = partial_file.tell()
+    if content_length is not None and size != offset + int(content_length):
+        raise IOError(
+            "Incomplete download (%d of %d bytes)"
+            % (size, offset + int(content_length))
+        )
+    return digest.hexdigest()
+
+
+class Download(typing.NamedTuple):
+    validators: typing.Dict[str, str]
+    sha256: str
+
+
+def download_to_path(
+    url: str,
+    dest_path: str,
+    pool: typing.Optional[ConnectionPool] = None,
+    sha256: typing.Optional[str] = None,
+) -> Download:
+    # Streams the response to dest_path + PARTIAL_SUFFIX, which is only renamed
+    # to dest_path once it's complete (and matches the expected sha256, if
+    # any), so that an interrupted or corrupted download is never mistaken for
+    # a cached file. The next attempt resumes it with a Range request, as
+    # long as the resource hasn't changed since according to the validators
+    # that are stored next to it (otherwise, or if the server doesn't support
+    # ranges, it starts over).
+    partial_path = dest_path + PARTIAL_SUFFIX
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    validators = (read_validators(partial_path) if offset else None) or {}
+    try:
+        response, offset = open_url_from(url, offset, pool, validators)
+        if response is not None:
+            with response:
+                validators = response_validators(response.headers)
+                if not offset:
+                    write_validators(partial_path, validators)
+                digest = write_response(response, partial_path, offset)
+        else:
+            digest = registry.hash_file(partial_path)
+        if sha256 and digest != sha256:
+            # Resuming it would not help.
+            os.remove(partial_path)
+            remove_validators(partial_path)
+            raise IOError(
+                "Download does not match the expected digest (%s instead of %s)"
+                % (digest, sha256)
+            )
+        os.replace(partial_path, dest_path)
+        remove_validators(partial_path)
     except:
         sys.stderr.write("Failed to download %s\n" % url)
         raise
+    return Download(validators, digest)
 
 
 # macgui.com has a nonce in the download URL, so we need to fetch the page first
 # to get it, and then do the download.
-def fetch_macgui_url(page_url: str, headers: bool = False) -> str:
-    page_body = fetch_url(page_url)
+def macgui_download_url(
+    page_url: str, pool: typing.Optional[ConnectionPool] = None
+) -> str:
+    page_body = fetch_url(page_url, pool=pool)
     soup = bs4.BeautifulSoup(page_body, "html.parser")
     download_link = soup.find("a", {"title": "Download File"})
     if download_link:
-        download_url = urllib.parse.urljoin(page_url, download_link.get("href"))
-        return fetch_url(download_url, headers)
+        return urllib.parse.urljoin(page_url, download_link.get("href"))
     else:
         raise Exception("Could not find download link on page %s" % page_url)
+
+
+def fetch_macgui_url(
+    page_url: str, headers: bool = False, pool: typing.Optional[ConnectionPool] = None
+) -> bytes:
+    return fetch_url(macgui_download_url(page_url, pool), headers, pool)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import argparse
+import chunks
+import concurrent.futures
+import merkle
+import os
+import paths
+import registry
+import sweep
+import sys
+import time
+import typing
+
+# Registry kind for the signature of a stored chunk file (as opposed to the
+# chunk signatures of an image, which are keyed by the image path).
+CHUNK_SIGNATURE_KIND = "chunk-signature"
+
+
+class ChunkResult(typing.NamedTuple):
+    signature: str
+    # "ok", "missing" or "corrupt".
+    status: str
+    # Bytes that had to be read and hashed (0 if the registry had an entry).
+    hashed_size: int
+    fingerprint: typing.Optional[registry.Fingerprint]
+    actual_signature: typing.Optional[str]
+
+
+def verify_chunk(signature: str, chunk_dir: str, use_registry: bool) -> ChunkResult:
+    path = chunks.chunk_path(signature, chunk_dir)
+    try:
+        fingerprint = registry.fingerprint(path)
+    except FileNotFoundError:
+        return ChunkResult(signature, "missing", 0, None, None)
+    actual_signature = (
+        registry.get(fingerprint, CHUNK_SIGNATURE_KIND) if use_registry else None
+    )
+    hashed_size = 0
+    if actual_signature is None:
+        with open(path, "rb") as chunk_file:
+            data = chunk_file.read()
+        hashed_size = len(data)
+        actual_signature = chunks.chunk_signature(data)
+    return ChunkResult(
+        signature,
+        "ok" if actual_signature == signature else "corrupt",
+        hashed_size,
+        fingerprint if hashed_size else None,
+        actual_signature,
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Check that every chunk referenced by the manifests in src/Data is "
+            "in Images/build and has the expected signature, and that the "
+            "manifests' Merkle trees (if any) match their chunk lists."
+        )
+    )
+    parser.add_argument(
+        "--manifest-dir",
+        default=paths.DATA_DIR,
+        help="directory of manifests to verify (default: src/Data)",
+    )
+    parser.add_argument(
+        "--chunk-dir",
+        default=paths.DISK_DIR,
+        help="chunk store to verify (default: Images/build)",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of chunks to hash concurrently (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help=(
+            "rehash every chunk, instead of trusting the hash registry for "
+            "files that have not changed since they were last verified"
+        ),
+    )
+    args = parser.parse_args()
+    start_time = time.monotonic()
+
+    all_manifests = sweep.read_manifest_dir(args.manifest_dir)
+    images_by_signature: typing.Dict[str, typing.List[str]] = {}
+    for name, manifest in all_manifests.items():
+        for signature in set(manifest["chunks"]):
+            if signature:
+                images_by_signature.setdefault(signature, []).append(name)
+    signatures = sorted(images_by_signature.keys())
+    sys.stderr.write(
+        "Verifying %d chunks referenced by %d manifests\n"
+        % (len(signatures), len(all_manifests))
+    )
+
+    # blake2b and file I/O release the GIL for chunk-sized buffers.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as e:
+        results = list(
+            e.map(
+                lambda s: verify_chunk(s, args.chunk_dir, use_registry=not args.full),
+                signatures,
+            )
+        )
+    # Only remember signatures that were just computed (a single transaction,
+    # instead of one per chunk).
+    registry.put_many(
+        (r.fingerprint, CHUNK_SIGNATURE_KIND, r.actual_signature)
+        for r in results
+        if r.fingerprint
+    )
+
+    problem_count = 0
+    for result in results:
+        if result.status != "ok":
+            problem_count += 1
+            print(
+                "%s %s (in %s)"
+                % (
+                    result.status,
+                    result.signature,
+                    ", ".join(images_by_signature[result.signature]),
+                )
+            )
+    tree_count = 0
+    for name, manifest in all_manifests.items():
+        if "merkle" not in manifest:
+            continue
+        tree_count += 1
+        mismatched_nodes = merkle.check_tree(manifest)
+        if mismatched_nodes == [-1]:
+            problem_count += 1
+            print("bad-root %s" % name)
+        elif mismatched_nodes:
+            problem_count += 1
+            span = manifest["merkle"]["span"]
+            print(
+                "bad-nodes %s (chunks %s)"
+                % (
+                    name,
+                    ", ".join(
+                        "%d-%d" % (i * span, (i + 1) * span - 1)
+                        for i in mismatched_nodes
+                    ),
+                )
+            )
+
+    hashed_size = sum(r.hashed_size for r in results)
+    sys.stderr.write(
+        "%d missing, %d corrupt chunks; %d Merkle trees checked; hashed %d "
+        "chunks (%s), %d unchanged since they were last verified\n"
+        % (
+            sum(1 for r in results if r.status == "missing"),
+            sum(1 for r in results if r.status == "corrupt"),
+            tree_count,
+            sum(1 for r in results if r.hashed_size),
+            chunks.format_throughput(hashed_size, time.monotonic() - start_time),
+            sum(1 for r in results if r.status != "missing" and not r.hashed_size),
+        )
+    )
+    return 1 if problem_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
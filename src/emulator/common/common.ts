@@ -108,13 +108,114 @@ export type EmulatorChunkedFileSpec = {
     baseUrl: string;
     totalSize: number;
     chunks: string[];
+    // Upper bound on the size of chunks. Unless chunkStarts is provided, all
+    // chunks are this size (except for the last one, which may be truncated).
     chunkSize: number;
+    // Offsets of variable-length (content-defined) chunks. Chunk i spans from
+    // chunkStarts[i] to chunkStarts[i + 1] (or totalSize for the last one).
+    // Not supported for persistent disks.
+    chunkStarts?: number[];
     prefetchChunks: number[];
     persistent?: boolean;
     isFloppy?: boolean;
     hasDeviceImageHeader?: boolean;
 };
 
+type ChunkLayout = Pick<
+    EmulatorChunkedFileSpec,
+    "totalSize" | "chunkSize" | "chunkStarts"
+>;
+
+export function getChunkStart(spec: ChunkLayout, chunkIndex: number): number {
+    const {chunkStarts, chunkSize, totalSize} = spec;
+    if (!chunkStarts) {
+        return chunkIndex * chunkSize;
+    }
+    if (chunkIndex < chunkStarts.length) {
+        return chunkStarts[chunkIndex];
+    }
+    // Chunks past the end of the file are treated as fixed size.
+    return totalSize + (chunkIndex - chunkStarts.length) * chunkSize;
+}
+
+export function getChunkIndex(spec: ChunkLayout, offset: number): number {
+    const {chunkStarts, chunkSize, totalSize} = spec;
+    if (!chunkStarts) {
+        return Math.floor(offset / chunkSize);
+    }
+    if (offset >= totalSize) {
+        return (
+            chunkStarts.length + Math.floor((offset - totalSize) / chunkSize)
+        );
+    }
+    // Binary search for the last chunk that starts at or before the offset.
+    let low = 0;
+    let high = chunkStarts.length - 1;
+    while (low < high) {
+        const mid = (low + high + 1) >> 1;
+        if (chunkStarts[mid] <= offset) {
+            low = mid;
+        } else {
+            high = mid - 1;
+        }
+    }
+    return low;
+}
+
+// prefetchChunks lists in disk definitions are indexes of fixed-size chunks of
+// this size. Content-defined chunks (chunkStarts) have other boundaries, so the
+// lists are mapped to the chunks that cover the same bytes.
+export const PREFETCH_CHUNK_SIZE = 256 * 1024;
+
+export function getPrefetchChunks(
+    spec: ChunkLayout,
+    prefetchChunks: number[]
+): number[] {
+    if (!spec.chunkStarts) {
+        return prefetchChunks;
+    }
+    // Sets preserve insertion order, so the prefetch order is kept.
+    const chunkIndexes = new Set<number>();
+    for (const prefetchChunk of prefetchChunks) {
+        const start = prefetchChunk * PREFETCH_CHUNK_SIZE;
+        const end = Math.min(start + PREFETCH_CHUNK_SIZE, spec.totalSize);
+        if (start >= end) {
+            continue;
+        }
+        const last = getChunkIndex(spec, end - 1);
+        for (let i = getChunkIndex(spec, start); i <= last; i++) {
+            chunkIndexes.add(i);
+        }
+    }
+    return Array.from(chunkIndexes);
+}
+
+// The inverse of getPrefetchChunks(), for suggesting prefetchChunks lists.
+export function getPrefetchChunkIndexes(
+    spec: ChunkLayout,
+    chunkIndexes: number[]
+): number[] {
+    if (!spec.chunkStarts) {
+        return chunkIndexes;
+    }
+    const prefetchChunks = new Set<number>();
+    for (const chunkIndex of chunkIndexes) {
+        const start = getChunkStart(spec, chunkIndex);
+        const end = Math.min(
+            getChunkStart(spec, chunkIndex + 1),
+            spec.totalSize
+        );
+        if (start >= end) {
+            continue;
+        }
+        const last = Math.floor((end - 1) / PREFETCH_CHUNK_SIZE);
+        for (let i = Math.floor(start / PREFETCH_CHUNK_SIZE); i <= last; i++) {
+            prefetchChunks.add(i);
+        }
+    }
+    return Array.from(prefetchChunks);
+}
+
 export function generateChunkUrl(
     spec: Pick<EmulatorChunkedFileSpec, "baseUrl" | "chunks">,
     chunk: number
@@ -2,7 +2,7 @@ import JSZip from "jszip";
 import {saveAs} from "file-saver";
 import {type EmulatorDiskDef} from "@/defs/disks";
 import {dirtyChunksFileName, dataFileName} from "@/emulator/common/disk-saver";
-import {generateChunkUrl} from "@/emulator/common/common";
+import {generateChunkUrl, getChunkStart} from "@/emulator/common/common";
 import {
     DeviceImageType,
     generateDeviceImageHeader,
@@ -140,7 +140,7 @@ export async function saveDiskSaverImage(
 
         const chunkUrl = generateChunkUrl(chunkedSpec, chunkIndex);
         const chunk = await (await fetch(chunkUrl)).arrayBuffer();
-        image.set(new Uint8Array(chunk), chunkIndex * spec.chunkSize);
+        image.set(new Uint8Array(chunk), getChunkStart(spec, chunkIndex));
     }
 
     if (deviceImage) {
@@ -8,6 +8,7 @@ import {
     type EmulatorWorkerVideoBlit,
     type EmulatorMouseEvent,
     generateChunkedFileSpecForCDROM,
+    getPrefetchChunks,
     type EmulatorConfigFlags,
 } from "@/emulator/common/common";
 import {
@@ -1162,7 +1163,7 @@ async function loadDisks(
     return disks.map((d, i) => ({
         ...diskSpecs[i],
         baseUrl: "/Disk",
-        prefetchChunks: d.prefetchChunks,
+        prefetchChunks: getPrefetchChunks(diskSpecs[i], d.prefetchChunks),
         persistent: d.persistent,
         isFloppy: d.isFloppy,
         hasDeviceImageHeader: d.hasDeviceImageHeader,
@@ -1,6 +1,9 @@
 import {
     type EmulatorChunkedFileSpec,
     generateChunkUrl,
+    getChunkIndex,
+    getChunkStart,
+    getPrefetchChunkIndexes,
 } from "@/emulator/common/common";
 import {type EmulatorWorkerDisk} from "@/emulator/worker/disks";
 
@@ -110,9 +113,9 @@ export class EmulatorWorkerChunkedDisk implements EmulatorWorkerDisk {
             chunkIndex: number
         ) => void
     ) {
-        const {chunkSize} = this.#spec;
-        const startChunk = Math.floor(offset / chunkSize);
-        const endChunk = Math.floor((offset + length - 1) / chunkSize);
+        const spec = this.#spec;
+        const startChunk = getChunkIndex(spec, offset);
+        const endChunk = getChunkIndex(spec, offset + length - 1);
         for (
             let chunkIndex = startChunk;
             chunkIndex <= endChunk;
@@ -128,8 +131,8 @@ export class EmulatorWorkerChunkedDisk implements EmulatorWorkerDisk {
             }
             callback(
                 chunk,
-                chunkIndex * chunkSize,
-                (chunkIndex + 1) * chunkSize,
+                getChunkStart(spec, chunkIndex),
+                getChunkStart(spec, chunkIndex + 1),
                 chunkIndex
             );
         }
@@ -161,8 +164,9 @@ export class EmulatorWorkerChunkedDisk implements EmulatorWorkerDisk {
     #loadChunk(chunkIndex: number): Uint8Array {
         // Allow additional chunks to be created past the end (the disk image
         // may be truncated, and empty space at the end is omitted).
-        const {chunkSize} = this.#spec;
-        const chunkStart = chunkIndex * chunkSize;
+        const chunkStart = getChunkStart(this.#spec, chunkIndex);
+        const chunkSize =
+            getChunkStart(this.#spec, chunkIndex + 1) - chunkStart;
         // Entirely out of bounds chunk, just synthesize an empty one.
         if (chunkStart >= this.size) {
             return new Uint8Array(chunkSize);
@@ -224,9 +228,14 @@ export class EmulatorWorkerChunkedDisk implements EmulatorWorkerDisk {
                     needsPrefetch.sort(numberCompare)
                 );
             }
+            // The lists above are of the spec's chunks, this one is of the
+            // fixed-size chunks that prefetchChunks in disk definitions use.
             console.warn(
                 `${prefix} complete set of ideal prefetch chunks: ${JSON.stringify(
-                    Array.from(this.#loadedChunks.keys()).sort(numberCompare)
+                    getPrefetchChunkIndexes(
+                        spec,
+                        Array.from(this.#loadedChunks.keys())
+                    ).sort(numberCompare)
                 )}`
             );
         }
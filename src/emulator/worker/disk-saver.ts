@@ -1,4 +1,7 @@
-import {type EmulatorChunkedFileSpec} from "@/emulator/common/common";
+import {
+    type EmulatorChunkedFileSpec,
+    getChunkStart,
+} from "@/emulator/common/common";
 import {dataFileName, dirtyChunksFileName} from "@/emulator/common/disk-saver";
 import {type EmulatorWorkerChunkedDiskDelegate} from "@/emulator/worker/chunked-disk";
 
@@ -86,7 +89,7 @@ export class EmulatorWorkerDiskSaver
         const chunkBit = 1 << (chunkIndex & 7);
         if (chunkByte & chunkBit) {
             this.#dataHandle.read(chunk, {
-                at: chunkIndex * this.#spec.chunkSize,
+                at: getChunkStart(this.#spec, chunkIndex),
             });
             chunkByte &= ~chunkBit;
             this.#chunksToRead[chunkByteIndex] = chunkByte;
@@ -110,7 +113,7 @@ export class EmulatorWorkerDiskSaver
             );
         }
         this.#dataHandle.write(chunk, {
-            at: chunkIndex * this.#spec.chunkSize,
+            at: getChunkStart(this.#spec, chunkIndex),
         });
     }
 